@@ -6,13 +6,15 @@ from pydantic import BaseModel
 from typing import Any, List
 
 from processor import MainProcessor
-from jobtools import EmbedJob, JobRegister
+from jobtools import EmbedJob, JobRegister, JobReaper
 
 # Fetch the supertoken from environment variables
 supertoken = os.getenv('SUPERTOKEN', default="PLEASE_CHANGE_THIS_PLEASE")
 
 # Initialize job registration and threading components
 jobReg = JobRegister()
+reaper = JobReaper(jobReg)
+reaper.start()
 taskLock = threading.Lock()
 taskQueue = queue.Queue(maxsize=1000)
 
@@ -46,8 +48,14 @@ async def get_status(info: InfoRequest) -> Any:
 
     Returns:
         Any: The status of the job.
+
+    Raises:
+        HTTPException: If the job does not exist or was already removed.
     """
-    return {"status":jobReg.get_job(info.uuid).get_status(),"queue_size":taskQueue.qsize()}
+    job = jobReg.get_job(info.uuid)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"status":job.get_status(),"queue_size":taskQueue.qsize()}
 
 
 @app.post("/getCompletion/")
@@ -114,7 +122,12 @@ async def embed_job(item: EmbedRequest) -> Any:
         dict: The UUID and status of the created job.
     """
     job = EmbedJob(item.text)
-    jobReg.add_job(job)
+    if not jobReg.add_job(job):
+        job.set_status("failed")
+        return {
+            "uuid": job.get_uuid(),
+            "status": job.get_status()
+        }
     
     try:
         taskQueue.put(job.get_uuid())
@@ -124,4 +137,15 @@ async def embed_job(item: EmbedRequest) -> Any:
     return {
         "uuid": job.get_uuid(),
         "status": job.get_status()
-    }
\ No newline at end of file
+    }
+
+
+@app.get("/getJobStats/")
+async def get_job_stats() -> Any:
+    """
+    Get the number of registered jobs, the bytes they retain and the eviction counters.
+
+    Returns:
+        dict: The statistics of the job register.
+    """
+    return jobReg.get_stats()
@@ -1,6 +1,9 @@
+import os
+import time
+import threading
 from uuid import uuid4
-from typing import List, Dict, Optional
-from threading import RLock
+from typing import Callable, List, Dict, Optional
+from threading import Lock, RLock
 
 
 class EmbedJob:
@@ -12,6 +15,11 @@ class EmbedJob:
         uuid (str): A unique identifier for the embed job.
         status (str): The current status of the embed job (e.g., 'created', 'processing', 'completed').
         embedding (Optional[List[float]]): The embedded vector, if available.
+        updated_at (float): The monotonic time of the last status change.
+        size (int): The number of bytes retained by the job.
+        lock (Lock): Guards the size and the register callback.
+        on_resize (Optional[Callable[[int], None]]): Called with the change in size when the
+            embedding is set, so that the register holding the job can keep its total current.
     """
 
     def __init__(self, text: str):
@@ -25,6 +33,10 @@ class EmbedJob:
         self.uuid = str(uuid4().hex)
         self.status = "created"
         self.embedding: Optional[List[float]] = None
+        self.updated_at = time.monotonic()
+        self.size = len(text.encode("utf-8"))
+        self.lock = Lock()
+        self.on_resize: Optional[Callable[[int], None]] = None
 
     def set_embedding(self, embedding: List[float]) -> None:
         """
@@ -34,6 +46,22 @@ class EmbedJob:
             embedding (List[float]): The embedded vector to assign to the job.
         """
         self.embedding = embedding
+        values = 0
+        for value in embedding or []:
+            values += len(value) if isinstance(value, list) else 1
+        self.resize(len(self.text.encode("utf-8")) + 8 * values)
+
+    def resize(self, size: int) -> None:
+        """
+        Sets the number of bytes retained by the job and reports the change to its register.
+
+        Args:
+            size (int): The new size.
+        """
+        with self.lock:
+            change, self.size = size - self.size, size
+            if self.on_resize is not None:
+                self.on_resize(change)
 
     def get_embedding(self) -> Optional[List[float]]:
         """
@@ -44,6 +72,24 @@ class EmbedJob:
         """
         return self.embedding
 
+    def get_size(self) -> int:
+        """
+        Estimates the number of bytes retained by the embed job.
+
+        Returns:
+            int: The UTF-8 size of the text plus 8 bytes per embedding value.
+        """
+        return self.size
+
+    def get_updated_at(self) -> float:
+        """
+        Retrieves the monotonic time of the last status change.
+
+        Returns:
+            float: The time of the last status change.
+        """
+        return self.updated_at
+
     def get_text(self) -> str:
         """
         Retrieves the original text string.
@@ -79,48 +125,80 @@ class EmbedJob:
             status (str): The new status to assign to the embed job.
         """
         self.status = status
+        self.updated_at = time.monotonic()
 
 class JobRegister:
     """
     A thread-safe class to manage the registration and tracking of multiple jobs.
 
+    Jobs in a final state expire once they have not changed for the time to live. The number of
+    jobs and the bytes they retain are capped; to make room for a new job the least recently
+    updated final jobs are evicted, and the new job is refused if that is not enough.
+
     Attributes:
         register (Dict[str, EmbedJob]): A dictionary storing jobs by their UUID.
         lock (RLock): A reentrant lock to ensure thread-safe operations.
+        ttl (float): Seconds a job in a final state is kept after its last status change.
+        max_jobs (int): The maximum number of registered jobs.
+        max_bytes (int): The maximum number of bytes retained by the registered jobs.
+        evicted_expired (int): The number of jobs removed because their time to live passed.
+        evicted_capacity (int): The number of jobs removed to make room for new ones.
+        rejected (int): The number of jobs refused because the register was full.
+        retained (int): The running total of the bytes retained by the registered jobs.
+        retained_lock (Lock): Guards the running total, which jobs update as their size changes.
     """
 
-    def __init__(self):
+    FINAL_STATUSES = ("finished", "failed")
+
+    def __init__(self, ttl: Optional[float] = None, max_jobs: Optional[int] = None, max_bytes: Optional[int] = None):
         """
         Initializes a JobRegister instance with an empty register and a lock.
+
+        Args:
+            ttl (Optional[float]): Seconds to keep final jobs. Defaults to JOB_TTL.
+            max_jobs (Optional[int]): The maximum number of jobs. Defaults to MAX_JOBS.
+            max_bytes (Optional[int]): The maximum retained bytes. Defaults to MAX_JOB_BYTES.
         """
         self.register: Dict[str, EmbedJob] = {}
         self.lock = RLock()
+        self.ttl = ttl if ttl is not None else float(os.getenv('JOB_TTL', '3600'))
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.getenv('MAX_JOBS', '10000'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('MAX_JOB_BYTES', str(1024 ** 3)))
+        self.evicted_expired = 0
+        self.evicted_capacity = 0
+        self.rejected = 0
+        self.retained = 0
+        self.retained_lock = Lock()
 
     def delete_job(self, uuid: str) -> None:
         """
-        Deletes a job from the register by its UUID.
+        Deletes a job from the register by its UUID. Unknown UUIDs are ignored.
 
         Args:
             uuid (str): The UUID of the job to delete.
-
-        Raises:
-            KeyError: If the UUID is not found in the register.
         """
         with self.lock:
-            try:
-                del self.register[uuid]
-            except Exception as e:
-                print(e)
+            job = self.register.pop(uuid, None)
+            if job is not None:
+                self._untrack(job)
 
-    def add_job(self, job: EmbedJob) -> None:
+    def add_job(self, job: EmbedJob) -> bool:
         """
-        Adds a job to the register.
+        Adds a job to the register, evicting final jobs if the register is full.
 
         Args:
             job (EmbedJob): The job instance to add.
+
+        Returns:
+            bool: True if the job was added, False if the register is full.
         """
         with self.lock:
+            if not self.make_room(job.get_size()):
+                self.rejected += 1
+                return False
             self.register[job.get_uuid()] = job
+            self._track(job)
+            return True
 
     def get_job(self, uuid: str) -> Optional[EmbedJob]:
         """
@@ -135,6 +213,138 @@ class JobRegister:
         with self.lock:
             return self.register.get(uuid)
 
+    def _track(self, job: EmbedJob) -> None:
+        """
+        Adds a newly registered job to the running total and has it report its changes in size.
+
+        Args:
+            job (EmbedJob): The job.
+        """
+        with job.lock:
+            job.on_resize = self._resize
+            self._resize(job.get_size())
+
+    def _untrack(self, job: EmbedJob) -> None:
+        """
+        Removes a job that left the register from the running total.
+
+        Args:
+            job (EmbedJob): The job.
+        """
+        with job.lock:
+            job.on_resize = None
+            self._resize(-job.get_size())
+
+    def _resize(self, size: int) -> None:
+        """
+        Changes the running total of retained bytes.
+
+        Args:
+            size (int): The bytes to add, negative to subtract.
+        """
+        with self.retained_lock:
+            self.retained += size
+
+    def retained_bytes(self) -> int:
+        """
+        Retrieves the number of bytes retained by the registered jobs.
+
+        Returns:
+            int: The retained bytes.
+        """
+        with self.retained_lock:
+            return self.retained
+
+    def make_room(self, size: int) -> bool:
+        """
+        Evicts the least recently updated final jobs until a new job of the given size fits.
+
+        Args:
+            size (int): The bytes retained by the new job.
+
+        Returns:
+            bool: True if the new job fits.
+        """
+        with self.lock:
+            def fits() -> bool:
+                return len(self.register) < self.max_jobs and self.retained_bytes() + size <= self.max_bytes
+
+            if fits():
+                return True
+            final = [job for job in self.register.values() if job.get_status() in self.FINAL_STATUSES]
+            for job in sorted(final, key=lambda job: job.get_updated_at()):
+                del self.register[job.get_uuid()]
+                self._untrack(job)
+                self.evicted_capacity += 1
+                if fits():
+                    return True
+            return False
+
+    def reap(self) -> int:
+        """
+        Removes the final jobs whose time to live has passed.
+
+        Returns:
+            int: The number of removed jobs.
+        """
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            expired = [
+                uuid for uuid, job in self.register.items()
+                if job.get_status() in self.FINAL_STATUSES and job.get_updated_at() < deadline
+            ]
+            for uuid in expired:
+                self._untrack(self.register.pop(uuid))
+            self.evicted_expired += len(expired)
+            return len(expired)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size of the register and its eviction counters.
+
+        Returns:
+            Dict[str, int]: The number of jobs, retained bytes and eviction counters.
+        """
+        with self.lock:
+            return {
+                "jobs": len(self.register),
+                "retained_bytes": self.retained_bytes(),
+                "evicted_expired": self.evicted_expired,
+                "evicted_capacity": self.evicted_capacity,
+                "rejected": self.rejected
+            }
+
+class JobReaper(threading.Thread):
+    """
+    A daemon thread that periodically removes expired jobs from a JobRegister.
+
+    Attributes:
+        jobReg (JobRegister): The register to clean up.
+        interval (float): Seconds between two clean-ups.
+    """
+
+    def __init__(self, jobReg: JobRegister, interval: Optional[float] = None):
+        """
+        Initializes the JobReaper.
+
+        Args:
+            jobReg (JobRegister): The register to clean up.
+            interval (Optional[float]): Seconds between two clean-ups. Defaults to JOB_REAP_INTERVAL.
+        """
+        super().__init__(daemon=True)
+        self.jobReg = jobReg
+        self.interval = interval if interval is not None else float(os.getenv('JOB_REAP_INTERVAL', '60'))
+
+    def run(self):
+        """
+        Removes expired jobs every interval seconds.
+        """
+        while True:
+            time.sleep(self.interval)
+            removed = self.jobReg.reap()
+            if removed:
+                print(f"Removed {removed} expired job(s).")
+
 class RoleToggle:
     """
     A class to toggle between two roles: 'user' and 'assistant'.
@@ -1,8 +1,107 @@
 import os
+import json
+import time
+import hashlib
 import requests
+import threading
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 from llama_cpp import Llama
 
+
+def file_sha256(path: str) -> str:
+    """
+    Computes the SHA-256 of a file.
+
+    Parameters:
+    -----------
+    path : str
+        The path of the file.
+
+    Returns:
+    --------
+    str
+        The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DownloadProgress:
+    """
+    A thread-safe counter of downloaded bytes that prints the progress at most every few seconds.
+
+    Attributes:
+    -----------
+    total : Optional[int]
+        The expected number of bytes, if known.
+    done : int
+        The number of bytes downloaded so far, including resumed ones.
+    interval : float
+        The minimum number of seconds between two reports.
+    started : float
+        The monotonic time the download (re)started, used for the rate.
+    resumed : int
+        The number of bytes that were already present when the download (re)started.
+    reported : float
+        The monotonic time of the last report.
+    lock : threading.Lock
+        Guards the counters, which are updated from several download threads.
+    """
+
+    def __init__(self, total: Optional[int], done: int = 0, interval: float = 5):
+        """
+        Initializes the progress of a download.
+
+        Parameters:
+        -----------
+        total : Optional[int]
+            The expected number of bytes, if known.
+        done : int
+            The number of bytes already present from an earlier attempt.
+        interval : float
+            The minimum number of seconds between two reports.
+        """
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.started = time.monotonic()
+        self.resumed = done
+        self.reported = self.started
+        self.lock = threading.Lock()
+        if done:
+            print(f"Resuming download at {done / 2**20:.0f} MiB.")
+
+    def add(self, count: int) -> bool:
+        """
+        Adds downloaded bytes and prints the progress if the last report is old enough.
+
+        Parameters:
+        -----------
+        count : int
+            The number of bytes downloaded.
+
+        Returns:
+        --------
+        bool
+            True if the progress has been reported.
+        """
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.reported < self.interval and self.done != self.total:
+                return False
+            self.reported = now
+            rate = (self.done - self.resumed) / max(now - self.started, 1e-6) / 2**20
+            total = f" of {self.total / 2**20:.0f}" if self.total else ""
+            print(f"Downloaded {self.done / 2**20:.0f}{total} MiB ({rate:.1f} MiB/s)")
+            return True
+
+
 class ModelHandler:
     """
     A class to handle downloading and building the Llama model.
@@ -17,6 +116,10 @@ class ModelHandler:
         The URL from which to download the model if needed.
     filename : str
         The path where the model binary should be saved/loaded from.
+    sha256 : str
+        The expected SHA-256 of the model file; empty to skip verification.
+    connections : int
+        The number of parallel connections used for the download.
     gpu_layers : int
         The number of GPU layers to use for inference.
     verbose : bool
@@ -31,7 +134,9 @@ class ModelHandler:
         Initializes and returns the Llama model instance.
     """
 
-    CHUNK_SIZE = 8192  # Constant for download chunk size
+    CHUNK_SIZE = 1024 * 1024  # Constant for download chunk size
+    TIMEOUT = 60  # Seconds without data after which a download connection is dropped
+    RETRIES = 5  # Attempts per download segment
 
     def __init__(self):
         """
@@ -44,6 +149,8 @@ class ModelHandler:
         """
         self.url = os.getenv('EMBEDDING_DOWNLOAD_URL')
         self.filename = os.getenv('EMBEDDING_MODEL_BIN_PATH')
+        self.sha256 = os.getenv('EMBEDDING_SHA256', '').lower()
+        self.connections = max(1, int(os.getenv('DOWNLOAD_CONNECTIONS', '8')))
         self.gpu_layers = int(os.getenv('GPU_LAYERS', '0'))  # Default to 0 GPU layers
         self.verbose = True  # Always use verbose mode (non-verbose leads to errors)
         self.n_ctx = int(os.getenv('EMBED_N_CTX', '0'))
@@ -55,6 +162,12 @@ class ModelHandler:
         """
         Downloads the model from the specified URL and saves it locally.
 
+        The file is downloaded to a ".part" file next to the target and only renamed to the
+        target once it is complete (and matches the expected SHA-256, if one is set), so an
+        interrupted download never leaves a truncated model behind. If the server supports
+        range requests, the file is split into segments downloaded in parallel, and an
+        interrupted download resumes where it stopped.
+
         Returns:
         --------
         str
@@ -66,16 +179,146 @@ class ModelHandler:
             If the download request fails with an HTTP error.
         IOError:
             If there is an error writing to the file.
+        ValueError:
+            If the checksum of the downloaded file does not match.
         """
         print(f"Downloading model from {self.url}...")
-        with requests.get(self.url, stream=True) as response:
-            response.raise_for_status()  # Ensure the request was successful
-            with open(self.filename, 'wb') as f:
+        part = self.filename + ".part"
+        size, ranged = self.probe()
+        if ranged and size:
+            self.download_segments(part, size)
+        else:
+            if os.path.exists(part + ".json"):
+                # A preallocated file of a segmented download cannot be continued as a stream
+                os.remove(part + ".json")
+                os.remove(part)
+            self.download_stream(part, ranged)
+
+        if self.sha256:
+            digest = file_sha256(part)
+            if digest != self.sha256:
+                os.remove(part)
+                raise ValueError(f"Checksum mismatch for {self.url}: expected {self.sha256}, got {digest}.")
+            print("Checksum verified.")
+
+        os.replace(part, self.filename)
+        print("Download complete.")
+        return self.filename
+
+    def probe(self) -> Tuple[Optional[int], bool]:
+        """
+        Asks the server for the size of the model and whether it supports range requests.
+
+        Returns:
+        --------
+        Tuple[Optional[int], bool]
+            The size in bytes, if known, and whether range requests are supported.
+        """
+        with requests.get(self.url, headers={"Range": "bytes=0-0"}, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+                total = response.headers["Content-Range"].rsplit("/", 1)[1]
+                return (int(total) if total.isdigit() else None), True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else None), False
+
+    def download_stream(self, part: str, ranged: bool) -> None:
+        """
+        Downloads the model on a single connection, continuing a partial file if the server
+        supports range requests.
+
+        Parameters:
+        -----------
+        part : str
+            The path of the partial file.
+        ranged : bool
+            Whether the server supports range requests.
+        """
+        offset = os.path.getsize(part) if ranged and os.path.exists(part) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            length = response.headers.get("Content-Length")
+            progress = DownloadProgress(offset + int(length) if length else None, offset)
+            with open(part, 'ab' if offset else 'wb') as f:
                 for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
                     if chunk:  # Avoid writing keep-alive chunks
                         f.write(chunk)
-        print("Download complete.")
-        return self.filename
+                        progress.add(len(chunk))
+
+    def download_segments(self, part: str, size: int) -> None:
+        """
+        Downloads the model in parallel segments written into a preallocated partial file.
+        The progress of each segment is recorded in a ".json" file next to the partial file
+        so an interrupted download resumes where it stopped.
+
+        Parameters:
+        -----------
+        part : str
+            The path of the partial file.
+        size : int
+            The size of the model in bytes.
+        """
+        state_path = part + ".json"
+        segments = None
+        if os.path.exists(part) and os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                if state.get("url") == self.url and state.get("size") == size:
+                    segments = state["segments"]
+            except (OSError, ValueError, KeyError):
+                segments = None
+        if segments is None:
+            step = -(-size // self.connections)
+            segments = [[start, min(start + step, size), start] for start in range(0, size, step)]
+            with open(part, 'wb') as f:
+                f.truncate(size)
+
+        lock = threading.Lock()
+        progress = DownloadProgress(size, sum(done - start for start, _, done in segments))
+
+        def save_state() -> None:
+            with lock:
+                with open(state_path + ".tmp", 'w') as f:
+                    json.dump({"url": self.url, "size": size, "segments": segments}, f)
+                os.replace(state_path + ".tmp", state_path)
+
+        def fetch(segment: List[int]) -> None:
+            for attempt in range(self.RETRIES):
+                if segment[2] >= segment[1]:
+                    return
+                try:
+                    headers = {"Range": f"bytes={segment[2]}-{segment[1] - 1}"}
+                    with requests.get(self.url, headers=headers, stream=True, timeout=self.TIMEOUT) as response:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            raise requests.exceptions.HTTPError("Server ignored the range request.")
+                        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                            if chunk:
+                                chunk = chunk[:segment[1] - segment[2]]
+                                os.pwrite(fd, chunk, segment[2])
+                                segment[2] += len(chunk)
+                                if progress.add(len(chunk)):
+                                    save_state()
+                except requests.exceptions.RequestException as e:
+                    if attempt == self.RETRIES - 1:
+                        raise
+                    print(f"Warning: {e}. Retrying segment at byte {segment[2]}...")
+            if segment[2] < segment[1]:
+                raise IOError(f"Segment ending at byte {segment[1]} is incomplete.")
+
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                for future in [executor.submit(fetch, segment) for segment in segments]:
+                    future.result()
+        finally:
+            os.close(fd)
+            save_state()
+        os.remove(state_path)
 
     def build(self) -> Llama:
         """
@@ -1,5 +1,6 @@
+import json
 import requests
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 
 class ChatClient:
     """
@@ -16,33 +17,48 @@ class ChatClient:
         """
         self.base_url = base_url
 
-    def send_chat(self, sysprompt: str, messages: List[str]) -> str:
+    def send_chat(self, sysprompt: str, messages: List[str], client_id: Optional[str] = None,
+                  model: Optional[str] = None, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Sends a chat request to the /chat/ endpoint.
 
         Args:
             sysprompt (str): System prompt for the chat.
             messages (List[str]): List of user messages.
+            client_id (Optional[str]): Identifies the user for fair scheduling.
+            model (Optional[str]): Name of the model to use; the service's default model if None.
+            options (Optional[Dict[str, Any]]): Generation options such as temperature, seed,
+                                                max_tokens, stop and deadline (seconds).
 
         Returns:
-            str: UUID of the created job or error message if request fails.
+            dict: UUID, status and estimated completion time of the created job, or a failed
+                  status with an error message and the server's Retry-After if the request fails.
         """
         url = f"{self.base_url}/chat/"
         payload = {"sysprompt": sysprompt, "messages": messages}
+        if client_id:
+            payload["client_id"] = client_id
+        if model:
+            payload["model"] = model
+        if options:
+            payload.update(options)
         
         try:
             response = requests.post(url, json=payload)
             response.raise_for_status()
             return response.json()  # Return the job's UUID and status
         except requests.exceptions.RequestException as e:
-            return f"Chat request failed: {e}"
+            retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+            return {"error": f"Chat request failed: {e}", "status": "failed", "retry_after": retry_after}
 
-    def get_completion(self, uuid: str) -> Dict[str, Any]:
+    def get_completion(self, uuid: str, since: Optional[int] = None) -> Dict[str, Any]:
         """
         Retrieves the completion and status of a job based on its UUID.
 
         Args:
             uuid (str): UUID of the job.
+            since (Optional[int]): Cursor returned by the previous call. If given, only the
+                                   text produced since then is returned along with a new cursor.
 
         Returns:
             dict: A dictionary containing the job's completion and status,
@@ -50,6 +66,8 @@ class ChatClient:
         """
         url = f"{self.base_url}/getCompletion/"
         payload = {"uuid": uuid}
+        if since is not None:
+            payload["since"] = since
         
 
         try:
@@ -59,6 +77,28 @@ class ChatClient:
         except requests.exceptions.RequestException as e:
             return {"error": f"Completion request failed: {e}"}
 
+    def stream_completion(self, uuid: str) -> Iterator[Dict[str, Any]]:
+        """
+        Streams the completion of a job from the /streamCompletion/ endpoint as it is generated.
+
+        Args:
+            uuid (str): UUID of the job.
+
+        Yields:
+            dict: Events of the form {"chunk": ...} or {"status": ...},
+                  or a single {"error": ...} if the request fails.
+        """
+        url = f"{self.base_url}/streamCompletion/{uuid}"
+
+        try:
+            with requests.get(url, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("data: "):
+                        yield json.loads(line[len("data: "):])
+        except requests.exceptions.RequestException as e:
+            yield {"error": f"Stream request failed: {e}"}
+
     def get_status(self, uuid: str) -> Dict[str, Any]:
         """
         Retrieves the status of a job based on its UUID by calling the /getStatus/ endpoint.
@@ -80,6 +120,27 @@ class ChatClient:
         except requests.exceptions.RequestException as e:
             return {"error": f"Status request failed: {e}"}
 
+    def cancel_job(self, uuid: str) -> Dict[str, Any]:
+        """
+        Cancels a job using its UUID by calling the /cancelJob/ endpoint, stopping its generation.
+
+        Args:
+            uuid (str): UUID of the job to be cancelled.
+
+        Returns:
+            dict: A dictionary containing the job's status after the cancellation,
+                  or an error message if the request fails.
+        """
+        url = f"{self.base_url}/cancelJob/"
+        payload = {"uuid": uuid}
+
+        try:
+            response = requests.post(url, json=payload)
+            response.raise_for_status()
+            return response.json()  # Return job's status
+        except requests.exceptions.RequestException as e:
+            return {"error": f"Cancel job request failed: {e}"}
+
     def unregister_job(self, uuid: str) -> str:
         """
         Unregisters a job using its UUID by calling the /unregisterJob/ endpoint.
@@ -27,9 +27,10 @@ def chat():
 
         chat_job = ChatJob.from_dict(app.storage.user['chat_job']) 
         role_toggle = RoleToggle(assistant=os.getenv('ASSISTANT',default="Assistent:in"),user=os.getenv('YOU',default="Sie"))
-        result = client.get_completion(chat_job.get_uuid())
+        result = client.get_completion(chat_job.get_uuid(), since=chat_job.get_cursor())
         #print(result)
-        chat_job.set_completion(result.get('completion',''))
+        chat_job.append_chunk(result.get('completion',''))
+        chat_job.set_cursor(result.get('cursor', chat_job.get_cursor()))
         chat_job.set_status(result.get('status',''))
 
         for msg in chat_job.get_messages():
@@ -51,7 +52,7 @@ def chat():
         else:
             thinking = False
 
-            if chat_job.get_status()== 'finished':
+            if chat_job.get_status() in ('finished', 'expired'):
                 chat_job.append_message()
                 client.unregister_job(chat_job.get_uuid())
                 chat_job.set_status('created')
@@ -74,6 +75,7 @@ def chat():
         
     def delete_chat() -> None:
         chat_job = ChatJob.from_dict(app.storage.user['chat_job'])
+        client.cancel_job(chat_job.get_uuid())
         client.unregister_job(chat_job.get_uuid())
         app.storage.user['chat_job'] = ChatJob(sys_prompt="sysprompt",messages=[]).to_dict()
         chat_messages.refresh()
@@ -93,7 +95,7 @@ def chat():
         text.value = ''
         app.storage.user['input'] = ''
 
-        result = client.send_chat(sysprompt,chat_job.get_messages())
+        result = client.send_chat(sysprompt,chat_job.get_messages(),client_id=app.storage.browser.get('id'))
         chat_job.set_uuid(result.get('uuid',''))
         chat_job.set_status(result.get('status',''))
 
@@ -15,6 +15,7 @@ class ChatJob:
         uuid (str): A unique identifier for the chat job.
         status (str): The current status of the chat job.
         completion (str): The ongoing or accumulated completion text.
+        cursor (int): The cursor of the completion received so far from the llm service.
     """
 
     def __init__(self, sys_prompt: str, messages: List[str]):
@@ -30,6 +31,7 @@ class ChatJob:
         self.uuid = str(uuid4().hex)
         self.status = "created"
         self.completion = ""
+        self.cursor = 0
 
     def append_chunk(self, chunk: str) -> None:
         """
@@ -46,6 +48,7 @@ class ChatJob:
         """
         self.messages.append(self.completion)
         self.completion = ""
+        self.cursor = 0
 
     @classmethod
     def from_dict(cls, data: Dict) -> "ChatJob":
@@ -60,6 +63,7 @@ class ChatJob:
         result.uuid = data.get("uuid")
         result.status = data.get("status", "created")
         result.completion=data.get("completion", "")
+        result.cursor = data.get("cursor", 0)
         return result
 
     def get_completion(self) -> str:
@@ -70,6 +74,15 @@ class ChatJob:
             str: The completion.
         """
         return self.completion
+
+    def get_cursor(self) -> int:
+        """
+        Retrieves the cursor of the completion received so far.
+
+        Returns:
+            int: The cursor.
+        """
+        return self.cursor
         
     def get_messages(self) -> List[str]:
         """
@@ -115,6 +128,16 @@ class ChatJob:
             completion (str): The new completion to assign to the chat job.
         """
         self.completion = completion
+
+    def set_cursor(self, cursor: int) -> None:
+        """
+        Updates the cursor of the completion received so far.
+
+        Args:
+            cursor (int): The cursor returned by the llm service.
+        """
+        self.cursor = cursor
+
     def set_status(self, status: str) -> None:
         """
         Updates the status of the chat job.
@@ -143,7 +166,8 @@ class ChatJob:
             "messages": self.messages,
             "uuid": self.uuid,
             "status": self.status,
-            "completion": self.completion
+            "completion": self.completion,
+            "cursor": self.cursor
         }
 
 class JobRegister:
@@ -0,0 +1,345 @@
+"""
+Load test of the LLM service: simulated users submit chat jobs to /chat/ and poll /getCompletion/
+until they end, and the throughput, time to first token and latency percentiles are reported.
+
+Run against a running service with --url, or with --spawn to start the service with the fake
+backend, which needs neither a model nor network access:
+
+    python benchmark.py --spawn --users 16 --requests 400
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import requests
+from typing import Any, Dict, List, Optional, Tuple
+
+# Job states after which no further chunks are produced
+FINAL_STATUSES = ("finished", "failed", "cancelled", "expired")
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Computes a nearest-rank percentile.
+
+    Args:
+        values (List[float]): The samples.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+
+    Returns:
+        Optional[float]: The percentile, or None without samples.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(fraction * len(ordered) + 0.5) - 1))]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Summarizes samples by their mean and 50th, 95th and 99th percentiles.
+
+    Args:
+        values (List[float]): The samples.
+
+    Returns:
+        Dict[str, Optional[float]]: The mean, p50, p95 and p99; None without samples.
+    """
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99)
+    }
+
+
+class SimulatedUser(threading.Thread):
+    """
+    A thread that submits chat jobs one after the other and records how long each took.
+
+    Attributes:
+        index (int): The number of the user, used as its client id.
+        args (argparse.Namespace): The benchmark options.
+        counter (Dict[str, int]): The number of jobs started by all users, shared with them.
+        lock (threading.Lock): Guards the counter.
+        deadline (float): The monotonic time after which no new job is started.
+        session (requests.Session): Keeps the connection to the service alive.
+        results (List[Dict[str, Any]]): One record per job: the outcome, submit, TTFT and total
+            seconds and the number of chunks.
+    """
+
+    def __init__(self, index: int, args: argparse.Namespace, counter: Dict[str, int],
+                 lock: threading.Lock, deadline: float):
+        """
+        Initializes the SimulatedUser.
+
+        Args:
+            index (int): The number of the user.
+            args (argparse.Namespace): The benchmark options.
+            counter (Dict[str, int]): The number of jobs started by all users.
+            lock (threading.Lock): Guards the counter.
+            deadline (float): The monotonic time after which no new job is started.
+        """
+        super().__init__(daemon=True)
+        self.index = index
+        self.args = args
+        self.counter = counter
+        self.lock = lock
+        self.deadline = deadline
+        self.session = requests.Session()
+        self.results: List[Dict[str, Any]] = []
+
+    def take(self) -> bool:
+        """
+        Claims the next job of the run.
+
+        Returns:
+            bool: False once all requests are started or the duration is over.
+        """
+        if time.monotonic() >= self.deadline:
+            return False
+        with self.lock:
+            if self.args.requests and self.counter["started"] >= self.args.requests:
+                return False
+            self.counter["started"] += 1
+            return True
+
+    def run(self):
+        """
+        Runs jobs until the run is over.
+        """
+        number = 0
+        while self.take():
+            self.results.append(self.run_job(number))
+            number += 1
+
+    def run_job(self, number: int) -> Dict[str, Any]:
+        """
+        Submits one chat job and polls its completion until it ends.
+
+        Args:
+            number (int): The number of the job of this user, which varies the prompt.
+
+        Returns:
+            Dict[str, Any]: The outcome ("finished", another final status, "rejected" or "error"),
+                the seconds to submit, to the first text and to the end, and the number of chunks.
+        """
+        words = " ".join(f"word{(self.index * 31 + number + i) % 997}" for i in range(self.args.prompt_words))
+        body = {
+            "sysprompt": "You are a helpful assistant.",
+            "messages": [f"Question {self.index}-{number}: {words}"],
+            "client_id": f"bench-{self.index}",
+            "priority": self.args.priority
+        }
+        if self.args.max_tokens:
+            body["max_tokens"] = self.args.max_tokens
+        if self.args.model:
+            body["model"] = self.args.model
+
+        started = time.monotonic()
+        record: Dict[str, Any] = {"outcome": "error", "submit": None, "ttft": None, "total": None, "chunks": 0}
+        try:
+            response = self.session.post(f"{self.args.url}/chat/", json=body, timeout=self.args.timeout)
+            record["submit"] = time.monotonic() - started
+            if response.status_code == 429:
+                record["outcome"] = "rejected"
+                time.sleep(min(float(response.headers.get("Retry-After", "1")), self.args.max_backoff))
+                return record
+            response.raise_for_status()
+            uuid = response.json()["uuid"]
+
+            cursor = 0
+            try:
+                while time.monotonic() - started < self.args.timeout:
+                    result = self.session.post(f"{self.args.url}/getCompletion/",
+                                               json={"uuid": uuid, "since": cursor}, timeout=self.args.timeout).json()
+                    if result.get("completion") and record["ttft"] is None:
+                        record["ttft"] = time.monotonic() - started
+                    cursor = result.get("cursor", cursor)
+                    if result.get("status") in FINAL_STATUSES:
+                        record["outcome"] = result["status"]
+                        break
+                    time.sleep(self.args.poll_interval)
+            finally:
+                self.session.post(f"{self.args.url}/unregisterJob/", json={"uuid": uuid}, timeout=self.args.timeout)
+            record["total"] = time.monotonic() - started
+            record["chunks"] = cursor
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Job of user {self.index} failed: {e}", file=sys.stderr)
+        return record
+
+
+def free_port() -> int:
+    """
+    Finds a free local TCP port.
+
+    Returns:
+        int: The port.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn_service(env: List[str], startup_timeout: float) -> Tuple[subprocess.Popen, str]:
+    """
+    Starts the service from ./src with the fake backend on a free port and waits until it is ready.
+
+    Args:
+        env (List[str]): Extra environment variables as KEY=VALUE, e.g. FAKE_TOKEN_SECONDS=0.01.
+        startup_timeout (float): Seconds to wait for /ready.
+
+    Returns:
+        Tuple[subprocess.Popen, str]: The server process and its base URL.
+
+    Raises:
+        RuntimeError: If the service exits or is not ready in time.
+    """
+    port = free_port()
+    environment = dict(os.environ, BACKEND="fake", WARMUP_TOKENS="0")
+    environment.update(item.split("=", 1) for item in env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"),
+        env=environment
+    )
+    url = f"http://127.0.0.1:{port}"
+    started = time.monotonic()
+    while time.monotonic() - started < startup_timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"The service exited with code {process.returncode}.")
+        try:
+            if requests.get(f"{url}/ready", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The service did not become ready in time.")
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Runs the simulated users and summarizes their jobs.
+
+    Args:
+        args (argparse.Namespace): The benchmark options.
+
+    Returns:
+        Dict[str, Any]: The job counts by outcome, the wall time, the throughput in jobs and
+            chunks per second, and summaries of the submit, TTFT and total latencies of the
+            finished jobs.
+    """
+    counter = {"started": 0}
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + args.duration if args.duration else float("inf")
+    users = [SimulatedUser(index, args, counter, lock, deadline) for index in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    wall = time.monotonic() - started
+
+    records = [record for user in users for record in user.results]
+    finished = [record for record in records if record["outcome"] == "finished"]
+    outcomes: Dict[str, int] = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    chunks = sum(record["chunks"] for record in finished)
+    return {
+        "users": args.users,
+        "jobs": len(records),
+        "outcomes": outcomes,
+        "wall_seconds": wall,
+        "jobs_per_second": len(finished) / wall if wall else 0.0,
+        "chunks_per_second": chunks / wall if wall else 0.0,
+        "submit_seconds": summarize([record["submit"] for record in records if record["submit"] is not None]),
+        "ttft_seconds": summarize([record["ttft"] for record in finished if record["ttft"] is not None]),
+        "latency_seconds": summarize([record["total"] for record in finished])
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """
+    Prints a benchmark report as a table.
+
+    Args:
+        report (Dict[str, Any]): The result of run_benchmark.
+    """
+    outcomes = ", ".join(f"{name} {count}" for name, count in sorted(report["outcomes"].items()))
+    print(f"{report['jobs']} jobs from {report['users']} users in {report['wall_seconds']:.2f}s ({outcomes})")
+    print(f"Throughput: {report['jobs_per_second']:.2f} jobs/s, {report['chunks_per_second']:.1f} chunks/s")
+    print(f"{'seconds':<10}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name in ("submit", "ttft", "latency"):
+        values = report[f"{name}_seconds"]
+        cells = "".join(f"{values[key]:>10.3f}" if values[key] is not None else f"{'-':>10}"
+                        for key in ("mean", "p50", "p95", "p99"))
+        print(f"{name:<10}{cells}")
+
+
+def main() -> int:
+    """
+    Parses the options, runs the benchmark and checks the latency limits.
+
+    Returns:
+        int: The exit code: 1 if a limit is exceeded or no job finished, else 0.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:80", help="Base URL of a running service.")
+    parser.add_argument("--spawn", action="store_true", help="Start the service with the fake backend.")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Environment of the spawned service, e.g. FAKE_TOKEN_SECONDS=0.01 or WORKERS=4.")
+    parser.add_argument("--users", type=int, default=8, help="Number of concurrent users.")
+    parser.add_argument("--requests", type=int, default=100, help="Total number of jobs; 0 runs for --duration.")
+    parser.add_argument("--duration", type=float, default=0, help="Seconds after which no job is started; 0 for no limit.")
+    parser.add_argument("--prompt-words", type=int, default=32, help="Words in each question.")
+    parser.add_argument("--max-tokens", type=int, default=0, help="max_tokens of each job; 0 leaves it unset.")
+    parser.add_argument("--model", default="", help="Model to request; empty for the default model.")
+    parser.add_argument("--priority", choices=("interactive", "batch"), default="interactive")
+    parser.add_argument("--poll-interval", type=float, default=0.02, help="Seconds between polls of a job.")
+    parser.add_argument("--max-backoff", type=float, default=1.0, help="Longest wait after a 429 response.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds after which a job is abandoned.")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="Seconds to wait for a spawned service.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--max-p95-latency", type=float, default=0, help="Fail if the p95 latency exceeds this.")
+    parser.add_argument("--max-p95-ttft", type=float, default=0, help="Fail if the p95 TTFT exceeds this.")
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("--requests 0 needs a --duration")
+
+    process = None
+    if args.spawn:
+        process, args.url = spawn_service(args.env, args.startup_timeout)
+    try:
+        report = run_benchmark(args)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    failures = []
+    if not report["outcomes"].get("finished"):
+        failures.append("no job finished")
+    p95_latency = report["latency_seconds"]["p95"]
+    if args.max_p95_latency and p95_latency is not None and p95_latency > args.max_p95_latency:
+        failures.append(f"p95 latency {p95_latency:.3f}s exceeds {args.max_p95_latency}s")
+    p95_ttft = report["ttft_seconds"]["p95"]
+    if args.max_p95_ttft and p95_ttft is not None and p95_ttft > args.max_p95_ttft:
+        failures.append(f"p95 TTFT {p95_ttft:.3f}s exceeds {args.max_p95_ttft}s")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,41 +1,159 @@
 import os
+import math
+import json
+import asyncio
 import threading
 import queue
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Any, List
+from typing import Any, AsyncIterator, Callable, List, Literal, Optional, Tuple
 
-from processor import MainProcessor
-from jobtools import ChatJob, JobRegister
+from processor import PARALLEL_JOBS
+from registry import ModelEntry, ModelRegistry
+from cache import ResponseCache, SemanticCache, lookup_cache
+from embedding import make_embedder
+from context import count_messages
+from jobtools import ChatJob, JobRegister, JobReaper
+from scheduler import FairScheduler
+from jobstore import JOB_STORE, JobStore, StoreJobRegister, StoreRegistry, StoreSessionStore
+from sessions import SESSION_MAX_CHARS, Session, SessionStore, trim
+import metrics
 
 # Fetch the supertoken from environment variables
 supertoken = os.getenv('SUPERTOKEN', default="PLEASE_CHANGE_THIS_PLEASE")
 
-# Initialize job registration and threading components
-jobReg = JobRegister()
-taskLock = threading.Lock()
-taskQueue = queue.Queue(maxsize=1000)
+# The models the service can serve
+models = ModelRegistry.from_env()
+DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'default' if 'default' in models else next(iter(models), ''))
 
-# Start the main processor thread
-thread = MainProcessor(taskLock, taskQueue, jobReg)
-thread.start()
+if JOB_STORE:
+    # Jobs and queues live in a database shared by all API worker processes (uvicorn --workers),
+    # and a separate inference process (inference.py) runs the models and answers from the caches
+    store = JobStore(JOB_STORE)
+    jobReg = StoreJobRegister(store)
+    registry = StoreRegistry(store, models, DEFAULT_MODEL)
+    sessions = StoreSessionStore(store)
+    responseCache = semanticCache = embedder = None
+else:
+    store = None
+    jobReg = JobRegister()
+    sessions = SessionStore()
+
+    # Cache of completions of deterministic requests (temperature 0 or fixed seed) and cache
+    # answering single-turn questions similar to ones answered before
+    responseCache = ResponseCache.from_env()
+    semanticCache = SemanticCache.from_env()
+    embedder = make_embedder() if semanticCache is not None else None
+
+    # All but the default model are loaded on first use, and idle models are unloaded
+    # when loading another would exceed MODEL_RAM_BUDGET bytes
+    registry = ModelRegistry(
+        models,
+        default=DEFAULT_MODEL,
+        budget_bytes=int(os.getenv('MODEL_RAM_BUDGET', '0')),
+        make_queue=FairScheduler.from_env,
+        taskLock=threading.Lock(),
+        jobReg=jobReg,
+        responseCache=responseCache,
+        semanticCache=semanticCache
+    )
+
+    # Load the default model and start its inference worker threads in the background,
+    # so the server answers health checks and queues jobs while the model is loading
+    registry.load()
+
+reaper = JobReaper(jobReg)
+reaper.start()
+sessionReaper = JobReaper(sessions, label="session")
+sessionReaper.start()
 
 # Initialize FastAPI app
 app = FastAPI()
 
+# Job states after which no further chunks are produced
+FINAL_STATUSES = ("finished", "failed", "cancelled", "expired")
+# Seconds between keep-alive comments on an idle event stream
+STREAM_KEEPALIVE = float(os.getenv('STREAM_KEEPALIVE', '15'))
+# Seconds after which chat jobs without their own deadline expire; 0 disables the default
+DEFAULT_DEADLINE = float(os.getenv('DEFAULT_DEADLINE', '0'))
+# Retry-After sent with 429 responses as long as no throughput has been measured
+RETRY_AFTER = int(os.getenv('RETRY_AFTER', '10'))
+
 
 class Chat(BaseModel):
     sysprompt: str
     messages: List[str]
+    client_id: Optional[str] = None
+    priority: Literal["interactive", "batch"] = "interactive"
+    model: Optional[str] = None
+    temperature: Optional[float] = None
+    seed: Optional[int] = None
+    max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    deadline: Optional[float] = None
 
 
 class InfoRequest(BaseModel):
     uuid: str
 
 
+class CompletionRequest(BaseModel):
+    uuid: str
+    since: Optional[int] = None
+
+
 class EmbedRequest(BaseModel):
     text: str
 
+
+class TokenizeRequest(BaseModel):
+    text: Optional[str] = None
+    sysprompt: Optional[str] = None
+    messages: Optional[List[str]] = None
+    model: Optional[str] = None
+    max_tokens: Optional[int] = None
+
+
+class SessionCreate(BaseModel):
+    sysprompt: str
+    client_id: Optional[str] = None
+    model: Optional[str] = None
+
+
+class SessionMessage(BaseModel):
+    session_id: str
+    message: str
+    priority: Literal["interactive", "batch"] = "interactive"
+    temperature: Optional[float] = None
+    seed: Optional[int] = None
+    max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    deadline: Optional[float] = None
+
+
+class SessionRequest(BaseModel):
+    session_id: str
+    since: Optional[int] = None
+
+
+async def offload(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs a call on the job register, queues or sessions. With a job store these are SQLite
+    queries that may wait for the write lock held by another process, so they run off the event loop.
+
+    Args:
+        func (Callable[..., Any]): The function to call.
+        *args (Any): Its arguments.
+
+    Returns:
+        Any: The result of the call.
+    """
+    if store is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
 @app.post("/getStatus/")
 async def get_status(info: InfoRequest) -> Any:
     """
@@ -46,25 +164,72 @@ async def get_status(info: InfoRequest) -> Any:
 
     Returns:
         Any: The status of the job.
+
+    Raises:
+        HTTPException: If the job does not exist or was already removed.
+    """
+    status = await offload(read_status, info.uuid)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+
+def read_status(uuid: str) -> Optional[dict]:
+    """
+    Reads the status of a job and the length of the queue.
+
+    Args:
+        uuid (str): The UUID of the job.
+
+    Returns:
+        Optional[dict]: The response of the /getStatus/ endpoint, or None if the job is not registered.
     """
-    return {"status":jobReg.get_job(info.uuid).get_status(),"queue_size":taskQueue.qsize()}
+    job = jobReg.get_job(uuid)
+    if job is None:
+        return None
+    return {"status":job.get_status(),"queue_size":registry.qsize()}
 
 
 @app.post("/getCompletion/")
-async def get_completion(info: InfoRequest) -> Any:
+async def get_completion(info: CompletionRequest) -> Any:
     """
     Get the completion or embedding and status of a job based on its UUID.
 
+    If a 'since' cursor is given, only the text produced after that cursor is returned,
+    together with the cursor to use on the next call.
+
     Args:
-        info (InfoRequest): The request containing the UUID of the job.
+        info (CompletionRequest): The request containing the UUID of the job and an optional cursor.
 
     Returns:
         dict: A dictionary containing the job's completion/embedding and status.
     """
+    return await offload(read_completion, info)
+
+
+def read_completion(info: CompletionRequest) -> dict:
+    """
+    Reads the completion and status of a job.
+
+    Args:
+        info (CompletionRequest): The request containing the UUID of the job and an optional cursor.
+
+    Returns:
+        dict: The response of the /getCompletion/ endpoint.
+    """
     job = jobReg.get_job(info.uuid)
     if job:
         # Check if it's a ChatJob and return the completion
         if isinstance(job, ChatJob):
+            if info.since is not None:
+                # Read the status first so a final status never precedes missing text
+                status = job.get_status()
+                completion, cursor = job.get_completion_since(info.since)
+                return {
+                    "completion": completion,
+                    "cursor": cursor,
+                    "status": status
+                }
             return {
                 "completion": job.get_completion(),
                 "status": job.get_status()
@@ -84,6 +249,83 @@ async def get_completion(info: InfoRequest) -> Any:
         }
 
 
+def format_event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    """
+    Formats a single Server-Sent Event.
+
+    Args:
+        event (str): The event name.
+        data (dict): The payload, sent as JSON.
+        event_id (Optional[int]): The event id, used by clients to resume via Last-Event-ID.
+
+    Returns:
+        str: The encoded event.
+    """
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def job_events(job: ChatJob, cursor: int = 0) -> AsyncIterator[str]:
+    """
+    Yields the chunks and status changes of a chat job as Server-Sent Events until the job ends.
+
+    Args:
+        job (ChatJob): The job to stream.
+        cursor (int): The number of chunks the client has already received.
+
+    Yields:
+        str: Encoded events.
+    """
+    events = job.subscribe(asyncio.get_running_loop(), cursor)
+    try:
+        while True:
+            try:
+                event, payload = await asyncio.wait_for(events.get(), timeout=STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                if await offload(jobReg.get_job, job.get_uuid()) is None:
+                    # The job was unregistered while waiting in the queue and will never finish
+                    break
+                yield ": keep-alive\n\n"
+                continue
+
+            if event == "chunk":
+                chunk, cursor = payload
+                yield format_event("chunk", {"chunk": chunk, "cursor": cursor}, event_id=cursor)
+            elif event == "status":
+                yield format_event("status", {"status": payload})
+                if payload in FINAL_STATUSES:
+                    break
+    finally:
+        job.unsubscribe(events)
+
+
+@app.get("/streamCompletion/{uuid}")
+async def stream_completion(uuid: str, last_event_id: Optional[int] = Header(default=None)) -> StreamingResponse:
+    """
+    Stream the completion of a chat job as Server-Sent Events while it is being generated.
+
+    Emits 'chunk' events carrying new text and 'status' events carrying status changes;
+    the stream closes once the job is finished or failed. Reconnecting clients resume after
+    the chunk given in the Last-Event-ID header.
+
+    Args:
+        uuid (str): The UUID of the job.
+        last_event_id (Optional[int]): The cursor of the last chunk the client received.
+
+    Returns:
+        StreamingResponse: A text/event-stream response.
+    """
+    job = await offload(jobReg.get_job, uuid)
+    if not isinstance(job, ChatJob):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return StreamingResponse(
+        job_events(job, last_event_id or 0),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.post("/unregisterJob/")
 async def unregister_job(info: InfoRequest) -> Any:
     """
@@ -96,30 +338,659 @@ async def unregister_job(info: InfoRequest) -> Any:
         str: A confirmation message.
     """
 
-    jobReg.delete_job(info.uuid)
+    await offload(jobReg.delete_job, info.uuid)
     return "OK"
 
 
+@app.post("/cancelJob/")
+async def cancel_job(info: InfoRequest) -> Any:
+    """
+    Cancel a chat job. A queued job is removed from the queue, a running job stops
+    generating at its next chunk.
+
+    Args:
+        info (InfoRequest): The request containing the UUID of the job.
+
+    Returns:
+        dict: The status of the job after the cancellation.
+    """
+    job = await offload(jobReg.get_job, info.uuid)
+    if not isinstance(job, ChatJob):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    await offload(cancel, job)
+    return {"status": await offload(job.get_status)}
+
+
+def cancel(job: ChatJob) -> None:
+    """
+    Cancels a chat job, removing it from the queue if it has not started.
+
+    Args:
+        job (ChatJob): The job to cancel.
+    """
+    job.cancel()
+    if registry.remove(job.get_uuid()):
+        job.set_status("cancelled")
+        count_outcome("cancelled")
+
+
+def count_outcome(outcome: str) -> None:
+    """
+    Counts a job outcome in llm_jobs_total; with a job store in the store, so that the outcomes
+    of all API worker processes are reported.
+
+    Args:
+        outcome (str): How the job ended, e.g. "cancelled".
+    """
+    if store is not None:
+        store.count_outcomes({outcome: 1})
+    else:
+        metrics.JOBS.inc(outcome=outcome)
+
+
+def reject(reason: str, entry: ModelEntry) -> None:
+    """
+    Refuses a request because the service is at capacity.
+
+    Args:
+        reason (str): The detail sent to the client.
+        entry (ModelEntry): The model the request asked for.
+
+    Raises:
+        HTTPException: Always, with status 429 and a Retry-After header estimating when a slot frees up.
+    """
+    count_outcome("rejected")
+    average = entry.tracker.get_average_job_seconds()
+    retry_after = max(1, math.ceil(average / PARALLEL_JOBS)) if average is not None else RETRY_AFTER
+    raise HTTPException(status_code=429, detail=reason, headers={"Retry-After": str(retry_after)})
+
+
+def prompt_cost(job: ChatJob, entry: ModelEntry) -> int:
+    """
+    Counts the prompt tokens of a chat job for shortest-prompt-first scheduling.
+
+    Args:
+        job (ChatJob): The chat job.
+        entry (ModelEntry): The model the job asked for.
+
+    Returns:
+        int: The token count, or 0 if the scheduler does not use it.
+    """
+    if not entry.queue.shortest_first:
+        return 0
+    worker = first_worker(entry)
+    if worker is None:
+        # No tokenizer while the model is not loaded; roughly four characters per token
+        return len(job.get_sys_prompt() + "".join(job.get_messages())) // 4
+    return sum(count_messages(job.get_chat_messages(), worker.counter))
+
+
+def first_worker(entry: ModelEntry) -> Any:
+    """
+    Finds a worker of a model, whose tokenizer and token counter serve requests.
+
+    Args:
+        entry (ModelEntry): The model.
+
+    Returns:
+        Any: The first worker, or None while the model is not loaded or runs in another process.
+    """
+    workers = entry.loader.workers if getattr(entry, "loader", None) is not None else []
+    return workers[0] if workers else None
+
+
+def finish_cached(job: ChatJob, completion: str, entry: ModelEntry) -> Any:
+    """
+    Registers a chat job that is answered from a cache as finished.
+
+    Args:
+        job (ChatJob): The new job.
+        completion (str): The cached completion.
+        entry (ModelEntry): The model the request asked for.
+
+    Returns:
+        dict: The response of the /chat/ endpoint.
+    """
+    job.append_chunk(completion)
+    job.set_status("finished")
+    if not jobReg.add_job(job):
+        reject("Too many jobs registered.", entry)
+    count_outcome("cached")
+    return {
+        "uuid": job.get_uuid(),
+        "status": job.get_status(),
+        "eta": 0.0,
+        "tokens_per_second": entry.tracker.get_tokens_per_second(),
+        "cached": True
+        }
+
+
 @app.post("/chat/")
-async def chat(item: Chat) -> Any:
+async def chat(item: Chat, request: Request) -> Any:
     """
     Process a chat request and add it to the job queue.
 
+    Requests are admitted without blocking; if the queue or the job register is full the
+    request is refused with 429 and a Retry-After header. The job is scheduled fairly among
+    the jobs of other clients, identified by client_id or else the client address. The job is
+    generated by the requested model, or the default model, which is loaded first if necessary.
+
+    Generation ends after max_tokens tokens or at one of the stop strings. A job whose deadline
+    (seconds after submission, DEFAULT_DEADLINE if not given) passes is dropped before its prompt
+    is processed, or stopped during generation, and ends with status "expired".
+
+    Deterministic requests (temperature 0 or a fixed seed) are answered from the response cache
+    if an identical request has been completed before. Single-turn questions are embedded and
+    answered from the semantic cache if a similar enough question has been answered before.
+    A job answered from a cache is finished immediately and never queued. With a job store the
+    inference process looks the caches up when it takes the job from the store.
+
     Args:
-        item (Chat): The chat request containing the system prompt and messages.
+        item (Chat): The chat request containing the system prompt, messages, client id, priority,
+                     model, sampling parameters, generation limits and deadline.
+        request (Request): The HTTP request, used to identify anonymous clients.
 
     Returns:
-        str: The UUID of the created job.
+        dict: The UUID and status of the created job, the estimated seconds until it is
+              finished (None until throughput has been measured) and whether it was cached.
+
+    Raises:
+        HTTPException: 404 if the model is unknown, 429 if the service is at capacity.
     """
-    job = ChatJob(item.sysprompt, item.messages)
-    jobReg.add_job(job)
     try:
-        taskQueue.put(job.get_uuid())
+        entry = await offload(registry.get_entry, item.model)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {item.model}")
+
+    job = ChatJob(item.sysprompt, item.messages, make_params(item), timeout=item.deadline or DEFAULT_DEADLINE or None)
+    client_id = item.client_id or (request.client.host if request.client else "")
+    return await submit(job, entry, client_id, item.priority)
+
+
+def make_params(item: Any) -> dict:
+    """
+    Collects the sampling parameters and generation limits a request sets.
+
+    Args:
+        item (Any): The Chat or SessionMessage request.
+
+    Returns:
+        dict: The parameters of the chat job.
+    """
+    return {name: value for name, value in (("temperature", item.temperature), ("seed", item.seed),
+                                            ("max_tokens", item.max_tokens), ("stop", item.stop))
+            if value is not None}
+
+
+async def submit(job: ChatJob, entry: ModelEntry, client_id: str, priority: str) -> dict:
+    """
+    Answers a new chat job from the caches or registers and queues it.
+
+    Args:
+        job (ChatJob): The new job.
+        entry (ModelEntry): The model the job asked for.
+        client_id (str): The client the job is scheduled for.
+        priority (str): The priority class of the job.
+
+    Returns:
+        dict: The response of the /chat/ endpoint.
+
+    Raises:
+        HTTPException: 429 if the service is at capacity.
+    """
+    if responseCache is not None or semanticCache is not None:
+        # Embedding the question for the semantic cache blocks, so it runs off the event loop
+        completion = await asyncio.get_running_loop().run_in_executor(
+            None, lookup_cache, job, os.path.basename(entry.handler.filename), responseCache, semanticCache, embedder
+        )
+        if completion is not None:
+            return await offload(finish_cached, job, completion, entry)
+
+    cost = 0
+    if entry.queue.shortest_first:
+        # Tokenizing blocks, and is an HTTP request for remote models, so it runs off the event loop
+        cost = await asyncio.get_running_loop().run_in_executor(None, prompt_cost, job, entry)
+    return await offload(enqueue, job, entry, client_id, priority, cost)
+
+
+def enqueue(job: ChatJob, entry: ModelEntry, client_id: str, priority: str, cost: int) -> dict:
+    """
+    Registers and queues a new chat job.
+
+    Args:
+        job (ChatJob): The new job.
+        entry (ModelEntry): The model the job asked for.
+        client_id (str): The client the job is scheduled for.
+        priority (str): The priority class of the job.
+        cost (int): The prompt tokens of the job, for shortest-prompt-first scheduling.
+
+    Returns:
+        dict: The response of the /chat/ endpoint.
+
+    Raises:
+        HTTPException: 429 if the service is at capacity.
+    """
+    if not jobReg.add_job(job):
+        reject("Too many jobs registered.", entry)
+
+    jobs_ahead = entry.queue.ahead(priority)
+    try:
+        registry.submit(entry.name, job.get_uuid(), client_id, priority, cost)
     except queue.Full:
-        job.set_status("failed")
-    
+        jobReg.delete_job(job.get_uuid())
+        reject("Queue is full.", entry)
+
     return {
         "uuid": job.get_uuid(),
-        "status": job.get_status()
+        "status": job.get_status(),
+        "eta": entry.tracker.estimate_wait(jobs_ahead, PARALLEL_JOBS),
+        "tokens_per_second": entry.tracker.get_tokens_per_second(),
+        "cached": False
         }
 
+
+def settle(session: Session) -> bool:
+    """
+    Closes the pending turn of a session once its job has ended: the reply of a finished job
+    is added to the history, otherwise the unanswered message is dropped so that the client
+    can send it again. The job is then unregistered, as the session holds its reply.
+
+    Args:
+        session (Session): The session.
+
+    Returns:
+        bool: False if the job is still queued or running.
+    """
+    uuid = session.pending
+    if uuid is None:
+        return True
+    job = jobReg.get_job(uuid)
+    status = job.get_status() if job is not None else "expired"
+    if status not in FINAL_STATUSES:
+        return False
+    messages = session.get_messages()
+    if status == "finished":
+        messages.append(job.get_completion())
+    else:
+        messages.pop()
+    if sessions.update(session.session_id, uuid, messages, None):
+        jobReg.delete_job(uuid)
+    return True
+
+
+@app.post("/createSession/")
+async def create_session(item: SessionCreate, request: Request) -> Any:
+    """
+    Create a conversation kept by the server, so that each turn sends only the new message.
+
+    The history is stored compressed; once it exceeds SESSION_MAX_CHARS characters the oldest
+    exchanges are dropped. Sessions expire SESSION_TTL seconds after their last turn, and the
+    least recently used idle sessions are evicted when MAX_SESSIONS or SESSIONS_MAX_BYTES is reached.
+
+    Args:
+        item (SessionCreate): The system prompt, client id and model of the conversation.
+        request (Request): The HTTP request, used to identify anonymous clients.
+
+    Returns:
+        dict: The id of the session.
+
+    Raises:
+        HTTPException: 404 if the model is unknown, 429 if no session can be evicted to make room.
+    """
+    if item.model is not None and item.model not in models:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {item.model}")
+    client_id = item.client_id or (request.client.host if request.client else "")
+    session = await offload(sessions.create, item.sysprompt, item.model, client_id)
+    if session is None:
+        raise HTTPException(status_code=429, detail="Too many sessions.", headers={"Retry-After": str(RETRY_AFTER)})
+    return {"session_id": session.session_id}
+
+
+@app.post("/sessionChat/")
+async def session_chat(item: SessionMessage) -> Any:
+    """
+    Send the next user message of a session. The message is answered like a /chat/ request
+    with the session's system prompt and history; the job it creates is polled or streamed
+    by its UUID or read with /getSessionReply/. Its reply is added to the history when read
+    or when the next message is sent. As the history is resent unchanged, the prefix cache of
+    the llama backend keeps the tokens of earlier turns evaluated.
+
+    Args:
+        item (SessionMessage): The session id, the message, the priority, sampling parameters,
+                               generation limits and deadline.
+
+    Returns:
+        dict: The session id and the response of the /chat/ endpoint for the job of the turn.
+
+    Raises:
+        HTTPException: 404 if the session or its model is unknown, 409 while the previous turn
+                       is running, 429 if the service is at capacity.
+    """
+    session, entry, job, history = await offload(open_turn, item)
+    try:
+        response = await submit(job, entry, session.client_id, item.priority)
+    except HTTPException:
+        await offload(sessions.update, session.session_id, job.get_uuid(), history, None)
+        raise
+    return {"session_id": session.session_id, **response}
+
+
+def open_turn(item: SessionMessage) -> Tuple[Session, ModelEntry, ChatJob, List[str]]:
+    """
+    Closes the previous turn of a session and opens a turn for the new message.
+
+    Args:
+        item (SessionMessage): The request of the /sessionChat/ endpoint.
+
+    Returns:
+        Tuple[Session, ModelEntry, ChatJob, List[str]]: The session, its model, the job of the new
+            turn and the history before it, to restore if the job is refused.
+
+    Raises:
+        HTTPException: 404 if the session or its model is unknown, 409 while the previous turn is running.
+    """
+    session = sessions.get(item.session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    try:
+        entry = registry.get_entry(session.model)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {session.model}")
+    if not settle(session):
+        raise HTTPException(status_code=409, detail="The previous turn is still running.")
+
+    session = sessions.get(item.session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    history = session.get_messages()
+    messages = trim(history + [item.message], SESSION_MAX_CHARS)
+    job = ChatJob(session.sys_prompt, messages, make_params(item), timeout=item.deadline or DEFAULT_DEADLINE or None)
+    if not sessions.update(session.session_id, None, messages, job.get_uuid(), new_turn=True):
+        raise HTTPException(status_code=409, detail="The previous turn is still running.")
+    return session, entry, job, history
+
+
+@app.post("/getSessionReply/")
+async def get_session_reply(info: SessionRequest) -> Any:
+    """
+    Get the reply to the last message of a session, like /getCompletion/ for its job. Once the
+    job has ended the turn is closed; the status is "idle" if no turn is open.
+
+    Args:
+        info (SessionRequest): The session id and an optional cursor.
+
+    Returns:
+        dict: The reply and status of the turn, and the next cursor if a cursor was given.
+
+    Raises:
+        HTTPException: 404 if the session is unknown.
+    """
+    return await offload(read_session_reply, info)
+
+
+def read_session_reply(info: SessionRequest) -> dict:
+    """
+    Reads the reply to the last message of a session, closing the turn once its job has ended.
+
+    Args:
+        info (SessionRequest): The session id and an optional cursor.
+
+    Returns:
+        dict: The response of the /getSessionReply/ endpoint.
+
+    Raises:
+        HTTPException: 404 if the session is unknown.
+    """
+    session = sessions.get(info.session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    uuid = session.pending
+    job = jobReg.get_job(uuid) if uuid is not None else None
+    if job is None:
+        settle(session)
+        response = {"completion": "", "status": "idle" if uuid is None else "expired"}
+        return {**response, "cursor": info.since} if info.since is not None else response
+
+    status = job.get_status()
+    if info.since is not None:
+        completion, cursor = job.get_completion_since(info.since)
+        response = {"completion": completion, "cursor": cursor, "status": status}
+    else:
+        response = {"completion": job.get_completion(), "status": status}
+    if status in FINAL_STATUSES:
+        settle(session)
+    return response
+
+
+@app.post("/getSession/")
+async def get_session(info: SessionRequest) -> Any:
+    """
+    Get the system prompt, model, history and open turn of a session.
+
+    Args:
+        info (SessionRequest): The session id.
+
+    Returns:
+        dict: The session.
+
+    Raises:
+        HTTPException: 404 if the session is unknown.
+    """
+    return await offload(read_session, info)
+
+
+def read_session(info: SessionRequest) -> dict:
+    """
+    Reads a session, closing its open turn if the job has ended.
+
+    Args:
+        info (SessionRequest): The session id.
+
+    Returns:
+        dict: The response of the /getSession/ endpoint.
+
+    Raises:
+        HTTPException: 404 if the session is unknown.
+    """
+    session = sessions.get(info.session_id)
+    if session is not None and session.pending is not None and settle(session):
+        session = sessions.get(info.session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {
+        "session_id": session.session_id,
+        "sysprompt": session.sys_prompt,
+        "model": session.model,
+        "messages": session.get_messages(),
+        "turns": session.turns,
+        "pending": session.pending,
+        "updated_at": session.updated_at
+        }
+
+
+@app.post("/deleteSession/")
+async def delete_session(info: SessionRequest) -> Any:
+    """
+    Delete a session, cancelling the job of its open turn.
+
+    Args:
+        info (SessionRequest): The session id.
+
+    Returns:
+        str: A confirmation message.
+    """
+    await offload(remove_session, info.session_id)
+    return "OK"
+
+
+def remove_session(session_id: str) -> None:
+    """
+    Deletes a session and cancels and unregisters the job of its open turn.
+
+    Args:
+        session_id (str): The id of the session.
+    """
+    session = sessions.get(session_id)
+    uuid = session.pending if session is not None else None
+    if session is not None and sessions.delete(session.session_id) and uuid is not None:
+        job = jobReg.get_job(uuid)
+        if isinstance(job, ChatJob):
+            cancel(job)
+            jobReg.delete_job(uuid)
+
+
+@app.get("/getSessionStats/")
+async def get_session_stats() -> Any:
+    """
+    Get the number of sessions, the bytes they retain and the eviction counter.
+
+    Returns:
+        dict: The statistics of the session store.
+    """
+    return await offload(sessions.get_stats)
+
+
+@app.post("/tokenize/")
+async def tokenize(item: TokenizeRequest) -> Any:
+    """
+    Count tokens with the tokenizer of a model: of a text, or of a conversation, which is then
+    checked against the prompt budget its job would get. Conversations over the budget have
+    their oldest exchanges dropped by the worker. Counts of messages are cached, so resending
+    a growing conversation only tokenizes the new messages.
+
+    Counts are estimated at four characters per token while the model is not loaded, or
+    when a job store moves the models into another process.
+
+    Args:
+        item (TokenizeRequest): The text, or the system prompt and messages, the model and the
+                                max_tokens the job would set.
+
+    Returns:
+        dict: The total tokens, the tokens of each message including the chat template overhead,
+              the prompt budget and whether the conversation fits it, and whether the counts are exact.
+
+    Raises:
+        HTTPException: 404 if the model is unknown.
+    """
+    try:
+        entry = await offload(registry.get_entry, item.model)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {item.model}")
+
+    worker = first_worker(entry)
+    loop = asyncio.get_running_loop()
+    if item.text is not None:
+        if worker is None:
+            return {"model": entry.name, "tokens": len(item.text) // 4, "exact": False}
+        # Tokenizing long texts blocks, so it runs off the event loop
+        tokens = await loop.run_in_executor(None, worker.counter.count, item.text)
+        return {"model": entry.name, "tokens": tokens, "exact": True}
+
+    messages = ChatJob(item.sysprompt or "", item.messages or []).get_chat_messages()
+    if worker is None:
+        counts = [len(message["content"]) // 4 for message in messages]
+        budget = None
+    else:
+        counts = await loop.run_in_executor(None, count_messages, messages, worker.counter)
+        budget = worker.get_prompt_budget(item.max_tokens)
+    return {
+        "model": entry.name,
+        "tokens": sum(counts),
+        "counts": counts,
+        "budget": budget,
+        "fits": budget is None or sum(counts) <= budget,
+        "exact": worker is not None
+        }
+
+
+@app.get("/getJobStats/")
+async def get_job_stats() -> Any:
+    """
+    Get the number of registered jobs, the bytes they retain and the eviction counters.
+
+    Returns:
+        dict: The statistics of the job register.
+    """
+    return await offload(jobReg.get_stats)
+
+
+@app.get("/getCacheStats/")
+async def get_cache_stats() -> Any:
+    """
+    Get the size and hit counters of the response and semantic caches.
+
+    Returns:
+        dict: The statistics of the response cache and the semantic cache, each {"enabled": False}
+              if disabled.
+    """
+    return {
+        "response": {"enabled": True, **responseCache.get_stats()} if responseCache else {"enabled": False},
+        "semantic": {"enabled": True, **semanticCache.get_stats()} if semanticCache else {"enabled": False}
+        }
+
+
+@app.get("/health")
+async def health() -> Any:
+    """
+    Liveness probe. Fails only if loading the default model failed, as the process then needs a restart.
+
+    Returns:
+        JSONResponse: The state of the models, with status 503 if loading the default model failed.
+    """
+    failed = (await offload(registry.get_entry)).get_state() == "failed"
+    return JSONResponse(await offload(registry.get_status), status_code=503 if failed else 200)
+
+
+@app.get("/ready")
+async def ready() -> Any:
+    """
+    Readiness probe. Succeeds once the default model is loaded and warmed up and its workers are running.
+
+    Returns:
+        JSONResponse: The state of the models, with status 503 until the default model is ready.
+    """
+    status = await offload(registry.get_status)
+    return JSONResponse(status, status_code=200 if (await offload(registry.get_entry)).is_ready() else 503)
+
+
+@app.get("/models/")
+async def list_models() -> Any:
+    """
+    Get the declared models with their loading state, size, queue length and load timings,
+    and the memory budget.
+
+    Returns:
+        dict: The state of the model registry.
+    """
+    return await offload(registry.get_status)
+
+
+@app.get("/metrics")
+async def get_metrics() -> Any:
+    """
+    Prometheus scrape endpoint: queue wait, prefill, time to first token and decode speed of the
+    chat jobs, job outcomes, and queue depth and memory use sampled at scrape time.
+
+    With a job store the metrics are those the inference process published last, and the job
+    outcomes of all processes.
+
+    Returns:
+        PlainTextResponse: The metrics in the Prometheus text format.
+    """
+    if store is not None:
+        return PlainTextResponse(await offload(render_store_metrics), media_type="text/plain; version=0.0.4")
+    metrics.sample(registry, jobReg)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def render_store_metrics() -> str:
+    """
+    Renders the metrics the inference process published together with the job outcomes counted
+    in the store.
+
+    Returns:
+        str: The metrics in the Prometheus text format.
+    """
+    metrics.JOBS.restore({(outcome,): count for outcome, count in store.get_outcomes().items()})
+    return (store.get_meta("metrics") or "") + metrics.JOBS.render() + "\n"
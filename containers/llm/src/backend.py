@@ -0,0 +1,271 @@
+import os
+import time
+import random
+import hashlib
+from typing import Any, Dict, Iterator, List, Optional, Protocol, Union
+
+from model import ModelHandler
+from remote import RemoteModelHandler
+
+# The backend of models that do not name one: "llama" runs GGUF files with llama.cpp,
+# "remote" forwards jobs to OpenAI-compatible runtime replicas such as containers/llm_runtime,
+# "fake" generates deterministic text with simulated delays and needs no model file
+BACKEND = os.getenv('BACKEND', 'llama')
+
+# Words the fake backend builds its answers from
+FAKE_WORDS = (
+    "the", "model", "answers", "with", "a", "short", "and", "deterministic", "text", "that",
+    "depends", "only", "on", "prompt", "seed", "so", "benchmarks", "can", "compare", "runs",
+)
+
+
+class ChatBackend(Protocol):
+    """
+    The part of the Llama interface the MainProcessor generates with. Backends other than
+    llama.cpp implement it to run behind the same workers, queue and caches.
+    """
+
+    def create_chat_completion(self, messages: List[Dict[str, str]], **kwargs: Any) -> Any:
+        """
+        Generates the answer to a conversation, as one response or, with stream=True, as an iterator
+        of OpenAI-style chunks.
+        """
+        ...
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        """
+        Converts text to tokens.
+        """
+        ...
+
+    def reset(self) -> None:
+        """
+        Forgets the evaluated tokens.
+        """
+        ...
+
+
+class FakeLlama:
+    """
+    A stand-in for Llama that needs no model: it sleeps to simulate prompt processing and decoding
+    and answers with words picked deterministically from the prompt and seed. Used to measure the
+    overhead of the queueing and API code without a GGUF file.
+
+    Attributes:
+        prefill_seconds (float): The fixed delay before the first token.
+        prefill_token_seconds (float): The additional delay per prompt token before the first token.
+        token_seconds (float): The delay per generated token.
+        completion_tokens (int): The number of tokens generated unless max_tokens is smaller.
+    """
+
+    def __init__(self, prefill_seconds: float = 0.0, prefill_token_seconds: float = 0.0,
+                 token_seconds: float = 0.0, completion_tokens: int = 64):
+        """
+        Initializes the FakeLlama with its simulated timings.
+
+        Args:
+            prefill_seconds (float): The fixed delay before the first token.
+            prefill_token_seconds (float): The additional delay per prompt token before the first token.
+            token_seconds (float): The delay per generated token.
+            completion_tokens (int): The default length of an answer in tokens.
+        """
+        self.prefill_seconds = prefill_seconds
+        self.prefill_token_seconds = prefill_token_seconds
+        self.token_seconds = token_seconds
+        self.completion_tokens = completion_tokens
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        """
+        Splits text into one token per word.
+
+        Args:
+            text (bytes): The UTF-8 encoded text.
+            add_bos (bool): Whether to prepend a begin-of-sequence token.
+            special (bool): Ignored; there are no special tokens.
+
+        Returns:
+            List[int]: A token per word, derived from the word's hash.
+        """
+        tokens = [int.from_bytes(hashlib.sha256(word).digest()[:4], "little") for word in text.split()]
+        return [1] + tokens if add_bos else tokens
+
+    def reset(self) -> None:
+        """
+        Does nothing, as no state is kept between generations.
+        """
+
+    def set_cache(self, cache: Any) -> None:
+        """
+        Ignores the prefix cache, as there is no state to save.
+
+        Args:
+            cache (Any): The prefix cache.
+        """
+
+    def close(self) -> None:
+        """
+        Does nothing, as no resources are held.
+        """
+
+    def create_chat_completion(self, messages: List[Dict[str, str]], stream: bool = False,
+                               max_tokens: Optional[int] = None, stop: Union[str, List[str], None] = None,
+                               seed: Optional[int] = None, **kwargs: Any) -> Any:
+        """
+        Answers a conversation after the simulated delays.
+
+        Args:
+            messages (List[Dict[str, str]]): The conversation.
+            stream (bool): Whether to return an iterator of chunks.
+            max_tokens (Optional[int]): The maximum number of tokens to generate.
+            stop (Union[str, List[str], None]): Strings that end the answer before they appear.
+            seed (Optional[int]): Changes the words picked.
+            **kwargs (Any): Further sampling parameters, which are ignored.
+
+        Returns:
+            Any: An iterator of chunks if streaming, else the complete response.
+        """
+        chunks = self.generate(messages, max_tokens, stop, seed)
+        if stream:
+            return chunks
+        content = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks)
+        return {
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+        }
+
+    def generate(self, messages: List[Dict[str, str]], max_tokens: Optional[int],
+                 stop: Union[str, List[str], None], seed: Optional[int]) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the answer word by word in the chunk format of llama-cpp-python.
+
+        Args:
+            messages (List[Dict[str, str]]): The conversation.
+            max_tokens (Optional[int]): The maximum number of tokens to generate.
+            stop (Union[str, List[str], None]): Strings that end the answer before they appear.
+            seed (Optional[int]): Changes the words picked.
+
+        Yields:
+            Dict[str, Any]: The chunks: the role, one per word, and the finish reason.
+        """
+        prompt = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        time.sleep(self.prefill_seconds + self.prefill_token_seconds * len(self.tokenize(prompt.encode("utf-8"))))
+        yield {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]}
+
+        digest = hashlib.sha256(f"{seed}\n{prompt}".encode("utf-8")).digest()
+        rng = random.Random(int.from_bytes(digest[:8], "little"))
+        stops = [stop] if isinstance(stop, str) else [text for text in stop or [] if text]
+        length = self.completion_tokens if max_tokens is None or max_tokens <= 0 else min(max_tokens, self.completion_tokens)
+        text = ""
+        finish_reason = "length"
+        for index in range(length):
+            time.sleep(self.token_seconds)
+            word = ("" if index == 0 else " ") + rng.choice(FAKE_WORDS)
+            found = [position for position in ((text + word).find(text_stop) for text_stop in stops) if position >= 0]
+            if found:
+                # Like llama.cpp, end the answer right before the stop string
+                word = (text + word)[len(text):min(found)]
+                if word:
+                    yield {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+                finish_reason = "stop"
+                break
+            text += word
+            yield {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+        yield {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}
+
+
+class FakeModelHandler:
+    """
+    The counterpart of ModelHandler for the fake backend: there is nothing to download and
+    build() returns a FakeLlama.
+
+    Attributes:
+        filename (str): A name identifying the model in cache keys; no file is read.
+        n_ctx (int): The nominal context size.
+        supports_batching (bool): False, as the FakeLlama has no low-level batch API.
+        prefill_seconds (float): The fixed delay before the first token.
+        prefill_token_seconds (float): The additional delay per prompt token.
+        token_seconds (float): The delay per generated token.
+        completion_tokens (int): The default length of an answer in tokens.
+    """
+
+    supports_batching = False
+
+    def __init__(self, name: str = "fake", n_ctx: Optional[int] = None, prefill_seconds: Optional[float] = None,
+                 prefill_token_seconds: Optional[float] = None, token_seconds: Optional[float] = None,
+                 completion_tokens: Optional[int] = None):
+        """
+        Initializes the FakeModelHandler, falling back to the FAKE_* environment variables.
+
+        Args:
+            name (str): The name of the model.
+            n_ctx (Optional[int]): The nominal context size, overriding N_CTX.
+            prefill_seconds (Optional[float]): Overrides FAKE_PREFILL_SECONDS (default 0.05).
+            prefill_token_seconds (Optional[float]): Overrides FAKE_PREFILL_TOKEN_SECONDS (default 0).
+            token_seconds (Optional[float]): Overrides FAKE_TOKEN_SECONDS (default 0.02).
+            completion_tokens (Optional[int]): Overrides FAKE_COMPLETION_TOKENS (default 64).
+        """
+        self.filename = f"fake-{name}"
+        self.n_ctx = n_ctx or int(os.getenv('N_CTX', '0')) or 4096
+        self.prefill_seconds = prefill_seconds if prefill_seconds is not None else float(os.getenv('FAKE_PREFILL_SECONDS', '0.05'))
+        self.prefill_token_seconds = prefill_token_seconds if prefill_token_seconds is not None else float(os.getenv('FAKE_PREFILL_TOKEN_SECONDS', '0'))
+        self.token_seconds = token_seconds if token_seconds is not None else float(os.getenv('FAKE_TOKEN_SECONDS', '0.02'))
+        self.completion_tokens = completion_tokens if completion_tokens is not None else int(os.getenv('FAKE_COMPLETION_TOKENS', '64'))
+
+    def download_file(self) -> str:
+        """
+        Does nothing, as there is no model file.
+
+        Returns:
+            str: The model name.
+        """
+        return self.filename
+
+    def build(self, n_threads: Optional[int] = None, n_ctx: Optional[int] = None) -> FakeLlama:
+        """
+        Builds a FakeLlama with the configured timings.
+
+        Args:
+            n_threads (Optional[int]): Ignored.
+            n_ctx (Optional[int]): Ignored.
+
+        Returns:
+            FakeLlama: The fake model.
+        """
+        return FakeLlama(self.prefill_seconds, self.prefill_token_seconds, self.token_seconds, self.completion_tokens)
+
+
+# Anything that downloads and builds the model of a worker
+Handler = Union[ModelHandler, RemoteModelHandler, FakeModelHandler]
+
+
+def make_handler(name: str, spec: Dict[str, Any]) -> Handler:
+    """
+    Creates the handler of a declared model for its backend.
+
+    Args:
+        name (str): The name of the model.
+        spec (Dict[str, Any]): The model specification: "backend" (default BACKEND), and "url", "path",
+            "n_ctx", "sha256", "draft", "draft_url" and "draft_tokens" for llama, "urls", "model", "n_ctx"
+            and "api_key" for remote, or "n_ctx", "prefill_seconds", "prefill_token_seconds",
+            "token_seconds" and "completion_tokens" for fake.
+
+    Returns:
+        Handler: The handler.
+
+    Raises:
+        ValueError: If the backend is unknown or a llama model lacks its URL or path, or a remote model its replicas.
+    """
+    backend = spec.get("backend", BACKEND)
+    if backend == "remote":
+        return RemoteModelHandler(name, spec.get("urls"), spec.get("model"), spec.get("n_ctx"), spec.get("api_key"))
+    if backend == "fake":
+        return FakeModelHandler(name, spec.get("n_ctx"), spec.get("prefill_seconds"),
+                                spec.get("prefill_token_seconds"), spec.get("token_seconds"),
+                                spec.get("completion_tokens"))
+    if backend != "llama":
+        raise ValueError(f"Model {name} has an unknown backend: {backend}")
+    if not spec.get("url") or not spec.get("path"):
+        raise ValueError(f"Model {name} needs a url and a path.")
+    return ModelHandler(url=spec.get("url"), filename=spec.get("path"),
+                        n_ctx=spec.get("n_ctx"), sha256=spec.get("sha256", ""), draft=spec.get("draft", ""),
+                        draft_url=spec.get("draft_url", ""), draft_tokens=spec.get("draft_tokens"))
@@ -0,0 +1,508 @@
+import os
+import time
+import codecs
+import queue
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+from jobtools import ChatJob, JobRegister, ThroughputTracker
+from cache import ResponseCache, SemanticCache, cache_completion
+from context import TokenCounter, fit_messages, make_counter, prompt_budget
+from scheduler import SchedulerClosed
+import metrics
+
+# Removes the KV cells of a sequence; renamed in newer llama.cpp releases
+kv_seq_rm = getattr(llama_cpp, "llama_kv_self_seq_rm", None) or llama_cpp.llama_kv_cache_seq_rm
+
+
+class Sequence:
+    """
+    The decoding state of one chat job inside the shared batch.
+
+    Attributes:
+        seq_id (int): The llama.cpp sequence id the job occupies.
+        job (ChatJob): The job the generated text is reported to.
+        prompt (List[int]): Prompt tokens that still have to be prefilled.
+        stop (List[str]): Stop strings ending the generation.
+        n_past (int): The number of tokens of this sequence in the KV cache.
+        last_token (Optional[int]): The most recently sampled token, fed back in the next step.
+        logits_index (int): The batch position whose logits belong to this sequence, or -1.
+        held (str): Generated text withheld because it may be the start of a stop string.
+        n_generated (int): The number of tokens generated so far.
+        max_tokens (Optional[int]): The number of tokens after which the generation ends, if limited.
+        started (float): The monotonic time the sequence was admitted.
+        first_token (float): The monotonic time the first token was sampled; 0 until then.
+        temperature (float): The sampling temperature of this sequence.
+        rng (np.random.Generator): The random generator of this sequence, seeded if the job asks for it.
+        failed (bool): Whether the generation ended with an error.
+    """
+
+    def __init__(self, seq_id: int, job: ChatJob, prompt: List[int], stop: List[str], temperature: float):
+        """
+        Initializes a Sequence for a job whose prompt has been tokenized.
+
+        Args:
+            seq_id (int): The llama.cpp sequence id.
+            job (ChatJob): The chat job being generated.
+            prompt (List[int]): The prompt tokens.
+            stop (List[str]): Stop strings ending the generation.
+            temperature (float): The default sampling temperature, unless the job sets its own.
+        """
+        self.seq_id = seq_id
+        self.job = job
+        self.prompt = prompt
+        self.stop = stop
+        self.n_past = 0
+        self.last_token: Optional[int] = None
+        self.logits_index = -1
+        self.held = ""
+        self.n_generated = 0
+        self.max_tokens = job.get_params().get("max_tokens")
+        self.started = time.monotonic()
+        self.first_token = 0.0
+        self.temperature = job.get_params().get("temperature", temperature)
+        self.rng = np.random.default_rng(job.get_params().get("seed"))
+        self.failed = False
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def emit(self, text: str) -> bool:
+        """
+        Reports generated text to the job, holding back anything that may start a stop string.
+
+        Args:
+            text (str): Newly decoded text.
+
+        Returns:
+            bool: True if a stop string was reached and the generation should end.
+        """
+        self.held += text
+        for stop in self.stop:
+            index = self.held.find(stop)
+            if index >= 0:
+                self.held = self.held[:index]
+                self.flush()
+                return True
+
+        keep = 0
+        for stop in self.stop:
+            for length in range(min(len(stop) - 1, len(self.held)), keep, -1):
+                if self.held.endswith(stop[:length]):
+                    keep = length
+                    break
+        if len(self.held) > keep:
+            self.job.append_chunk(self.held[:len(self.held) - keep])
+            self.held = self.held[len(self.held) - keep:]
+        return False
+
+    def flush(self) -> None:
+        """
+        Reports any withheld text to the job.
+        """
+        if self.held:
+            self.job.append_chunk(self.held)
+            self.held = ""
+
+
+class BatchProcessor(threading.Thread):
+    """
+    A thread that generates several ChatJobs at once by decoding all active sequences in a single
+    llama.cpp batch per step. New jobs are admitted from the task queue as soon as a sequence slot
+    is free, and their prompts are prefilled in the same batches as the running decodes.
+
+    The processor owns a llama.cpp context with one sequence per slot. It is created on the model
+    of a Llama instance, so the weights are shared; the Llama itself is only used for tokenization.
+
+    Attributes:
+        taskLock (threading.Lock): A lock to ensure thread-safe access to shared resources.
+        taskQueue (queue.Queue): The queue holding jobs to be processed.
+        jobReg (JobRegister): A registry for managing and retrieving job objects by their UUID.
+        llm (Llama): The model instance providing weights, tokenizer and chat template.
+        n_seq (int): The maximum number of jobs generated concurrently.
+        n_batch (int): The maximum number of tokens decoded per step.
+        tracker (ThroughputTracker): Collects the duration and length of finished jobs.
+        responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+        semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+        seq_ctx (int): The number of KV cells available to each sequence.
+        counter (TokenCounter): Counts the tokens of messages with the model's tokenizer.
+        warming (bool): Whether the warmup generation is running, whose job is left out of the
+            metrics and the throughput.
+    """
+
+    def __init__(self, taskLock: threading.Lock, taskQueue: "queue.Queue[str]", jobReg: JobRegister, llm: Llama,
+                 tracker: ThroughputTracker, responseCache: Optional[ResponseCache],
+                 semanticCache: Optional[SemanticCache], n_seq: int, n_ctx: int, n_batch: int = 512, n_threads: Optional[int] = None,
+                 counter: Optional[TokenCounter] = None, n_threads_batch: Optional[int] = None,
+                 type_k: Optional[int] = None, type_v: Optional[int] = None, flash_attn: bool = False):
+        """
+        Initializes the BatchProcessor and creates its multi-sequence context.
+
+        Args:
+            taskLock (threading.Lock): A lock for synchronizing job-related operations.
+            taskQueue (queue.Queue): A queue containing job UUIDs to be processed.
+            jobReg (JobRegister): A job registry to manage and retrieve jobs.
+            llm (Llama): The model instance whose weights and tokenizer are used.
+            tracker (ThroughputTracker): Collects the duration and length of finished jobs.
+            responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+            semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+            n_seq (int): The maximum number of concurrently generated jobs.
+            n_ctx (int): The total context size, split evenly between the sequences.
+            n_batch (int): The maximum number of tokens decoded per step.
+            n_threads (Optional[int]): The number of CPU threads used for decoding.
+            counter (Optional[TokenCounter]): A token counter shared with the other workers of the model.
+                Defaults to a counter of its own.
+            n_threads_batch (Optional[int]): The number of CPU threads used for batches with prompt
+                tokens. Defaults to n_threads.
+            type_k (Optional[int]): The ggml type of the K cache. Defaults to f16.
+            type_v (Optional[int]): The ggml type of the V cache. Defaults to f16.
+            flash_attn (bool): Whether to use flash attention, which a quantized V cache requires.
+
+        Raises:
+            ValueError: If the model has no chat template.
+            RuntimeError: If the llama.cpp context cannot be created.
+        """
+        super().__init__()
+        self.taskLock = taskLock
+        self.taskQueue = taskQueue
+        self.jobReg = jobReg
+        self.llm = llm
+        self.tracker = tracker
+        self.responseCache = responseCache
+        self.semanticCache = semanticCache
+        self.n_seq = n_seq
+        self.n_batch = max(n_batch, n_seq)
+        self.n_vocab = llm.n_vocab()
+        self.counter = counter if counter is not None else make_counter(llm)
+        self.warming = False
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = self.n_batch
+        params.n_ubatch = self.n_batch
+        params.n_seq_max = n_seq
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads_batch or n_threads
+        if type_k is not None:
+            params.type_k = type_k
+        if type_v is not None:
+            params.type_v = type_v
+        if flash_attn:
+            # Older llama.cpp versions have a flag instead of the attention type
+            if hasattr(params, "flash_attn_type"):
+                params.flash_attn_type = llama_cpp.LLAMA_FLASH_ATTN_TYPE_ENABLED
+            else:
+                params.flash_attn = True
+        self.ctx = llama_cpp.llama_new_context_with_model(llm.model, params)
+        if not self.ctx:
+            raise RuntimeError("Failed to create the batch context.")
+        self.seq_ctx = llama_cpp.llama_n_ctx(self.ctx) // n_seq
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, n_seq)
+
+        template = llm.metadata.get("tokenizer.chat_template")
+        if not template:
+            raise ValueError("Continuous batching requires a model with an embedded chat template.")
+        eos = llm.token_eos()
+        self.formatter = Jinja2ChatFormatter(
+            template=template,
+            eos_token=llm._model.token_get_text(eos),
+            bos_token=llm._model.token_get_text(llm.token_bos()),
+            stop_token_ids=[eos]
+        )
+        self.eog_tokens = {eos}
+
+        self.temperature = float(os.getenv('TEMPERATURE', '0.2'))
+        self.top_k = int(os.getenv('TOP_K', '40'))
+        self.top_p = float(os.getenv('TOP_P', '0.95'))
+
+        self.free_ids = list(range(n_seq))
+        self.active: Dict[int, Sequence] = {}
+
+    def run(self):
+        """
+        The main loop of the thread. Admits queued jobs into free sequence slots and advances
+        all active sequences by one batched decoding step. Exits and frees the contexts once the
+        task queue is closed and all sequences are finished.
+        """
+        while True:
+            try:
+                self.admit()
+            except SchedulerClosed:
+                break
+            if not self.active:
+                continue
+            try:
+                self.step()
+            except Exception as e:
+                print(f"Error during batched LLM completion: {e}")
+                error_message = os.getenv('CHATERROR', 'An error occurred.')
+                for seq in list(self.active.values()):
+                    seq.job.append_chunk(error_message)
+                    seq.failed = True
+                    self.finish(seq)
+        self.release()
+
+    def is_idle(self) -> bool:
+        """
+        Checks whether the processor is waiting for a job.
+
+        Returns:
+            bool: True if no sequence is active.
+        """
+        return not self.active
+
+    def release(self) -> None:
+        """
+        Frees the batch, the multi-sequence context and the model.
+        """
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+        if hasattr(self.llm, "close"):
+            self.llm.close()
+        self.llm = None
+
+    def warmup(self, prompt: str, max_tokens: int) -> None:
+        """
+        Generates a few tokens before the processor is started, so the first job does not pay
+        for page faults and first-time allocations.
+
+        Args:
+            prompt (str): The user message to answer.
+            max_tokens (int): The number of tokens to generate.
+        """
+        job = ChatJob("", [prompt])
+        self.warming = True
+        try:
+            self.start(job)
+            while self.active and all(seq.n_generated < max_tokens for seq in self.active.values()):
+                self.step()
+            for seq in list(self.active.values()):
+                self.finish(seq, "cancelled")
+        finally:
+            self.warming = False
+
+    def admit(self) -> None:
+        """
+        Moves jobs from the task queue into free sequence slots. Blocks only while no sequence is active.
+
+        Raises:
+            SchedulerClosed: If the task queue is closed and empty and no sequence is active.
+        """
+        while self.free_ids:
+            try:
+                uuid = self.taskQueue.get(block=not self.active)
+            except queue.Empty:
+                return
+            except SchedulerClosed:
+                if self.active:
+                    return
+                raise
+
+            try:
+                job = self.jobReg.get_job(uuid)
+                if isinstance(job, ChatJob):
+                    metrics.QUEUE_WAIT.observe(time.monotonic() - job.get_created_at())
+                    if job.is_cancelled():
+                        job.set_status("cancelled")
+                        metrics.JOBS.inc(outcome="cancelled")
+                    elif job.is_expired():
+                        # Nobody waits for the answer any more, so skip the prefill
+                        job.set_status("expired")
+                        metrics.JOBS.inc(outcome="expired")
+                    else:
+                        self.start(job)
+                else:
+                    print(f"Unknown job type for UUID: {uuid}")
+            finally:
+                self.taskQueue.task_done()
+
+    def get_prompt_budget(self, max_tokens: Optional[int] = None) -> int:
+        """
+        Computes the number of tokens the prompt of a job may use in a sequence.
+
+        Args:
+            max_tokens (Optional[int]): The job's limit on generated tokens, if any.
+
+        Returns:
+            int: The budget.
+        """
+        return prompt_budget(self.seq_ctx, max_tokens)
+
+    def start(self, job: ChatJob) -> None:
+        """
+        Templates and tokenizes a job's conversation and assigns it a sequence slot. The oldest
+        exchanges are dropped if the conversation exceeds the prompt budget of a sequence.
+
+        Args:
+            job (ChatJob): The chat job to start.
+        """
+        job.set_status("processing")
+        try:
+            budget = self.get_prompt_budget(job.get_params().get("max_tokens"))
+            messages, _ = fit_messages(job.get_chat_messages(), self.counter, budget)
+            result = self.formatter(messages=messages)
+            prompt = self.llm.tokenize(
+                result.prompt.encode("utf-8"),
+                add_bos=not getattr(result, "added_special", False),
+                special=True
+            )
+        except Exception as e:
+            print(f"Error while preparing ChatJob: {e}")
+            job.append_chunk(os.getenv('CHATERROR', 'An error occurred.'))
+            job.set_status("finished")
+            self.count_job("failed")
+            return
+
+        if len(prompt) >= self.seq_ctx:
+            print(f"Prompt of {len(prompt)} tokens exceeds the sequence context of {self.seq_ctx}")
+            job.append_chunk(os.getenv('CHATERROR', 'An error occurred.'))
+            job.set_status("finished")
+            self.count_job("failed")
+            return
+
+        stop = result.stop if isinstance(result.stop, list) else [result.stop] if result.stop else []
+        for text in stop:
+            tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+            if len(tokens) == 1:
+                # Control tokens such as <|eot_id|> decode to nothing and are matched by id instead
+                self.eog_tokens.add(tokens[0])
+
+        requested = job.get_params().get("stop") or []
+        stop = stop + ([requested] if isinstance(requested, str) else list(requested))
+        seq = Sequence(self.free_ids.pop(), job, prompt, [text for text in stop if text], self.temperature)
+        self.active[seq.seq_id] = seq
+
+    def step(self) -> None:
+        """
+        Builds one batch from the next token of every decoding sequence plus as many pending
+        prompt tokens as fit, decodes it and samples the next token of each sequence.
+        Cancelled and expired sequences are released before the batch is built.
+
+        Raises:
+            RuntimeError: If llama_decode fails.
+        """
+        for seq in list(self.active.values()):
+            if seq.job.is_cancelled():
+                self.finish(seq, "cancelled")
+            elif seq.job.is_expired():
+                self.finish(seq, "expired")
+        if not self.active:
+            return
+
+        n_tokens = 0
+        for seq in self.active.values():
+            seq.logits_index = -1
+            if not seq.prompt:
+                n_tokens = self.add_token(n_tokens, seq, seq.last_token, True)
+
+        for seq in self.active.values():
+            if not seq.prompt or n_tokens >= self.n_batch:
+                continue
+            take = min(len(seq.prompt), self.n_batch - n_tokens)
+            for i, token in enumerate(seq.prompt[:take]):
+                # Only the last prompt token needs logits to sample the first generated token
+                n_tokens = self.add_token(n_tokens, seq, token, i == len(seq.prompt) - 1)
+            seq.prompt = seq.prompt[take:]
+
+        self.batch.n_tokens = n_tokens
+        result = llama_cpp.llama_decode(self.ctx, self.batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode returned {result}")
+
+        for seq in list(self.active.values()):
+            if seq.logits_index < 0:
+                continue
+            token = self.sample(seq, seq.logits_index)
+            if token in self.eog_tokens:
+                self.finish(seq)
+                continue
+
+            seq.last_token = token
+            seq.n_generated += 1
+            seq.first_token = seq.first_token or time.monotonic()
+            text = seq.decoder.decode(self.llm.detokenize([token]))
+            if seq.emit(text) or seq.n_past >= self.seq_ctx or seq.n_generated == seq.max_tokens:
+                self.finish(seq)
+
+    def add_token(self, n_tokens: int, seq: Sequence, token: int, logits: bool) -> int:
+        """
+        Appends a token of a sequence to the batch.
+
+        Args:
+            n_tokens (int): The current number of tokens in the batch.
+            seq (Sequence): The sequence the token belongs to.
+            token (int): The token id.
+            logits (bool): Whether logits should be computed for this position.
+
+        Returns:
+            int: The new number of tokens in the batch.
+        """
+        self.batch.token[n_tokens] = token
+        self.batch.pos[n_tokens] = seq.n_past
+        self.batch.n_seq_id[n_tokens] = 1
+        self.batch.seq_id[n_tokens][0] = seq.seq_id
+        self.batch.logits[n_tokens] = logits
+        seq.n_past += 1
+        if logits:
+            seq.logits_index = n_tokens
+        return n_tokens + 1
+
+    def sample(self, seq: Sequence, index: int) -> int:
+        """
+        Samples a token from the logits at a batch position using temperature, top-k and top-p.
+
+        Args:
+            seq (Sequence): The sequence the token is sampled for.
+            index (int): The batch position.
+
+        Returns:
+            int: The sampled token id.
+        """
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, index), shape=(self.n_vocab,))
+        if seq.temperature <= 0:
+            return int(np.argmax(logits))
+
+        top = np.argpartition(logits, -self.top_k)[-self.top_k:]
+        scaled = logits[top] / seq.temperature
+        probs = np.exp(scaled - scaled.max())
+        probs /= probs.sum()
+
+        order = np.argsort(-probs)
+        keep = order[:np.searchsorted(np.cumsum(probs[order]), self.top_p) + 1]
+        choice = seq.rng.choice(keep, p=probs[keep] / probs[keep].sum())
+        return int(top[choice])
+
+    def finish(self, seq: Sequence, status: str = "finished") -> None:
+        """
+        Ends a sequence, releases its KV cells and slot, and sets the final status of its job.
+
+        Args:
+            seq (Sequence): The sequence to finish.
+            status (str): The final status of the job.
+        """
+        seq.flush()
+        kv_seq_rm(self.ctx, seq.seq_id, -1, -1)
+        del self.active[seq.seq_id]
+        self.free_ids.append(seq.seq_id)
+        if status == "finished" and not self.warming:
+            self.tracker.record(time.monotonic() - seq.started, seq.n_generated)
+            if not seq.failed:
+                cache_completion(seq.job, self.responseCache, self.semanticCache)
+                metrics.record_generation(seq.job.get_created_at(), seq.started, seq.first_token,
+                                          time.monotonic(), seq.n_generated)
+        self.count_job("failed" if seq.failed else status)
+        seq.job.set_status(status)
+
+    def count_job(self, outcome: str) -> None:
+        """
+        Counts a job that ended, unless it is the warmup generation.
+
+        Args:
+            outcome (str): How the job ended.
+        """
+        if not self.warming:
+            metrics.JOBS.inc(outcome=outcome)
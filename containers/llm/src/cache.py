@@ -0,0 +1,913 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_cpp.llama import LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+
+def hash_tokens(tokens: Sequence[int]) -> str:
+    """
+    Computes a stable hash of a token sequence.
+
+    Args:
+        tokens (Sequence[int]): The token ids.
+
+    Returns:
+        str: The hex digest of the tokens.
+    """
+    return hashlib.blake2b(np.asarray(tokens, dtype=np.int32).tobytes(), digest_size=16).hexdigest()
+
+
+class DiskStateStore:
+    """
+    A size-capped on-disk store of llama.cpp states, evicting the least recently used files.
+
+    States are pickled to '<prefix length>-<hash>.state' files, so the index can be rebuilt from
+    the directory listing after a restart. The directory must be specific to one model and context
+    size, because states cannot be restored into a different one.
+
+    Attributes:
+        directory (str): The directory holding the state files.
+        capacity_bytes (int): The maximum total size of the state files.
+        index (OrderedDict[str, Tuple[int, int]]): Prefix length and file size by hash, least recently used first.
+        lock (threading.RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    SUFFIX = ".state"
+
+    def __init__(self, directory: str, capacity_bytes: int):
+        """
+        Initializes the store and indexes the state files already present in the directory.
+
+        Args:
+            directory (str): The directory holding the state files.
+            capacity_bytes (int): The maximum total size of the state files.
+        """
+        self.directory = directory
+        self.capacity_bytes = capacity_bytes
+        self.index: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                length, digest = name[:-len(self.SUFFIX)].split("-", 1)
+                stat = os.stat(os.path.join(directory, name))
+            except (ValueError, OSError):
+                continue
+            files.append((stat.st_mtime, digest, int(length), stat.st_size))
+        for _, digest, length, size in sorted(files):
+            self.index[digest] = (length, size)
+            self.size += size
+        self.shrink()
+
+    def path(self, digest: str, length: int) -> str:
+        """
+        Returns the file path of a state.
+
+        Args:
+            digest (str): The hash of the state's tokens.
+            length (int): The number of tokens in the state.
+        """
+        return os.path.join(self.directory, f"{length}-{digest}{self.SUFFIX}")
+
+    def __contains__(self, digest: str) -> bool:
+        """
+        Checks whether a state with the given hash is stored.
+        """
+        with self.lock:
+            return digest in self.index
+
+    def lengths(self) -> Dict[int, int]:
+        """
+        Returns the number of stored states per prefix length.
+        """
+        with self.lock:
+            lengths: Dict[int, int] = {}
+            for length, _ in self.index.values():
+                lengths[length] = lengths.get(length, 0) + 1
+            return lengths
+
+    def save(self, digest: str, length: int, state: LlamaState) -> None:
+        """
+        Writes a state to disk atomically and evicts the least recently used files beyond the capacity.
+
+        Args:
+            digest (str): The hash of the state's tokens.
+            length (int): The number of tokens in the state.
+            state (LlamaState): The state to store.
+        """
+        path = self.path(digest, length)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"Error while saving KV state: {e}")
+            return
+
+        with self.lock:
+            if digest in self.index:
+                self.size -= self.index.pop(digest)[1]
+            self.index[digest] = (length, size)
+            self.size += size
+            self.shrink()
+
+    def pop(self, digest: str) -> Optional[Tuple[int, LlamaState]]:
+        """
+        Loads a state and removes it from disk.
+
+        Args:
+            digest (str): The hash of the state's tokens.
+
+        Returns:
+            Optional[Tuple[int, LlamaState]]: The prefix length and the state, or None if it cannot be read.
+        """
+        with self.lock:
+            if digest not in self.index:
+                return None
+            length, size = self.index.pop(digest)
+            self.size -= size
+            # Claim the file, so that the state can be read without holding the lock
+            path = self.path(digest, length) + ".loading"
+            try:
+                os.replace(self.path(digest, length), path)
+            except OSError as e:
+                print(f"Error while loading KV state: {e}")
+                return None
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError) as e:
+            print(f"Error while loading KV state: {e}")
+            state = None
+        self.delete(path)
+        return (length, state) if state is not None else None
+
+    def load(self, digest: str) -> Optional[Tuple[int, LlamaState]]:
+        """
+        Loads a state and keeps it on disk, marking it as recently used.
+
+        Args:
+            digest (str): The hash of the state's tokens.
+
+        Returns:
+            Optional[Tuple[int, LlamaState]]: The prefix length and the state, or None if it cannot be read.
+        """
+        with self.lock:
+            if digest not in self.index:
+                return None
+            self.index.move_to_end(digest)
+            length = self.index[digest][0]
+        try:
+            with open(self.path(digest, length), "rb") as f:
+                return length, pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError) as e:
+            print(f"Error while loading KV state: {e}")
+            return None
+
+    def file_size(self, digest: str) -> int:
+        """
+        Returns the size of a stored state's file in bytes, or 0 if it is not stored.
+
+        Args:
+            digest (str): The hash of the state's tokens.
+        """
+        with self.lock:
+            return self.index[digest][1] if digest in self.index else 0
+
+    def shrink(self) -> None:
+        """
+        Deletes the least recently used files until the store fits its capacity.
+        """
+        with self.lock:
+            while self.size > self.capacity_bytes and self.index:
+                digest, (length, size) = self.index.popitem(last=False)
+                self.size -= size
+                self.delete(self.path(digest, length))
+
+    @staticmethod
+    def delete(path: str) -> None:
+        """
+        Deletes a file, ignoring files that are already gone.
+
+        Args:
+            path (str): The file to delete.
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class PrefixCache(BaseLlamaCache):
+    """
+    An in-memory LRU cache of llama.cpp states keyed by a hash of the tokens they contain.
+
+    Llama looks the cache up with the tokens of every new prompt and saves its state under the
+    prompt and completion tokens once a generation ends. A follow-up turn of a conversation starts
+    with exactly those tokens, so the longest stored prefix is restored and only the new message
+    has to be prefilled. The cache is thread-safe and may be shared by the Llama instances of all
+    workers as long as they use the same model and context size.
+
+    With a DiskStateStore attached, states evicted from memory and states of conversations that
+    have been idle for longer than idle_seconds are spilled to disk instead of being dropped, and
+    are loaded back when the conversation continues.
+
+    Attributes:
+        capacity_bytes (int): The maximum total size of the stored states.
+        entries (OrderedDict[str, Tuple[int, LlamaState]]): The states by prefix hash, least recently used first.
+        lengths (Dict[int, int]): The number of stored states per prefix length.
+        last_used (Dict[str, float]): The time each entry was last stored or looked up.
+        disk (Optional[DiskStateStore]): The store spilled states are written to.
+        idle_seconds (float): The idle time after which an entry is spilled to disk.
+        hits (int): The number of successful lookups.
+        misses (int): The number of failed lookups.
+        lock (threading.RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, capacity_bytes: int, disk: Optional[DiskStateStore] = None, idle_seconds: float = 0):
+        """
+        Initializes an empty PrefixCache.
+
+        Args:
+            capacity_bytes (int): The maximum total size of the stored states.
+            disk (Optional[DiskStateStore]): A store for spilled states.
+            idle_seconds (float): The idle time after which an entry is spilled to disk; 0 disables it.
+        """
+        super().__init__(capacity_bytes)
+        self.entries: "OrderedDict[str, Tuple[int, LlamaState]]" = OrderedDict()
+        self.lengths: Dict[int, int] = {}
+        self.last_used: Dict[str, float] = {}
+        self.disk = disk
+        self.idle_seconds = idle_seconds
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    @property
+    def cache_size(self) -> int:
+        """
+        Returns the total size of the stored states in bytes.
+        """
+        return self.size
+
+    @staticmethod
+    def state_size(state: LlamaState) -> int:
+        """
+        Returns the memory held by a state in bytes.
+
+        Args:
+            state (LlamaState): The state.
+        """
+        return state.llama_state_size + state.input_ids.nbytes + state.scores.nbytes
+
+    def _find_longest_prefix_key(self, key: Sequence[int]) -> Optional[str]:
+        """
+        Finds the hash of the longest stored prefix of the given tokens.
+
+        Args:
+            key (Sequence[int]): The tokens to look up.
+
+        Returns:
+            Optional[str]: The hash of the matching entry, or None.
+        """
+        with self.lock:
+            lengths = set(self.lengths)
+            if self.disk is not None:
+                lengths.update(self.disk.lengths())
+            for length in sorted(lengths, reverse=True):
+                if length > len(key):
+                    continue
+                digest = hash_tokens(key[:length])
+                if digest in self.entries or (self.disk is not None and digest in self.disk):
+                    return digest
+            return None
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        """
+        Returns the state of the longest stored prefix of the given tokens. A spilled state is
+        loaded back from disk without holding the lock, and moved into memory if it fits.
+
+        Raises:
+            KeyError: If no stored state is a prefix of the tokens.
+        """
+        state = None
+        with self.lock:
+            spilled = self.take_idle()
+            digest = self._find_longest_prefix_key(key)
+            if digest is not None and digest in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(digest)
+                self.last_used[digest] = time.monotonic()
+                state = self.entries[digest][1]
+            elif digest is None:
+                self.misses += 1
+        self.spill(spilled)
+        if digest is None:
+            raise KeyError("Prefix not found")
+        if state is not None:
+            return state
+
+        if self.disk.file_size(digest) > self.capacity_bytes:
+            # A state that cannot fit in memory is read from disk on every hit instead of moving back and forth
+            restored = self.disk.load(digest)
+        else:
+            restored = self.disk.pop(digest)
+        with self.lock:
+            if restored is None:
+                self.misses += 1
+                raise KeyError("Prefix not found")
+            self.hits += 1
+            length, state = restored
+            spilled = self.store(digest, length, state) if self.state_size(state) <= self.capacity_bytes else []
+        self.spill(spilled)
+        return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        """
+        Checks whether a stored state is a prefix of the given tokens.
+        """
+        return self._find_longest_prefix_key(key) is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState) -> None:
+        """
+        Stores a state under the hash of its tokens and evicts the least recently used
+        states until the cache fits its capacity. Evicted states are written to disk after
+        the lock is released.
+        """
+        with self.lock:
+            spilled = self.take_idle() + self.store(hash_tokens(key), len(key), value)
+        self.spill(spilled)
+
+    def store(self, digest: str, length: int, state: LlamaState) -> List[Tuple[str, int, LlamaState]]:
+        """
+        Stores a state in memory and evicts the least recently used states until the cache fits its capacity.
+
+        Args:
+            digest (str): The hash of the state's tokens.
+            length (int): The number of tokens in the state.
+            state (LlamaState): The state to store.
+
+        Returns:
+            List[Tuple[str, int, LlamaState]]: The evicted states to spill, and the new state itself
+                if it is larger than the capacity.
+        """
+        size = self.state_size(state)
+        with self.lock:
+            if digest in self.entries:
+                self.remove(digest)
+            if size > self.capacity_bytes:
+                return [(digest, length, state)]
+            self.entries[digest] = (length, state)
+            self.lengths[length] = self.lengths.get(length, 0) + 1
+            self.last_used[digest] = time.monotonic()
+            self.size += size
+            evicted = []
+            while self.size > self.capacity_bytes:
+                digest = next(iter(self.entries))
+                evicted.append((digest, *self.remove(digest)))
+            return evicted
+
+    def take_idle(self) -> List[Tuple[str, int, LlamaState]]:
+        """
+        Removes the states of conversations idle for longer than idle_seconds, to be spilled to disk.
+
+        Returns:
+            List[Tuple[str, int, LlamaState]]: The removed states.
+        """
+        if self.disk is None or self.idle_seconds <= 0:
+            return []
+        deadline = time.monotonic() - self.idle_seconds
+        with self.lock:
+            return [(digest, *self.remove(digest)) for digest in
+                    [digest for digest in self.entries if self.last_used[digest] < deadline]]
+
+    def spill(self, states: List[Tuple[str, int, LlamaState]]) -> None:
+        """
+        Writes removed states to disk if a store is attached. Called without the lock held, so the
+        other workers are not blocked while large states are pickled.
+
+        Args:
+            states (List[Tuple[str, int, LlamaState]]): The hash, prefix length and state of each.
+        """
+        if self.disk is None:
+            return
+        for digest, length, state in states:
+            self.disk.save(digest, length, state)
+
+    def remove(self, digest: str) -> Tuple[int, LlamaState]:
+        """
+        Removes a state from the cache.
+
+        Args:
+            digest (str): The hash of the entry.
+
+        Returns:
+            Tuple[int, LlamaState]: The prefix length and the removed state.
+        """
+        with self.lock:
+            length, state = self.entries.pop(digest)
+            del self.last_used[digest]
+            self.lengths[length] -= 1
+            if not self.lengths[length]:
+                del self.lengths[length]
+            self.size -= self.state_size(state)
+            return length, state
+
+
+class ResponseCache:
+    """
+    A thread-safe cache of finished completions for deterministic requests, with an in-memory
+    LRU tier and an optional on-disk tier that survives restarts.
+
+    Entries are keyed by a hash of the system prompt, the messages, the sampling parameters and
+    the model file. Both tiers are size-capped and entries expire after the time to live. The size
+    of the on-disk tier is tracked in memory from the directory listing at creation, so only one
+    process may write to the directory.
+
+    Attributes:
+        max_entries (int): The maximum number of entries kept in memory.
+        ttl (float): Seconds after which an entry expires.
+        directory (str): The directory of the on-disk tier; empty if disabled.
+        disk_bytes (int): The maximum total size of the on-disk tier.
+        entries (OrderedDict[str, Tuple[float, str]]): Creation time and completion by key, least recently used first.
+        disk_index (OrderedDict[str, int]): File size by key of the on-disk entries, least recently used first.
+        disk_size (int): The total size of the on-disk entries.
+        hits (int): The number of lookups answered from memory.
+        disk_hits (int): The number of lookups answered from disk.
+        misses (int): The number of failed lookups.
+        lock (threading.RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, directory: str = "", disk_bytes: int = 0):
+        """
+        Initializes an empty ResponseCache.
+
+        Args:
+            max_entries (int): The maximum number of entries kept in memory.
+            ttl (float): Seconds after which an entry expires.
+            directory (str): The directory of the on-disk tier; empty disables it.
+            disk_bytes (int): The maximum total size of the on-disk tier.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.disk_index: "OrderedDict[str, int]" = OrderedDict()
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.index_disk()
+
+    @staticmethod
+    def from_env() -> Optional["ResponseCache"]:
+        """
+        Creates the response cache configured by RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_TTL,
+        RESPONSE_CACHE_DIR and RESPONSE_CACHE_DISK_BYTES.
+
+        Returns:
+            Optional[ResponseCache]: The cache, or None if RESPONSE_CACHE_ENTRIES is 0.
+        """
+        max_entries = int(os.getenv('RESPONSE_CACHE_ENTRIES', '0'))
+        if max_entries <= 0:
+            return None
+        return ResponseCache(
+            max_entries=max_entries,
+            ttl=float(os.getenv('RESPONSE_CACHE_TTL', '86400')),
+            directory=os.getenv('RESPONSE_CACHE_DIR', ''),
+            disk_bytes=int(os.getenv('RESPONSE_CACHE_DISK_BYTES', str(1024 ** 3)))
+        )
+
+    @staticmethod
+    def is_cacheable(params: Dict[str, Any]) -> bool:
+        """
+        Checks whether a request with the given sampling parameters always produces the same completion.
+
+        Args:
+            params (Dict[str, Any]): The sampling parameters.
+
+        Returns:
+            bool: True for greedy sampling or a fixed seed.
+        """
+        return params.get("temperature") == 0 or params.get("seed") is not None
+
+    @staticmethod
+    def make_key(sys_prompt: str, messages: List[str], params: Dict[str, Any], model: str) -> str:
+        """
+        Computes the cache key of a request.
+
+        Args:
+            sys_prompt (str): The system prompt.
+            messages (List[str]): The conversation.
+            params (Dict[str, Any]): The sampling parameters.
+            model (str): The model file.
+
+        Returns:
+            str: The hex digest identifying the request.
+        """
+        data = json.dumps([sys_prompt, messages, params, model], sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        """
+        Returns the file path of an entry in the on-disk tier.
+
+        Args:
+            key (str): The cache key.
+        """
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks a completion up in memory, then on disk.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Optional[str]: The cached completion, or None.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+
+            entry = self.load(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self.remember(key, *entry)
+                if key in self.disk_index:
+                    self.disk_index.move_to_end(key)
+                self.disk_hits += 1
+                return entry[1]
+            if entry is not None:
+                self.disk_size -= self.disk_index.pop(key, 0)
+                DiskStateStore.delete(self.path(key))
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, completion: str) -> None:
+        """
+        Stores a completion in memory and on disk.
+
+        Args:
+            key (str): The cache key.
+            completion (str): The completion.
+        """
+        created = time.time()
+        with self.lock:
+            self.remember(key, created, completion)
+        if self.directory:
+            self.save(key, created, completion)
+
+    def remember(self, key: str, created: float, completion: str) -> None:
+        """
+        Stores an entry in memory, evicting the least recently used entries beyond max_entries.
+
+        Args:
+            key (str): The cache key.
+            created (float): The creation time of the entry.
+            completion (str): The completion.
+        """
+        with self.lock:
+            self.entries[key] = (created, completion)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def load(self, key: str) -> Optional[Tuple[float, str]]:
+        """
+        Reads an entry from the on-disk tier and marks it as recently used.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Optional[Tuple[float, str]]: Creation time and completion, or None.
+        """
+        if not self.directory:
+            return None
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(self.path(key))
+            return data["created"], data["completion"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key: str, created: float, completion: str) -> None:
+        """
+        Writes an entry to the on-disk tier atomically and trims the tier to its size.
+
+        Args:
+            key (str): The cache key.
+            created (float): The creation time of the entry.
+            completion (str): The completion.
+        """
+        path = self.path(key)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"created": created, "completion": completion}, f)
+            os.replace(path + ".tmp", path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"Error while saving cached response: {e}")
+            return
+
+        with self.lock:
+            self.disk_size += size - self.disk_index.pop(key, 0)
+            self.disk_index[key] = size
+            self.trim()
+
+    def index_disk(self) -> None:
+        """
+        Indexes the files already present in the on-disk tier, deleting the expired ones, and trims
+        the tier to its size.
+        """
+        now = time.time()
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                DiskStateStore.delete(path)
+            else:
+                files.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+
+        with self.lock:
+            for _, key, size in sorted(files):
+                self.disk_index[key] = size
+                self.disk_size += size
+            self.trim()
+
+    def trim(self) -> None:
+        """
+        Deletes the least recently used files until the on-disk tier fits its size.
+        """
+        with self.lock:
+            while self.disk_size > self.disk_bytes and self.disk_index:
+                key, size = self.disk_index.popitem(last=False)
+                self.disk_size -= size
+                DiskStateStore.delete(self.path(key))
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size and hit/miss counters of the cache.
+
+        Returns:
+            Dict[str, int]: The number of entries in memory and the counters.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses
+            }
+
+
+class SemanticCache:
+    """
+    A thread-safe cache answering single-turn questions that are similar to questions answered
+    before. Questions are compared by the cosine similarity of their embeddings; answers are only
+    shared between requests with the same system prompt and model.
+
+    Attributes:
+        max_entries (int): The maximum number of cached answers; the oldest are evicted first.
+        threshold (float): The minimum cosine similarity for a question to count as a match.
+        ttl (float): Seconds after which an answer expires.
+        namespaces (Dict[str, Tuple[List[np.ndarray], List[str], List[float]]]): Per system prompt and
+            model, the question embeddings, answers and creation times in order of insertion.
+        matrices (Dict[str, np.ndarray]): The stacked embeddings of each namespace, rebuilt on change.
+        size (int): The number of cached answers.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of failed lookups.
+        lock (threading.RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, max_entries: int, threshold: float, ttl: float):
+        """
+        Initializes an empty SemanticCache.
+
+        Args:
+            max_entries (int): The maximum number of cached answers.
+            threshold (float): The minimum cosine similarity for a match.
+            ttl (float): Seconds after which an answer expires.
+        """
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.namespaces: Dict[str, Tuple[List[np.ndarray], List[str], List[float]]] = {}
+        self.matrices: Dict[str, np.ndarray] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def from_env() -> Optional["SemanticCache"]:
+        """
+        Creates the semantic cache configured by SEMANTIC_CACHE_ENTRIES, SEMANTIC_CACHE_THRESHOLD
+        and SEMANTIC_CACHE_TTL.
+
+        Returns:
+            Optional[SemanticCache]: The cache, or None if SEMANTIC_CACHE_ENTRIES is 0.
+        """
+        max_entries = int(os.getenv('SEMANTIC_CACHE_ENTRIES', '0'))
+        if max_entries <= 0:
+            return None
+        return SemanticCache(
+            max_entries=max_entries,
+            threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95')),
+            ttl=float(os.getenv('SEMANTIC_CACHE_TTL', '86400'))
+        )
+
+    @staticmethod
+    def make_namespace(sys_prompt: str, model: str) -> str:
+        """
+        Computes the namespace of the answers to a system prompt on a model.
+
+        Args:
+            sys_prompt (str): The system prompt.
+            model (str): The name of the model file.
+
+        Returns:
+            str: The hex digest identifying the namespace.
+        """
+        return hashlib.sha256(json.dumps([sys_prompt, model]).encode("utf-8")).hexdigest()
+
+    def lookup(self, namespace: str, embedding: np.ndarray) -> Optional[str]:
+        """
+        Finds the answer to the most similar cached question.
+
+        Args:
+            namespace (str): The namespace of the request.
+            embedding (np.ndarray): The normalized embedding of the question.
+
+        Returns:
+            Optional[str]: The answer, or None if no cached question is similar enough.
+        """
+        with self.lock:
+            self.expire()
+            if namespace in self.namespaces:
+                if namespace not in self.matrices:
+                    self.matrices[namespace] = np.vstack(self.namespaces[namespace][0])
+                similarities = self.matrices[namespace] @ embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    return self.namespaces[namespace][1][best]
+            self.misses += 1
+            return None
+
+    def add(self, namespace: str, embedding: np.ndarray, answer: str) -> None:
+        """
+        Caches the answer to a question, evicting the oldest answers when full.
+
+        Args:
+            namespace (str): The namespace of the request.
+            embedding (np.ndarray): The normalized embedding of the question.
+            answer (str): The answer.
+        """
+        with self.lock:
+            embeddings, answers, created = self.namespaces.setdefault(namespace, ([], [], []))
+            embeddings.append(embedding)
+            answers.append(answer)
+            created.append(time.monotonic())
+            self.matrices.pop(namespace, None)
+            self.size += 1
+            while self.size > self.max_entries:
+                self.evict_oldest()
+
+    def evict_oldest(self) -> None:
+        """
+        Removes the oldest answer of all namespaces.
+        """
+        namespace = min(self.namespaces, key=lambda name: self.namespaces[name][2][0])
+        self.drop(namespace, 1)
+
+    def expire(self) -> None:
+        """
+        Removes the answers older than the time to live.
+        """
+        deadline = time.monotonic() - self.ttl
+        for namespace in list(self.namespaces):
+            created = self.namespaces[namespace][2]
+            count = 0
+            while count < len(created) and created[count] < deadline:
+                count += 1
+            if count:
+                self.drop(namespace, count)
+
+    def drop(self, namespace: str, count: int) -> None:
+        """
+        Removes the oldest answers of a namespace.
+
+        Args:
+            namespace (str): The namespace.
+            count (int): The number of answers to remove.
+        """
+        embeddings, answers, created = self.namespaces[namespace]
+        del embeddings[:count], answers[:count], created[:count]
+        self.matrices.pop(namespace, None)
+        self.size -= count
+        if not created:
+            del self.namespaces[namespace]
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size and hit/miss counters of the cache.
+
+        Returns:
+            Dict[str, int]: The number of cached answers and the counters.
+        """
+        with self.lock:
+            return {
+                "entries": self.size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def lookup_cache(job: Any, model: str, response_cache: Optional[ResponseCache],
+                 semantic_cache: Optional[SemanticCache], embedder: Any) -> Optional[str]:
+    """
+    Looks up the completion of a new chat job in the caches. On a miss the job remembers its
+    cache keys, so that its completion is stored once it is finished.
+
+    Deterministic requests (temperature 0 or a fixed seed) are looked up in the response cache.
+    Single-turn questions without max_tokens or stop are embedded and looked up in the semantic cache.
+
+    Args:
+        job (ChatJob): The new job.
+        model (str): The name of the model file.
+        response_cache (Optional[ResponseCache]): The exact-match cache, if enabled.
+        semantic_cache (Optional[SemanticCache]): The similarity cache, if enabled.
+        embedder (Any): Embeds questions for the semantic cache; see make_embedder.
+
+    Returns:
+        Optional[str]: The cached completion, or None.
+    """
+    params = job.get_params()
+    messages = job.get_messages()
+    if response_cache is not None and ResponseCache.is_cacheable(params):
+        cache_key = ResponseCache.make_key(job.get_sys_prompt(), messages, params, model)
+        completion = response_cache.get(cache_key)
+        if completion is not None:
+            return completion
+        job.set_cache_key(cache_key)
+
+    if (semantic_cache is not None and embedder is not None and len(messages) == 1
+            and not params.get("max_tokens") and not params.get("stop")):
+        embedding = embedder.embed(messages[0])
+        if embedding is not None:
+            namespace = SemanticCache.make_namespace(job.get_sys_prompt(), model)
+            completion = semantic_cache.lookup(namespace, embedding)
+            if completion is not None:
+                return completion
+            job.set_semantic_key(namespace, embedding)
+    return None
+
+
+def cache_completion(job: Any, response_cache: Optional[ResponseCache], semantic_cache: Optional[SemanticCache]) -> None:
+    """
+    Stores the completion of a successfully finished chat job in the caches it is eligible for.
+
+    Args:
+        job (ChatJob): The finished job.
+        response_cache (Optional[ResponseCache]): The exact-match cache, if enabled.
+        semantic_cache (Optional[SemanticCache]): The similarity cache, if enabled.
+    """
+    if response_cache is not None and job.get_cache_key():
+        response_cache.put(job.get_cache_key(), job.get_completion())
+    if semantic_cache is not None and job.get_semantic_key():
+        semantic_cache.add(*job.get_semantic_key(), job.get_completion())
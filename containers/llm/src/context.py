@@ -0,0 +1,159 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+# Maximum prompt tokens of a chat job; 0 uses the context size minus the completion reserve
+PROMPT_BUDGET = int(os.getenv('PROMPT_BUDGET', '0'))
+# Tokens kept free for the answer of jobs that do not set max_tokens
+COMPLETION_RESERVE = int(os.getenv('COMPLETION_RESERVE', '512'))
+# Tokens the chat template adds around each message
+MESSAGE_OVERHEAD = int(os.getenv('MESSAGE_OVERHEAD', '8'))
+# Number of per-message token counts kept per model
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '100000'))
+
+
+class TokenCounter:
+    """
+    Counts the tokens of texts with a model's tokenizer and remembers the counts, so that the
+    messages of a long conversation are tokenized once and not again on every turn. Counts are
+    keyed by a digest of the text, so the cache does not retain the messages themselves.
+
+    Attributes:
+        tokenize (Callable[[str], int]): Counts the tokens of a text.
+        capacity (int): The maximum number of remembered counts.
+        counts (OrderedDict[bytes, int]): The counts by text digest, least recently used first.
+        hits (int): The number of counts found in the cache.
+        misses (int): The number of texts tokenized.
+        lock (threading.Lock): A lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, tokenize: Callable[[str], int], capacity: int = TOKEN_CACHE_SIZE):
+        """
+        Initializes an empty TokenCounter.
+
+        Args:
+            tokenize (Callable[[str], int]): Counts the tokens of a text.
+            capacity (int): The maximum number of remembered counts.
+        """
+        self.tokenize = tokenize
+        self.capacity = capacity
+        self.counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        """
+        Counts the tokens of a text, from the cache if it was counted before.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The number of tokens, without a begin-of-sequence token.
+        """
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+                self.hits += 1
+                return count
+        # Tokenizing may take a while for remote backends, so it runs outside the lock
+        count = self.tokenize(text)
+        with self.lock:
+            self.misses += 1
+            self.counts[key] = count
+            while len(self.counts) > self.capacity:
+                self.counts.popitem(last=False)
+        return count
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size and hit counters of the cache.
+
+        Returns:
+            Dict[str, int]: The number of remembered counts, hits and misses.
+        """
+        with self.lock:
+            return {"entries": len(self.counts), "hits": self.hits, "misses": self.misses}
+
+
+def make_counter(llm: object) -> TokenCounter:
+    """
+    Creates a TokenCounter for the tokenizer of a model.
+
+    Args:
+        llm (object): The model, anything with the tokenize method of Llama.
+
+    Returns:
+        TokenCounter: The counter.
+    """
+    return TokenCounter(lambda text: len(llm.tokenize(text.encode("utf-8"), add_bos=False)))
+
+
+def prompt_budget(n_ctx: int, max_tokens: Optional[int] = None) -> int:
+    """
+    Computes the number of tokens a job's prompt may use.
+
+    Args:
+        n_ctx (int): The context size the job runs in.
+        max_tokens (Optional[int]): The job's limit on generated tokens, if any.
+
+    Returns:
+        int: The budget: the context size minus the room for the answer, capped by PROMPT_BUDGET.
+    """
+    reserve = max_tokens if max_tokens is not None and max_tokens > 0 else COMPLETION_RESERVE
+    budget = max(n_ctx - reserve, 0)
+    return min(budget, PROMPT_BUDGET) if PROMPT_BUDGET > 0 else budget
+
+
+def count_messages(messages: List[Dict[str, str]], counter: TokenCounter) -> List[int]:
+    """
+    Counts the tokens of each message of a conversation, including the chat template overhead.
+
+    Args:
+        messages (List[Dict[str, str]]): The conversation in the chat completion format.
+        counter (TokenCounter): The counter of the model.
+
+    Returns:
+        List[int]: The tokens of each message.
+    """
+    return [counter.count(message["content"]) + MESSAGE_OVERHEAD for message in messages]
+
+
+def fit_messages(messages: List[Dict[str, str]], counter: TokenCounter,
+                 budget: int) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Compacts a conversation to the prompt budget by dropping its oldest exchanges. The system
+    prompt and the last message are always kept, and messages are dropped in user/assistant
+    pairs so the conversation still starts with the user.
+
+    Args:
+        messages (List[Dict[str, str]]): The conversation, starting with the system prompt.
+        counter (TokenCounter): The counter of the model.
+        budget (int): The maximum number of prompt tokens.
+
+    Returns:
+        Tuple[List[Dict[str, str]], int]: The compacted conversation and its number of tokens.
+
+    Raises:
+        ValueError: If the system prompt and the last message alone exceed the budget.
+    """
+    counts = count_messages(messages, counter)
+    total = sum(counts)
+    start = 1
+    while total > budget and len(messages) - start > 2:
+        total -= counts[start] + counts[start + 1]
+        start += 2
+    if total > budget:
+        raise ValueError(f"Prompt of {total} tokens exceeds the budget of {budget}")
+    metrics.PROMPT_TOKENS.observe(total)
+    if start > 1:
+        metrics.CONTEXT_DROPPED.inc(start - 1)
+        print(f"Dropped the {start - 1} oldest message(s) to fit the prompt budget of {budget} tokens.")
+    return messages[:1] + messages[start:], total
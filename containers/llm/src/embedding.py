@@ -0,0 +1,152 @@
+import os
+import time
+import requests
+import threading
+from typing import List, Optional, Union
+from llama_cpp import Llama
+
+import numpy as np
+
+from tuning import default_threads
+
+
+def pool(embedding: Union[List[float], List[List[float]]]) -> np.ndarray:
+    """
+    Reduces an embedding to a single unit-length vector. Models without pooling return one
+    vector per token, which are averaged.
+
+    Args:
+        embedding (Union[List[float], List[List[float]]]): The embedding as returned by llama.cpp.
+
+    Returns:
+        np.ndarray: The normalized vector.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    if vector.ndim > 1:
+        vector = vector.mean(axis=0)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbedderClient:
+    """
+    A client for the embedder service, which submits an embed job and polls until it is finished.
+
+    Attributes:
+        base_url (str): Base URL of the embedder service.
+        timeout (float): The maximum number of seconds to wait for an embedding.
+        poll_interval (float): Seconds between two status requests.
+        session (requests.Session): Keeps the connection to the service alive between requests.
+    """
+
+    def __init__(self, base_url: str = "http://embedder:80", timeout: float = 10, poll_interval: float = 0.05):
+        """
+        Initializes the EmbedderClient with the base URL of the embedder service.
+
+        Args:
+            base_url (str): Base URL of the embedder service.
+            timeout (float): The maximum number of seconds to wait for an embedding.
+            poll_interval (float): Seconds between two status requests.
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.session = requests.Session()
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        """
+        Embeds a text using the /embed/ endpoint of the embedder service.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            Optional[np.ndarray]: The normalized embedding, or None if the service failed or timed out.
+        """
+        deadline = time.monotonic() + self.timeout
+        try:
+            response = self.session.post(f"{self.base_url}/embed/", json={"text": text}, timeout=self.timeout)
+            response.raise_for_status()
+            uuid = response.json().get("uuid")
+            if not uuid or response.json().get("status") == "failed":
+                return None
+
+            try:
+                while time.monotonic() < deadline:
+                    response = self.session.post(f"{self.base_url}/getCompletion/", json={"uuid": uuid},
+                                                 timeout=self.timeout)
+                    response.raise_for_status()
+                    result = response.json()
+                    if result.get("status") == "finished":
+                        return pool(result["embedding"]) if result.get("embedding") else None
+                    if result.get("status") in ("failed", ""):
+                        return None
+                    time.sleep(self.poll_interval)
+                return None
+            finally:
+                self.session.post(f"{self.base_url}/unregisterJob/", json={"uuid": uuid}, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            print(f"Embedding request failed: {e}")
+            return None
+
+
+class LocalEmbedder:
+    """
+    An in-process embedder running its own embedding model, for deployments without the embedder service.
+
+    Attributes:
+        llm (Llama): The embedding model.
+        lock (threading.Lock): Serializes calls into the model, which is not thread-safe.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 512):
+        """
+        Loads the embedding model.
+
+        Args:
+            model_path (str): The path to the GGUF embedding model.
+            n_ctx (int): The context size of the embedding model.
+        """
+        self.llm = Llama(
+            model_path=model_path,
+            verbose=False,
+            n_ctx=n_ctx,
+            n_threads=default_threads(),
+            embedding=True,
+            pooling_type=1
+        )
+        self.lock = threading.Lock()
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        """
+        Embeds a text.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            Optional[np.ndarray]: The normalized embedding, or None if embedding failed.
+        """
+        try:
+            with self.lock:
+                return pool(self.llm.embed(text))
+        except Exception as e:
+            print(f"Error during embedding: {e}")
+            return None
+
+
+def make_embedder() -> Union[EmbedderClient, LocalEmbedder]:
+    """
+    Creates the embedder configured by the environment: an in-process model if
+    SEMANTIC_CACHE_MODEL is set, else a client of the embedder service at EMBEDDER_URL.
+
+    Returns:
+        Union[EmbedderClient, LocalEmbedder]: The embedder.
+    """
+    model_path = os.getenv('SEMANTIC_CACHE_MODEL', '')
+    if model_path:
+        return LocalEmbedder(model_path, n_ctx=int(os.getenv('SEMANTIC_CACHE_N_CTX', '512')))
+    return EmbedderClient(
+        base_url=os.getenv('EMBEDDER_URL', 'http://embedder:80'),
+        timeout=float(os.getenv('EMBEDDER_TIMEOUT', '10'))
+    )
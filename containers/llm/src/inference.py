@@ -0,0 +1,54 @@
+"""
+Runs the models of the service in a process of their own, next to API worker processes started
+with `uvicorn app:app --workers N`. Both sides share the job store named by JOB_STORE: the API
+processes register and queue jobs there, and this process claims them, generates them and
+writes their text and status back.
+"""
+import os
+import threading
+
+from cache import ResponseCache, SemanticCache
+from embedding import make_embedder
+from jobstore import JOB_STORE, JobStore, StoreBridge
+from jobtools import JobRegister
+from registry import ModelRegistry
+from scheduler import FairScheduler
+
+
+def main() -> None:
+    """
+    Loads the default model and moves jobs between the job store and the models until the
+    process is stopped.
+
+    Raises:
+        ValueError: If JOB_STORE is not set.
+    """
+    if not JOB_STORE:
+        raise ValueError("JOB_STORE must be set to the database shared with the API processes.")
+    store = JobStore(JOB_STORE)
+    jobReg = JobRegister()
+    responseCache = ResponseCache.from_env()
+    semanticCache = SemanticCache.from_env()
+    embedder = make_embedder() if semanticCache is not None else None
+
+    models = ModelRegistry.from_env()
+    registry = ModelRegistry(
+        models,
+        default=os.getenv('DEFAULT_MODEL', 'default' if 'default' in models else next(iter(models), '')),
+        budget_bytes=int(os.getenv('MODEL_RAM_BUDGET', '0')),
+        make_queue=FairScheduler.from_env,
+        taskLock=threading.Lock(),
+        jobReg=jobReg,
+        responseCache=responseCache,
+        semanticCache=semanticCache
+    )
+    registry.load()
+
+    bridge = StoreBridge(store, registry, jobReg, responseCache, semanticCache, embedder)
+    bridge.start()
+    print(f"Inference process serving the jobs in {JOB_STORE}.")
+    bridge.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1362 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from uuid import uuid4
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+from cache import ResponseCache, SemanticCache, lookup_cache
+from jobtools import ChatJob, JobRegister, ThroughputTracker, text_bytes
+from registry import ModelRegistry
+from scheduler import PRIORITIES, FairScheduler
+from sessions import MAX_SESSIONS, SESSION_TTL, SESSIONS_MAX_BYTES, Session, pack
+
+# SQLite file shared by the API worker processes and the inference process; empty keeps
+# jobs and queues in the memory of a single process that also runs the models
+JOB_STORE = os.getenv('JOB_STORE', '')
+# Seconds between two rounds of the inference process claiming jobs and writing back their progress
+STORE_SYNC_INTERVAL = float(os.getenv('STORE_SYNC_INTERVAL', '0.05'))
+# Seconds between two reads of the store by an event stream
+STORE_STREAM_INTERVAL = float(os.getenv('STORE_STREAM_INTERVAL', '0.1'))
+# Seconds after which the inference process counts as down if it has not published its state
+STORE_STALE_SECONDS = float(os.getenv('STORE_STALE_SECONDS', '10'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    sys_prompt TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    params TEXT NOT NULL,
+    deadline REAL,
+    model TEXT,
+    client_id TEXT NOT NULL DEFAULT '',
+    priority TEXT NOT NULL DEFAULT 'interactive',
+    cost INTEGER NOT NULL DEFAULT 0,
+    dispatch TEXT NOT NULL DEFAULT 'held',
+    status TEXT NOT NULL,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_dispatch ON jobs (dispatch, model, priority);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at);
+CREATE TABLE IF NOT EXISTS chunks (
+    uuid TEXT NOT NULL,
+    cursor INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (uuid, cursor)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    sys_prompt TEXT NOT NULL,
+    model TEXT,
+    client_id TEXT NOT NULL,
+    history BLOB NOT NULL,
+    turns INTEGER NOT NULL DEFAULT 0,
+    pending TEXT,
+    size INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outcomes (
+    outcome TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals SELECT 'jobs', COUNT(*), COALESCE(SUM(size), 0) FROM jobs;
+INSERT OR IGNORE INTO totals SELECT 'sessions', COUNT(*), COALESCE(SUM(size), 0) FROM sessions;
+CREATE TRIGGER IF NOT EXISTS jobs_insert AFTER INSERT ON jobs BEGIN
+    UPDATE totals SET count = count + 1, size = size + NEW.size WHERE name = 'jobs';
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_delete AFTER DELETE ON jobs BEGIN
+    UPDATE totals SET count = count - 1, size = size - OLD.size WHERE name = 'jobs';
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_resize AFTER UPDATE OF size ON jobs BEGIN
+    UPDATE totals SET size = size + NEW.size - OLD.size WHERE name = 'jobs';
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_insert AFTER INSERT ON sessions BEGIN
+    UPDATE totals SET count = count + 1, size = size + NEW.size WHERE name = 'sessions';
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_delete AFTER DELETE ON sessions BEGIN
+    UPDATE totals SET count = count - 1, size = size - OLD.size WHERE name = 'sessions';
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_resize AFTER UPDATE OF size ON sessions BEGIN
+    UPDATE totals SET size = size + NEW.size - OLD.size WHERE name = 'sessions';
+END;
+"""
+
+
+class JobStore:
+    """
+    Chat jobs, their completions and the queue in an SQLite database in WAL mode, shared by
+    several processes: the API worker processes register, queue, poll and cancel jobs, and the
+    inference process claims the queued jobs and writes back their progress.
+
+    A job's "dispatch" is "held" while it is registered but not queued, "queued" while it waits
+    for the inference process and "claimed" once the inference process took it; a claimed job
+    counts towards the length of its model's queue until a worker starts it. Completions are
+    stored as runs of chunks keyed by the cursor before them, so cursors handed out to clients
+    stay valid. Triggers keep the number and bytes of the jobs and sessions in the "totals" table,
+    so admission does not aggregate the whole table.
+
+    Attributes:
+        path (str): The database file.
+        local (threading.local): The connection of each thread.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens the store, creating the database if necessary.
+
+        Args:
+            path (str): The database file.
+        """
+        self.path = path
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # In one transaction, so that processes starting together seed the totals once
+        self.connection().executescript(f"BEGIN IMMEDIATE;{SCHEMA}COMMIT;")
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the calling thread, opening it on first use.
+
+        Returns:
+            sqlite3.Connection: The connection, in autocommit mode.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Durable enough for jobs, which are lost on a crash anyway
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs statements in a write transaction, taking the write lock up front so that concurrent
+        writers wait instead of failing.
+
+        Yields:
+            sqlite3.Connection: The connection.
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def add_job(self, job: ChatJob, max_jobs: int, max_bytes: int) -> Tuple[bool, int]:
+        """
+        Registers a job, held until it is queued, evicting final jobs if the store is full.
+
+        Args:
+            job (ChatJob): The job, including any completion it already has.
+            max_jobs (int): The maximum number of stored jobs.
+            max_bytes (int): The maximum number of bytes retained by the stored jobs.
+
+        Returns:
+            Tuple[bool, int]: Whether the job was added, and the number of jobs evicted for it.
+        """
+        now = time.time()
+        deadline = now + job.deadline - time.monotonic() if job.deadline is not None else None
+        completion = job.get_completion()
+        with self.transaction() as connection:
+            count, retained = self.get_totals("jobs", connection)
+            evicted = 0
+            if count >= max_jobs or retained + job.get_size() > max_bytes:
+                final = connection.execute(
+                    f"SELECT uuid, size FROM jobs WHERE status IN ({','.join('?' * len(JobRegister.FINAL_STATUSES))}) "
+                    "ORDER BY updated_at", JobRegister.FINAL_STATUSES
+                ).fetchall()
+                for uuid, size in final:
+                    if count < max_jobs and retained + job.get_size() <= max_bytes:
+                        break
+                    self.delete_rows(connection, uuid)
+                    count, retained, evicted = count - 1, retained - size, evicted + 1
+                if count >= max_jobs or retained + job.get_size() > max_bytes:
+                    return False, evicted
+            connection.execute(
+                "INSERT INTO jobs (uuid, sys_prompt, messages, params, deadline, status, chunks, size, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.get_uuid(), job.get_sys_prompt(), json.dumps(job.get_messages()), json.dumps(job.get_params()),
+                 deadline, job.get_status(), job.count_chunks(), job.get_size(), now, now)
+            )
+            if completion:
+                connection.execute("INSERT INTO chunks (uuid, cursor, text) VALUES (?, 0, ?)", (job.get_uuid(), completion))
+            return True, evicted
+
+    @staticmethod
+    def delete_rows(connection: sqlite3.Connection, uuid: str) -> None:
+        """
+        Deletes a job and its completion.
+
+        Args:
+            connection (sqlite3.Connection): The connection, inside a transaction.
+            uuid (str): The UUID of the job.
+        """
+        connection.execute("DELETE FROM chunks WHERE uuid = ?", (uuid,))
+        connection.execute("DELETE FROM jobs WHERE uuid = ?", (uuid,))
+
+    def delete_job(self, uuid: str) -> None:
+        """
+        Deletes a job. A job the inference process is working on is cancelled by that.
+
+        Args:
+            uuid (str): The UUID of the job.
+        """
+        with self.transaction() as connection:
+            self.delete_rows(connection, uuid)
+
+    def get_row(self, uuid: str) -> Optional[sqlite3.Row]:
+        """
+        Reads a job.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            Optional[sqlite3.Row]: The job, or None if it is not stored.
+        """
+        return self.connection().execute("SELECT * FROM jobs WHERE uuid = ?", (uuid,)).fetchone()
+
+    def get_status(self, uuid: str) -> Tuple[str, bool, int]:
+        """
+        Reads the progress of a job.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            Tuple[str, bool, int]: The status ("" if the job is gone), whether it is cancelled and
+                its number of chunks.
+        """
+        row = self.connection().execute("SELECT status, cancelled, chunks FROM jobs WHERE uuid = ?", (uuid,)).fetchone()
+        return (row[0], bool(row[1]), row[2]) if row else ("", False, 0)
+
+    def get_completion_since(self, uuid: str, cursor: int) -> Tuple[str, int]:
+        """
+        Reads the text of a job stored after the given cursor.
+
+        Args:
+            uuid (str): The UUID of the job.
+            cursor (int): The number of chunks the caller has already received.
+
+        Returns:
+            Tuple[str, int]: The new text and the cursor to pass on the next call.
+        """
+        connection = self.connection()
+        # Read the count first, so that text stored in between is returned again next time
+        row = connection.execute("SELECT chunks FROM jobs WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None:
+            return "", 0
+        texts = connection.execute(
+            "SELECT text FROM chunks WHERE uuid = ? AND cursor >= ? AND cursor < ? ORDER BY cursor",
+            (uuid, max(cursor, 0), row[0])
+        ).fetchall()
+        return "".join(text for text, in texts), row[0]
+
+    def set_status(self, uuid: str, status: str) -> None:
+        """
+        Sets the status of a job.
+
+        Args:
+            uuid (str): The UUID of the job.
+            status (str): The new status.
+        """
+        with self.transaction() as connection:
+            connection.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE uuid = ?", (status, time.time(), uuid))
+
+    def cancel(self, uuid: str) -> None:
+        """
+        Asks the inference process to stop generating a job.
+
+        Args:
+            uuid (str): The UUID of the job.
+        """
+        with self.transaction() as connection:
+            connection.execute("UPDATE jobs SET cancelled = 1 WHERE uuid = ?", (uuid,))
+
+    def enqueue(self, uuid: str, model: str, client_id: str, priority: str, cost: int, maxsize: int) -> None:
+        """
+        Queues a held job for the inference process.
+
+        Args:
+            uuid (str): The UUID of the job.
+            model (str): The name of the model.
+            client_id (str): The client the job belongs to.
+            priority (str): The priority class.
+            cost (int): The cost used by shortest-prompt-first.
+            maxsize (int): The maximum number of jobs queued for the model; 0 means unbounded.
+
+        Raises:
+            queue.Full: If the model's queue is full.
+            ValueError: If the priority class is unknown.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        with self.transaction() as connection:
+            if maxsize > 0 and self.count_queued(model) >= maxsize:
+                raise queue.Full
+            connection.execute(
+                "UPDATE jobs SET dispatch = 'queued', model = ?, client_id = ?, priority = ?, cost = ? WHERE uuid = ?",
+                (model, client_id, priority, cost, uuid)
+            )
+
+    def remove_queued(self, uuid: str) -> bool:
+        """
+        Removes a job from the queue if the inference process has not claimed it yet.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            bool: True if the job was queued and has been removed.
+        """
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET dispatch = 'held', status = 'cancelled', cancelled = 1, updated_at = ? "
+                "WHERE uuid = ? AND dispatch = 'queued'", (time.time(), uuid)
+            ).rowcount > 0
+
+    def count_queued(self, model: Optional[str] = None, priorities: Tuple[str, ...] = PRIORITIES) -> int:
+        """
+        Counts the jobs waiting for a worker: those not claimed yet, and those the inference process
+        claimed into the scheduler of their model but has not started.
+
+        Args:
+            model (Optional[str]): Counts only the jobs of this model.
+            priorities (Tuple[str, ...]): Counts only the jobs of these priority classes.
+
+        Returns:
+            int: The number of queued jobs.
+        """
+        query = ("SELECT COUNT(*) FROM jobs WHERE dispatch IN ('queued', 'claimed') AND status = 'created' "
+                 f"AND priority IN ({','.join('?' * len(priorities))})")
+        args: List[Any] = list(priorities)
+        if model is not None:
+            query += " AND model = ?"
+            args.append(model)
+        return self.connection().execute(query, args).fetchone()[0]
+
+    def claim(self) -> List[sqlite3.Row]:
+        """
+        Takes all queued jobs for the inference process, oldest first. The write lock is only
+        taken if a read finds queued jobs.
+
+        Returns:
+            List[sqlite3.Row]: The claimed jobs.
+        """
+        if self.connection().execute("SELECT 1 FROM jobs WHERE dispatch = 'queued' LIMIT 1").fetchone() is None:
+            return []
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT * FROM jobs WHERE dispatch = 'queued' ORDER BY created_at").fetchall()
+            if rows:
+                connection.execute("UPDATE jobs SET dispatch = 'claimed' WHERE dispatch = 'queued'")
+            return rows
+
+    def sync(self, updates: List[Tuple[str, int, str, int, str]]) -> List[str]:
+        """
+        Writes back the progress of the jobs the inference process is working on.
+
+        Args:
+            updates (List[Tuple[str, int, str, int, str]]): Per job its UUID, the cursor before the new
+                text, the new text, the cursor after it and the status.
+
+        Returns:
+            List[str]: The UUIDs of the updated jobs that were cancelled or deleted by a client.
+        """
+        if not updates:
+            return []
+        now = time.time()
+        with self.transaction() as connection:
+            gone = []
+            for uuid, start, text, end, status in updates:
+                if text:
+                    connection.execute("INSERT OR REPLACE INTO chunks (uuid, cursor, text) VALUES (?, ?, ?)", (uuid, start, text))
+                changed = connection.execute(
+                    "UPDATE jobs SET chunks = ?, status = ?, size = size + ?, updated_at = ? WHERE uuid = ?",
+                    (end, status, text_bytes(text), now, uuid)
+                ).rowcount
+                if not changed:
+                    connection.execute("DELETE FROM chunks WHERE uuid = ?", (uuid,))
+                    gone.append(uuid)
+            return gone
+
+    def cancelled(self, uuids: List[str]) -> List[str]:
+        """
+        Finds the jobs that were cancelled or deleted by a client.
+
+        Args:
+            uuids (List[str]): The UUIDs of the jobs to check.
+
+        Returns:
+            List[str]: The cancelled or deleted ones.
+        """
+        if not uuids:
+            return []
+        connection = self.connection()
+        alive = set()
+        for start in range(0, len(uuids), 500):
+            batch = uuids[start:start + 500]
+            alive.update(uuid for uuid, in connection.execute(
+                f"SELECT uuid FROM jobs WHERE cancelled = 0 AND uuid IN ({','.join('?' * len(batch))})", batch
+            ))
+        return [uuid for uuid in uuids if uuid not in alive]
+
+    def fail_claimed(self, error: str) -> int:
+        """
+        Fails the jobs claimed by an inference process that has exited before finishing them.
+
+        Args:
+            error (str): The text appended to their completions.
+
+        Returns:
+            int: The number of failed jobs.
+        """
+        final = JobRegister.FINAL_STATUSES
+        with self.transaction() as connection:
+            rows = connection.execute(
+                f"SELECT uuid, chunks FROM jobs WHERE dispatch = 'claimed' AND status NOT IN ({','.join('?' * len(final))})", final
+            ).fetchall()
+            for uuid, chunks in rows:
+                connection.execute("INSERT OR REPLACE INTO chunks (uuid, cursor, text) VALUES (?, ?, ?)", (uuid, chunks, error))
+                connection.execute("UPDATE jobs SET chunks = chunks + 1, status = 'failed', updated_at = ? WHERE uuid = ?",
+                                   (time.time(), uuid))
+            return len(rows)
+
+    def reap(self, ttl: float) -> int:
+        """
+        Deletes the final jobs that have not changed for the time to live, and the held jobs as old,
+        which an API process registered but never queued because it exited in between.
+
+        Args:
+            ttl (float): Seconds a final or held job is kept after its last change.
+
+        Returns:
+            int: The number of deleted jobs.
+        """
+        final = JobRegister.FINAL_STATUSES
+        with self.transaction() as connection:
+            uuids = [uuid for uuid, in connection.execute(
+                f"SELECT uuid FROM jobs WHERE updated_at < ? AND (dispatch = 'held' OR status IN ({','.join('?' * len(final))}))",
+                (time.time() - ttl, *final)
+            )]
+            for uuid in uuids:
+                self.delete_rows(connection, uuid)
+            return len(uuids)
+
+    def get_totals(self, name: str = "jobs", connection: Optional[sqlite3.Connection] = None) -> Tuple[int, int]:
+        """
+        Reads the number of stored jobs or sessions and the bytes they retain.
+
+        Args:
+            name (str): "jobs" or "sessions".
+            connection (Optional[sqlite3.Connection]): The connection of a running transaction, if any.
+
+        Returns:
+            Tuple[int, int]: The number of rows and the retained bytes.
+        """
+        connection = connection or self.connection()
+        return tuple(connection.execute("SELECT count, size FROM totals WHERE name = ?", (name,)).fetchone())
+
+    def get_meta(self, key: str) -> Optional[str]:
+        """
+        Reads a value published by a process.
+
+        Args:
+            key (str): The key.
+
+        Returns:
+            Optional[str]: The value, or None if it was never published.
+        """
+        row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, values: Dict[str, str], outcomes: Optional[Dict[str, int]] = None) -> None:
+        """
+        Publishes values for the other processes.
+
+        Args:
+            values (Dict[str, str]): The values by key.
+            outcomes (Optional[Dict[str, int]]): Job outcomes to count in the same transaction.
+        """
+        with self.transaction() as connection:
+            connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", values.items())
+            if outcomes:
+                self.count_outcomes(outcomes, connection)
+
+    def count_outcomes(self, outcomes: Dict[str, int], connection: Optional[sqlite3.Connection] = None) -> None:
+        """
+        Adds to the counts of job outcomes, which every process records here so that /metrics
+        reports those of all processes.
+
+        Args:
+            outcomes (Dict[str, int]): The number of jobs by outcome.
+            connection (Optional[sqlite3.Connection]): The connection of a running transaction, if any.
+        """
+        if connection is None:
+            with self.transaction() as connection:
+                self.count_outcomes(outcomes, connection)
+            return
+        connection.executemany(
+            "INSERT INTO outcomes (outcome, count) VALUES (?, ?) "
+            "ON CONFLICT (outcome) DO UPDATE SET count = count + excluded.count", outcomes.items()
+        )
+
+    def get_outcomes(self) -> Dict[str, int]:
+        """
+        Reads the counts of job outcomes of all processes.
+
+        Returns:
+            Dict[str, int]: The number of jobs by outcome.
+        """
+        return dict(self.connection().execute("SELECT outcome, count FROM outcomes").fetchall())
+
+
+class StoredJob(ChatJob):
+    """
+    A chat job as seen by an API worker process: its prompt is loaded from the job store, and its
+    status and completion are read from the store on every access, as the inference process
+    writes them there.
+
+    Attributes:
+        store (JobStore): The job store.
+        pollers (Dict[int, asyncio.Task]): The tasks feeding the event queues of streaming clients.
+    """
+
+    def __init__(self, store: JobStore, row: sqlite3.Row):
+        """
+        Initializes the StoredJob from its row.
+
+        Args:
+            store (JobStore): The job store.
+            row (sqlite3.Row): The row of the job.
+        """
+        super().__init__(row["sys_prompt"], json.loads(row["messages"]), json.loads(row["params"]))
+        self.uuid = row["uuid"]
+        self.status = row["status"]
+        self.store = store
+        self.pollers: Dict[int, asyncio.Task] = {}
+
+    def get_status(self) -> str:
+        """
+        Reads the status of the job; empty once the job is deleted.
+        """
+        return self.store.get_status(self.uuid)[0]
+
+    def set_status(self, status: str) -> None:
+        """
+        Writes the status of the job.
+        """
+        self.store.set_status(self.uuid, status)
+
+    def cancel(self) -> None:
+        """
+        Asks the inference process to stop generating the job.
+        """
+        self.store.cancel(self.uuid)
+
+    def is_cancelled(self) -> bool:
+        """
+        Reads whether a client cancelled the job.
+        """
+        return self.store.get_status(self.uuid)[1]
+
+    def count_chunks(self) -> int:
+        """
+        Reads the number of chunks generated so far.
+        """
+        return self.store.get_status(self.uuid)[2]
+
+    def get_completion(self) -> str:
+        """
+        Reads the completion.
+        """
+        return self.store.get_completion_since(self.uuid, 0)[0]
+
+    def get_completion_since(self, cursor: int) -> Tuple[str, int]:
+        """
+        Reads the text stored after the given cursor and the cursor to pass on the next call.
+        """
+        return self.store.get_completion_since(self.uuid, cursor)
+
+    def read_progress(self, cursor: int) -> Tuple[str, str, int]:
+        """
+        Reads the status and the text stored after the given cursor.
+
+        Args:
+            cursor (int): The number of chunks the caller has already received.
+
+        Returns:
+            Tuple[str, str, int]: The status, the new text and the cursor to pass on the next call.
+        """
+        # Read the status first so a final status never precedes missing text
+        status = self.get_status()
+        text, cursor = self.get_completion_since(cursor)
+        return status, text, cursor
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop, cursor: int = 0) -> asyncio.Queue:
+        """
+        Registers a new subscriber for the job's chunk and status events, which are read from the
+        store every STORE_STREAM_INTERVAL seconds.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The event loop the returned queue is consumed on.
+            cursor (int): The number of chunks the subscriber has already received.
+
+        Returns:
+            asyncio.Queue: A queue receiving (event, payload) tuples.
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        self.pollers[id(events)] = loop.create_task(self.poll(events, cursor))
+        return events
+
+    def unsubscribe(self, events: asyncio.Queue) -> None:
+        """
+        Stops feeding a subscriber queue previously returned by subscribe().
+
+        Args:
+            events (asyncio.Queue): The queue to remove.
+        """
+        poller = self.pollers.pop(id(events), None)
+        if poller is not None:
+            poller.cancel()
+
+    async def poll(self, events: asyncio.Queue, cursor: int) -> None:
+        """
+        Feeds a subscriber queue with the new text and status changes until the job ends.
+
+        Args:
+            events (asyncio.Queue): The subscriber queue.
+            cursor (int): The number of chunks the subscriber has already received.
+        """
+        last_status = None
+        loop = asyncio.get_running_loop()
+        while True:
+            # The reads may wait for the write lock of another process, so they run off the event loop
+            status, text, cursor = await loop.run_in_executor(None, self.read_progress, cursor)
+            if text:
+                events.put_nowait(("chunk", (text, cursor)))
+            if status and status != last_status:
+                events.put_nowait(("status", status))
+                last_status = status
+            if not status or status in JobRegister.FINAL_STATUSES:
+                return
+            await asyncio.sleep(STORE_STREAM_INTERVAL)
+
+
+class StoreJobRegister:
+    """
+    The JobRegister of an API worker process: jobs live in the job store shared with the other
+    processes. Eviction counters are kept per process.
+
+    Attributes:
+        store (JobStore): The job store.
+        ttl (float): Seconds a job in a final state is kept after its last status change.
+        max_jobs (int): The maximum number of stored jobs.
+        max_bytes (int): The maximum number of bytes retained by the stored jobs.
+        evicted_expired (int): The number of jobs this process removed because their time to live passed.
+        evicted_capacity (int): The number of jobs this process removed to make room for new ones.
+        rejected (int): The number of jobs this process refused because the store was full.
+    """
+
+    FINAL_STATUSES = JobRegister.FINAL_STATUSES
+
+    def __init__(self, store: JobStore, ttl: Optional[float] = None, max_jobs: Optional[int] = None,
+                 max_bytes: Optional[int] = None):
+        """
+        Initializes the StoreJobRegister.
+
+        Args:
+            store (JobStore): The job store.
+            ttl (Optional[float]): Seconds to keep final jobs. Defaults to JOB_TTL.
+            max_jobs (Optional[int]): The maximum number of jobs. Defaults to MAX_JOBS.
+            max_bytes (Optional[int]): The maximum retained bytes. Defaults to MAX_JOB_BYTES.
+        """
+        self.store = store
+        self.ttl = ttl if ttl is not None else float(os.getenv('JOB_TTL', '3600'))
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.getenv('MAX_JOBS', '10000'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('MAX_JOB_BYTES', str(1024 ** 3)))
+        self.evicted_expired = 0
+        self.evicted_capacity = 0
+        self.rejected = 0
+
+    def add_job(self, job: ChatJob) -> bool:
+        """
+        Stores a new job, evicting final jobs if the store is full.
+
+        Args:
+            job (ChatJob): The job instance to add.
+
+        Returns:
+            bool: True if the job was added, False if the store is full.
+        """
+        added, evicted = self.store.add_job(job, self.max_jobs, self.max_bytes)
+        self.evicted_capacity += evicted
+        if not added:
+            self.rejected += 1
+        return added
+
+    def get_job(self, uuid: str) -> Optional[StoredJob]:
+        """
+        Loads a job from the store.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            Optional[StoredJob]: The job if found, otherwise None.
+        """
+        row = self.store.get_row(uuid)
+        return StoredJob(self.store, row) if row is not None else None
+
+    def delete_job(self, uuid: str) -> None:
+        """
+        Deletes a job from the store.
+
+        Args:
+            uuid (str): The UUID of the job to delete.
+        """
+        self.store.delete_job(uuid)
+
+    def reap(self) -> int:
+        """
+        Removes the final jobs whose time to live has passed, and the jobs that have been held
+        as long without being queued.
+
+        Returns:
+            int: The number of removed jobs.
+        """
+        removed = self.store.reap(self.ttl)
+        self.evicted_expired += removed
+        return removed
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size of the store and this process's eviction counters.
+
+        Returns:
+            Dict[str, int]: The number of jobs, retained bytes and eviction counters.
+        """
+        jobs, retained = self.store.get_totals()
+        return {
+            "jobs": jobs,
+            "retained_bytes": retained,
+            "evicted_expired": self.evicted_expired,
+            "evicted_capacity": self.evicted_capacity,
+            "rejected": self.rejected
+        }
+
+
+class StoreSessionStore:
+    """
+    The SessionStore of an API worker process: sessions live in the job store, so any worker
+    can continue a conversation. The eviction counter is kept per process.
+
+    Attributes:
+        store (JobStore): The job store.
+        ttl (float): Seconds a session is kept after its last change.
+        max_sessions (int): The maximum number of sessions.
+        max_bytes (int): The maximum number of bytes retained by all sessions.
+        evicted (int): The number of sessions this process evicted to make room.
+    """
+
+    def __init__(self, store: JobStore, ttl: float = SESSION_TTL, max_sessions: int = MAX_SESSIONS,
+                 max_bytes: int = SESSIONS_MAX_BYTES):
+        """
+        Initializes the StoreSessionStore.
+
+        Args:
+            store (JobStore): The job store.
+            ttl (float): Seconds a session is kept after its last change.
+            max_sessions (int): The maximum number of sessions.
+            max_bytes (int): The maximum number of bytes retained by all sessions.
+        """
+        self.store = store
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.evicted = 0
+
+    def make_room(self, connection: sqlite3.Connection, size: int, count: int, keep: Optional[str] = None) -> bool:
+        """
+        Evicts the least recently used sessions without a running turn until the given bytes
+        and number of new sessions fit.
+
+        Args:
+            connection (sqlite3.Connection): The connection, inside a transaction.
+            size (int): The bytes needed.
+            count (int): The number of sessions added.
+            keep (Optional[str]): The id of a session that must not be evicted.
+
+        Returns:
+            bool: True if they fit.
+        """
+        sessions, retained = self.store.get_totals("sessions", connection)
+        if sessions + count <= self.max_sessions and retained + size <= self.max_bytes:
+            return True
+        idle = connection.execute(
+            "SELECT session_id, size FROM sessions WHERE pending IS NULL AND session_id != ? ORDER BY updated_at",
+            (keep or "",)
+        ).fetchall()
+        for session_id, session_size in idle:
+            if sessions + count <= self.max_sessions and retained + size <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            sessions, retained = sessions - 1, retained - session_size
+            self.evicted += 1
+        return sessions + count <= self.max_sessions and retained + size <= self.max_bytes
+
+    def create(self, sys_prompt: str, model: Optional[str], client_id: str) -> Optional[Session]:
+        """
+        Creates an empty session.
+
+        Args:
+            sys_prompt (str): The system prompt.
+            model (Optional[str]): The model; None for the default model.
+            client_id (str): The client the session's jobs are scheduled for.
+
+        Returns:
+            Optional[Session]: The session, or None if the store is full.
+        """
+        session = Session(uuid4().hex, sys_prompt, model, client_id, pack([]))
+        with self.store.transaction() as connection:
+            if not self.make_room(connection, session.get_size(), 1):
+                return None
+            connection.execute(
+                "INSERT INTO sessions (session_id, sys_prompt, model, client_id, history, size, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session.session_id, sys_prompt, model, client_id, session.history, session.get_size(), session.updated_at)
+            )
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """
+        Loads a session.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            Optional[Session]: A snapshot of the session, or None if it does not exist.
+        """
+        row = self.store.connection().execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        return Session(row["session_id"], row["sys_prompt"], row["model"], row["client_id"], bytes(row["history"]),
+                       row["turns"], row["pending"], row["updated_at"])
+
+    def update(self, session_id: str, expected: Optional[str], messages: List[str], pending: Optional[str],
+               new_turn: bool = False) -> bool:
+        """
+        Replaces the history and pending job of a session, unless another request changed its
+        pending job in the meantime. Idle sessions are evicted if the history grows beyond the limit.
+
+        Args:
+            session_id (str): The id of the session.
+            expected (Optional[str]): The pending job the caller saw.
+            messages (List[str]): The new messages.
+            pending (Optional[str]): The new pending job.
+            new_turn (bool): Whether the update starts a turn.
+
+        Returns:
+            bool: True if the session was updated.
+        """
+        history = pack(messages)
+        with self.store.transaction() as connection:
+            row = connection.execute("SELECT sys_prompt, pending, size FROM sessions WHERE session_id = ?",
+                                     (session_id,)).fetchone()
+            if row is None or row["pending"] != expected:
+                return False
+            size = len(row["sys_prompt"]) + len(history)
+            if size > row["size"]:
+                self.make_room(connection, size - row["size"], 0, session_id)
+            connection.execute(
+                "UPDATE sessions SET history = ?, pending = ?, size = ?, turns = turns + ?, updated_at = ? "
+                "WHERE session_id = ?",
+                (history, pending, size, 1 if new_turn else 0, time.time(), session_id)
+            )
+            return True
+
+    def delete(self, session_id: str) -> bool:
+        """
+        Deletes a session.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            bool: True if the session existed.
+        """
+        with self.store.transaction() as connection:
+            return connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    def reap(self) -> int:
+        """
+        Removes the sessions whose time to live has passed, keeping those with a turn in progress
+        for up to twice the time to live.
+
+        Returns:
+            int: The number of removed sessions.
+        """
+        now = time.time()
+        with self.store.transaction() as connection:
+            return connection.execute(
+                "DELETE FROM sessions WHERE updated_at < ? AND (pending IS NULL OR updated_at < ?)",
+                (now - self.ttl, now - 2 * self.ttl)
+            ).rowcount
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the number of sessions, the bytes they retain and this process's eviction counter.
+
+        Returns:
+            Dict[str, int]: The statistics of the store.
+        """
+        sessions, retained = self.store.get_totals("sessions")
+        return {"sessions": sessions, "retained_bytes": retained, "evicted": self.evicted}
+
+
+class StoreQueue:
+    """
+    The task queue of a model as seen by an API worker process: queued jobs are marked in the
+    job store and scheduled by the inference process.
+
+    Attributes:
+        store (JobStore): The job store.
+        model (str): The name of the model.
+        maxsize (int): The maximum number of queued jobs; 0 means unbounded.
+        shortest_first (bool): Whether the inference process orders a client's jobs by prompt cost.
+    """
+
+    def __init__(self, store: JobStore, model: str, maxsize: int, shortest_first: bool):
+        """
+        Initializes the StoreQueue.
+
+        Args:
+            store (JobStore): The job store.
+            model (str): The name of the model.
+            maxsize (int): The maximum number of queued jobs; 0 means unbounded.
+            shortest_first (bool): Whether prompt costs are used.
+        """
+        self.store = store
+        self.model = model
+        self.maxsize = maxsize
+        self.shortest_first = shortest_first
+
+    def qsize(self) -> int:
+        """
+        Returns the number of jobs of the model waiting for a worker.
+        """
+        return self.store.count_queued(self.model)
+
+    def ahead(self, priority: str) -> int:
+        """
+        Returns the number of queued jobs a new job of the given priority would have to wait for.
+
+        Args:
+            priority (str): The priority class of the new job.
+        """
+        return self.store.count_queued(self.model, PRIORITIES[:PRIORITIES.index(priority) + 1])
+
+    def put_nowait(self, uuid: str, client_id: str = "", priority: str = "interactive", cost: int = 0) -> None:
+        """
+        Queues a stored job.
+
+        Args:
+            uuid (str): The UUID of the job.
+            client_id (str): The client the job belongs to.
+            priority (str): The priority class, one of PRIORITIES.
+            cost (int): The cost used by shortest-prompt-first.
+
+        Raises:
+            queue.Full: If the queue is full.
+            ValueError: If the priority class is unknown.
+        """
+        self.store.enqueue(uuid, self.model, client_id, priority, cost, self.maxsize)
+
+    def remove(self, uuid: str) -> bool:
+        """
+        Removes a job the inference process has not claimed yet and marks it cancelled.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            bool: True if the job was queued and has been removed.
+        """
+        return self.store.remove_queued(uuid)
+
+
+class StoreEntry:
+    """
+    A model as seen by an API worker process, with the state the inference process published.
+
+    Attributes:
+        name (str): The name clients select the model by.
+        queue (StoreQueue): The jobs waiting for this model.
+        tracker (ThroughputTracker): The recent jobs of the model, copied from the inference process.
+        loader (None): Models are not loaded in API worker processes.
+        status (Dict[str, Any]): The published state of the model.
+    """
+
+    def __init__(self, name: str, queue: StoreQueue):
+        """
+        Initializes the StoreEntry with an unknown state.
+
+        Args:
+            name (str): The name of the model.
+            queue (StoreQueue): The queue of the model.
+        """
+        self.name = name
+        self.queue = queue
+        self.tracker = ThroughputTracker()
+        self.loader = None
+        self.status: Dict[str, Any] = {"state": "unavailable"}
+
+    def get_state(self) -> str:
+        """
+        Retrieves the loading state of the model in the inference process.
+
+        Returns:
+            str: The state, or "unavailable" if the inference process is down.
+        """
+        return self.status.get("state", "unavailable")
+
+    def is_ready(self) -> bool:
+        """
+        Checks whether the inference process can serve jobs of the model.
+
+        Returns:
+            bool: True if the model is ready, or will be loaded again on the next job.
+        """
+        return bool(self.status.get("ready"))
+
+
+class StoreRegistry:
+    """
+    The ModelRegistry of an API worker process: jobs are queued in the job store, and the state
+    of the models is read from what the inference process publishes there.
+
+    Attributes:
+        store (JobStore): The job store.
+        entries (Dict[str, StoreEntry]): The declared models by name.
+        default (str): The name of the model used when a request names none.
+        status (Dict[str, Any]): The registry state last published by the inference process.
+        refreshed (float): The monotonic time the state was last read.
+        lock (threading.Lock): Guards the refresh.
+    """
+
+    def __init__(self, store: JobStore, models: Dict[str, Dict[str, Any]], default: str):
+        """
+        Initializes the registry with the declared models.
+
+        Args:
+            store (JobStore): The job store.
+            models (Dict[str, Dict[str, Any]]): The model specifications by name.
+            default (str): The name of the default model.
+
+        Raises:
+            ValueError: If the default model is not declared.
+        """
+        if default not in models:
+            raise ValueError(f"Default model {default} is not declared.")
+        template = FairScheduler.from_env()
+        self.store = store
+        self.entries = {
+            name: StoreEntry(name, StoreQueue(store, name, template.maxsize, template.shortest_first))
+            for name in models
+        }
+        self.default = default
+        self.status: Dict[str, Any] = {}
+        self.refreshed = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """
+        Reads the state published by the inference process, at most once per second.
+        """
+        with self.lock:
+            if time.monotonic() - self.refreshed < 1:
+                return
+            self.refreshed = time.monotonic()
+            published = self.store.get_meta("status")
+            status = json.loads(published) if published else {}
+            if time.time() - status.get("published_at", 0) > STORE_STALE_SECONDS:
+                status = {}
+            self.status = status
+            models = status.get("models", {})
+            for name, entry in self.entries.items():
+                entry.status = models.get(name, {"state": "unavailable"})
+                entry.tracker.samples = deque(map(tuple, entry.status.get("samples", [])), maxlen=entry.tracker.samples.maxlen)
+
+    def get_entry(self, name: Optional[str] = None) -> StoreEntry:
+        """
+        Retrieves a declared model.
+
+        Args:
+            name (Optional[str]): The name of the model; None selects the default model.
+
+        Returns:
+            StoreEntry: The model.
+
+        Raises:
+            KeyError: If the model is not declared.
+        """
+        self.refresh()
+        return self.entries[name or self.default]
+
+    def submit(self, name: Optional[str], uuid: str, client_id: str, priority: str, cost: int) -> StoreEntry:
+        """
+        Queues a stored job for a model.
+
+        Args:
+            name (Optional[str]): The name of the model; None selects the default model.
+            uuid (str): The UUID of the job.
+            client_id (str): The client the job belongs to.
+            priority (str): The priority class.
+            cost (int): The cost used by shortest-prompt-first.
+
+        Returns:
+            StoreEntry: The model.
+
+        Raises:
+            queue.Full: If the model's queue is full.
+        """
+        entry = self.get_entry(name)
+        entry.queue.put_nowait(uuid, client_id, priority, cost)
+        return entry
+
+    def remove(self, uuid: str) -> bool:
+        """
+        Removes a job the inference process has not claimed yet.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            bool: True if the job was queued and has been removed.
+        """
+        return self.store.remove_queued(uuid)
+
+    def qsize(self) -> int:
+        """
+        Returns the number of jobs of all models waiting for a worker.
+        """
+        return self.store.count_queued()
+
+    def get_status(self) -> Dict[str, Any]:
+        """
+        Retrieves the state of every declared model as published by the inference process.
+
+        Returns:
+            Dict[str, Any]: The published state, with every model "unavailable" if the inference
+                process is down.
+        """
+        self.refresh()
+        if not self.status:
+            return {"default": self.default, "models": {name: {"state": "unavailable"} for name in self.entries}}
+        status = {key: value for key, value in self.status.items() if key != "published_at"}
+        status["models"] = {
+            name: {key: value for key, value in model.items() if key != "samples"}
+            for name, model in status.get("models", {}).items()
+        }
+        return status
+
+
+class StoreBridge(threading.Thread):
+    """
+    A thread of the inference process that moves jobs between the job store and the models:
+    it claims queued jobs, answers them from the caches or submits them to the model registry,
+    writes their text and status back, passes on cancellations and publishes the state of the
+    models and the metrics.
+
+    Attributes:
+        store (JobStore): The job store.
+        registry (ModelRegistry): The models of this process.
+        jobReg (JobRegister): The jobs this process is working on.
+        responseCache (Optional[ResponseCache]): Answers deterministic requests.
+        semanticCache (Optional[SemanticCache]): Answers single-turn questions.
+        embedder (Any): Embeds questions for the semantic cache.
+        active (Dict[str, Tuple[ChatJob, int, str]]): The jobs being worked on, with the number of
+            chunks and the status already written back.
+        published (float): The monotonic time the state was last published.
+        written (float): The monotonic time the state was last written to the store.
+        last_state (Tuple[str, str]): The status and metrics last written, to skip unchanged ones.
+    """
+
+    def __init__(self, store: JobStore, registry: ModelRegistry, jobReg: JobRegister,
+                 responseCache: Optional[ResponseCache] = None, semanticCache: Optional[SemanticCache] = None,
+                 embedder: Any = None):
+        """
+        Initializes the StoreBridge.
+
+        Args:
+            store (JobStore): The job store.
+            registry (ModelRegistry): The models of this process.
+            jobReg (JobRegister): The register the workers look jobs up in.
+            responseCache (Optional[ResponseCache]): The exact-match cache, if enabled.
+            semanticCache (Optional[SemanticCache]): The similarity cache, if enabled.
+            embedder (Any): Embeds questions for the semantic cache.
+        """
+        super().__init__(daemon=True)
+        self.store = store
+        self.registry = registry
+        self.jobReg = jobReg
+        self.responseCache = responseCache
+        self.semanticCache = semanticCache
+        self.embedder = embedder
+        self.active: Dict[str, Tuple[ChatJob, int, str]] = {}
+        self.published = 0.0
+        self.written = 0.0
+        self.last_state = ("", "")
+
+    def run(self):
+        """
+        Claims, syncs and publishes every STORE_SYNC_INTERVAL seconds.
+        """
+        failed = self.store.fail_claimed(os.getenv('CHATERROR', 'An error occurred.'))
+        if failed:
+            print(f"Failed {failed} job(s) left unfinished by the previous inference process.")
+        while True:
+            try:
+                for row in self.store.claim():
+                    self.admit(row)
+                self.sync()
+                if time.monotonic() - self.published >= 1:
+                    self.publish()
+            except sqlite3.Error as e:
+                print(f"Error while syncing the job store: {e}")
+            time.sleep(STORE_SYNC_INTERVAL)
+
+    def admit(self, row: sqlite3.Row) -> None:
+        """
+        Starts working on a claimed job: answers it from the caches or submits it to its model.
+        A job that cannot be submitted fails.
+
+        Args:
+            row (sqlite3.Row): The claimed job.
+        """
+        timeout = row["deadline"] - time.time() if row["deadline"] is not None else None
+        job = ChatJob(row["sys_prompt"], json.loads(row["messages"]), json.loads(row["params"]), timeout)
+        job.uuid = row["uuid"]
+        # Count the waiting time in the store as queue wait
+        job.created_at -= max(0.0, time.time() - row["created_at"])
+        self.active[job.get_uuid()] = (job, 0, row["status"])
+        if row["cancelled"]:
+            job.set_status("cancelled")
+            return
+
+        try:
+            entry = self.registry.get_entry(row["model"])
+        except KeyError:
+            self.fail(job, f"Unknown model: {row['model']}")
+            return
+        completion = lookup_cache(job, os.path.basename(entry.handler.filename),
+                                  self.responseCache, self.semanticCache, self.embedder)
+        if completion is not None:
+            job.append_chunk(completion)
+            job.set_status("finished")
+            metrics.JOBS.inc(outcome="cached")
+            return
+
+        if not self.jobReg.add_job(job):
+            self.fail(job, "Too many jobs registered.")
+            return
+        try:
+            self.registry.submit(entry.name, job.get_uuid(), row["client_id"], row["priority"], row["cost"])
+        except queue.Full:
+            self.jobReg.delete_job(job.get_uuid())
+            self.fail(job, "Queue is full.")
+
+    def fail(self, job: ChatJob, reason: str) -> None:
+        """
+        Fails a job that cannot be processed.
+
+        Args:
+            job (ChatJob): The job.
+            reason (str): The reason, which is logged.
+        """
+        print(f"Job {job.get_uuid()} failed: {reason}")
+        job.append_chunk(os.getenv('CHATERROR', 'An error occurred.'))
+        job.set_status("failed")
+        metrics.JOBS.inc(outcome="rejected")
+
+    def sync(self) -> None:
+        """
+        Writes back the new text and status of the active jobs that changed, stops the jobs
+        clients cancelled or deleted and forgets the jobs that ended.
+        """
+        updates = []
+        progress = {}
+        for uuid, (job, cursor, written) in self.active.items():
+            # Read the status first so a final status never precedes missing text
+            status = job.get_status()
+            text, end = job.get_completion_since(cursor)
+            progress[uuid] = (end, status)
+            if end != cursor or status != written:
+                updates.append((uuid, cursor, text, end, status))
+        gone = set(self.store.sync(updates)) | set(self.store.cancelled(list(self.active)))
+        for uuid, (end, status) in progress.items():
+            job = self.active[uuid][0]
+            if uuid in gone and not job.is_cancelled():
+                job.cancel()
+                if self.registry.remove(uuid):
+                    job.set_status("cancelled")
+                    metrics.JOBS.inc(outcome="cancelled")
+            if status in JobRegister.FINAL_STATUSES:
+                del self.active[uuid]
+                self.jobReg.delete_job(uuid)
+            else:
+                self.active[uuid] = (job, end, status)
+
+    def publish(self) -> None:
+        """
+        Publishes the state of the models, their recent throughput and the metrics of this process.
+        Unchanged state is only written again when the other processes would otherwise count
+        this one as down.
+        """
+        status = self.registry.get_status()
+        for name, entry in self.registry.entries.items():
+            status["models"][name]["ready"] = entry.is_ready()
+            status["models"][name]["samples"] = list(entry.tracker.samples)
+        metrics.sample(self.registry, self.jobReg)
+        # Job outcomes are counted in the store, where the API worker processes add theirs
+        state = (json.dumps(status), metrics.render(skip=[metrics.JOBS]))
+        outcomes = {key[0]: int(count) for key, count in metrics.JOBS.take().items()}
+        self.published = time.monotonic()
+        if not outcomes and state == self.last_state and self.published - self.written < STORE_STALE_SECONDS / 2:
+            return
+        status["published_at"] = time.time()
+        try:
+            self.store.set_meta({"status": json.dumps(status), "metrics": state[1]}, outcomes)
+        except sqlite3.Error:
+            for outcome, count in outcomes.items():
+                metrics.JOBS.inc(count, outcome=outcome)
+            raise
+        self.written = self.published
+        self.last_state = state
@@ -1,6 +1,25 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
 from uuid import uuid4
-from typing import List, Dict, Optional
-from threading import RLock
+from typing import Any, Callable, Deque, List, Dict, Optional, Tuple
+from threading import Lock, RLock
+
+
+def text_bytes(text: str) -> int:
+    """
+    Counts the bytes a text takes in UTF-8.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The number of bytes.
+    """
+    return len(text.encode("utf-8"))
+
 
 class ChatJob:
     """
@@ -11,38 +30,75 @@ class ChatJob:
         messages (List[str]): A list of chat messages exchanged during the interaction.
         uuid (str): A unique identifier for the chat job.
         status (str): The current status of the chat job.
-        completion (str): The ongoing or accumulated completion text.
+        chunks (List[str]): Append-only buffer of the streamed completion chunks. The number of
+            chunks serves as the cursor for incremental retrieval.
+        subscribers (List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]): Event queues of clients
+            streaming this job, together with the event loop each queue belongs to.
+        lock (RLock): A reentrant lock guarding the chunks and the subscribers.
+        cancelled (bool): Whether the client requested the generation to stop.
+        params (Dict[str, Any]): Sampling parameters passed on to the chat completion, such as
+            temperature, seed, max_tokens and stop.
+        deadline (Optional[float]): The monotonic time by which the job must be finished, if any.
+        cache_key (Optional[str]): The response cache key, if the completion may be cached.
+        semantic_key (Optional[Tuple[str, Any]]): The semantic cache namespace and question embedding,
+            if the completion may be cached.
+        size (int): The number of UTF-8 bytes of text retained by the job.
+        on_resize (Optional[Callable[[int], None]]): Called with the change in size when a chunk is
+            appended, so that the register holding the job can keep its total current.
+        updated_at (float): The monotonic time of the last status change.
+        created_at (float): The monotonic time the job was created.
     """
 
-    def __init__(self, sys_prompt: str, messages: List[str]):
+    def __init__(self, sys_prompt: str, messages: List[str], params: Optional[Dict[str, Any]] = None,
+                 timeout: Optional[float] = None):
         """
         Initializes a ChatJob instance with a system prompt and messages.
 
         Args:
             sys_prompt (str): The system prompt guiding the chat.
             messages (List[str]): Initial chat messages.
+            params (Optional[Dict[str, Any]]): Sampling parameters such as temperature, seed, max_tokens and stop.
+            timeout (Optional[float]): Seconds from now after which the job expires, if any.
         """
         self.sys_prompt = sys_prompt
         self.messages = messages
         self.uuid = str(uuid4().hex)
         self.status = "created"
-        self.completion = ""
+        self.chunks: List[str] = []
+        self.subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self.lock = RLock()
+        self.cancelled = False
+        self.params: Dict[str, Any] = params or {}
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.cache_key: Optional[str] = None
+        self.semantic_key: Optional[Tuple[str, Any]] = None
+        self.size = text_bytes(sys_prompt) + sum(text_bytes(message) for message in messages)
+        self.on_resize: Optional[Callable[[int], None]] = None
+        self.updated_at = time.monotonic()
+        self.created_at = self.updated_at
 
     def append_chunk(self, chunk: str) -> None:
         """
-        Appends a chunk of text to the current completion.
+        Appends a chunk of text to the current completion and forwards it to all subscribers.
 
         Args:
             chunk (str): A string chunk to add to the completion.
         """
-        self.completion += chunk
+        with self.lock:
+            self.chunks.append(chunk)
+            size = text_bytes(chunk)
+            self.size += size
+            if self.on_resize is not None:
+                self.on_resize(size)
+            self._publish("chunk", (chunk, len(self.chunks)))
 
     def append_message(self) -> None:
         """
         Appends the current completion to the list of messages and resets the completion text.
         """
-        self.messages.append(self.completion)
-        self.completion = ""
+        with self.lock:
+            self.messages.append("".join(self.chunks))
+            self.chunks = []
 
     def get_completion(self) -> str:
         """
@@ -51,8 +107,47 @@ class ChatJob:
         Returns:
             str: The completion.
         """
-        return self.completion
-        
+        with self.lock:
+            return "".join(self.chunks)
+
+    def get_completion_since(self, cursor: int) -> Tuple[str, int]:
+        """
+        Retrieves the text appended after the given cursor.
+
+        Args:
+            cursor (int): The number of chunks the caller has already received.
+
+        Returns:
+            Tuple[str, int]: The new text and the cursor to pass on the next call.
+        """
+        with self.lock:
+            cursor = min(max(cursor, 0), len(self.chunks))
+            return "".join(self.chunks[cursor:]), len(self.chunks)
+
+    def count_chunks(self) -> int:
+        """
+        Retrieves the number of chunks generated so far, roughly the number of completion tokens.
+
+        Returns:
+            int: The number of chunks.
+        """
+        with self.lock:
+            return len(self.chunks)
+
+    def get_chat_messages(self) -> List[Dict[str, str]]:
+        """
+        Builds the conversation in the chat completion format, starting with the system prompt
+        and alternating between the user and assistant roles.
+
+        Returns:
+            List[Dict[str, str]]: A list of {"role": ..., "content": ...} messages.
+        """
+        toggle = RoleToggle("user", "assistant")
+        messages = [{"role": "system", "content": self.sys_prompt}]
+        for message in self.messages:
+            messages.append({"role": toggle.toggle(), "content": message})
+        return messages
+
     def get_messages(self) -> List[str]:
         """
         Retrieves the list of chat messages.
@@ -71,6 +166,103 @@ class ChatJob:
         """
         return self.status
 
+    def cancel(self) -> None:
+        """
+        Requests the generation of the chat job to stop at the next chunk.
+        """
+        self.cancelled = True
+
+    def is_cancelled(self) -> bool:
+        """
+        Checks whether the chat job has been cancelled.
+
+        Returns:
+            bool: True if the job has been cancelled.
+        """
+        return self.cancelled
+
+    def get_size(self) -> int:
+        """
+        Retrieves the number of UTF-8 bytes of text retained by the chat job.
+
+        Returns:
+            int: The size of the prompt, messages and completion.
+        """
+        return self.size
+
+    def get_updated_at(self) -> float:
+        """
+        Retrieves the monotonic time of the last status change.
+
+        Returns:
+            float: The time of the last status change.
+        """
+        return self.updated_at
+
+    def get_created_at(self) -> float:
+        """
+        Retrieves the creation time of the chat job.
+
+        Returns:
+            float: The monotonic time the job was created.
+        """
+        return self.created_at
+
+    def is_expired(self) -> bool:
+        """
+        Checks whether the deadline of the chat job has passed.
+
+        Returns:
+            bool: True if the job has a deadline and it has passed.
+        """
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def get_params(self) -> Dict[str, Any]:
+        """
+        Retrieves the sampling parameters.
+
+        Returns:
+            Dict[str, Any]: The parameters passed on to the chat completion.
+        """
+        return self.params
+
+    def get_cache_key(self) -> Optional[str]:
+        """
+        Retrieves the response cache key.
+
+        Returns:
+            Optional[str]: The key, or None if the completion must not be cached.
+        """
+        return self.cache_key
+
+    def set_cache_key(self, cache_key: Optional[str]) -> None:
+        """
+        Marks the completion as cacheable under the given key.
+
+        Args:
+            cache_key (Optional[str]): The response cache key.
+        """
+        self.cache_key = cache_key
+
+    def get_semantic_key(self) -> Optional[Tuple[str, Any]]:
+        """
+        Retrieves the semantic cache namespace and question embedding.
+
+        Returns:
+            Optional[Tuple[str, Any]]: The namespace and embedding, or None if the completion must not be cached.
+        """
+        return self.semantic_key
+
+    def set_semantic_key(self, namespace: str, embedding: Any) -> None:
+        """
+        Marks the completion as an answer for the semantic cache.
+
+        Args:
+            namespace (str): The semantic cache namespace of the request.
+            embedding (Any): The normalized embedding of the question.
+        """
+        self.semantic_key = (namespace, embedding)
+
     def get_sys_prompt(self) -> str:
         """
         Retrieves the system prompt.
@@ -96,49 +288,132 @@ class ChatJob:
         Args:
             status (str): The new status to assign to the chat job.
         """
-        self.status = status
+        with self.lock:
+            self.status = status
+            self.updated_at = time.monotonic()
+            self._publish("status", status)
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop, cursor: int = 0) -> asyncio.Queue:
+        """
+        Registers a new subscriber for the job's chunk and status events.
+
+        The queue is primed with the completion produced after the cursor and the current status,
+        so a subscriber that joins late does not miss any text. Chunk events carry a
+        (text, cursor) tuple.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The event loop the returned queue is consumed on.
+            cursor (int): The number of chunks the subscriber has already received.
+
+        Returns:
+            asyncio.Queue: A queue receiving (event, payload) tuples.
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        with self.lock:
+            text, cursor = self.get_completion_since(cursor)
+            if text:
+                events.put_nowait(("chunk", (text, cursor)))
+            events.put_nowait(("status", self.status))
+            self.subscribers.append((loop, events))
+        return events
+
+    def unsubscribe(self, events: asyncio.Queue) -> None:
+        """
+        Removes a subscriber queue previously returned by subscribe().
+
+        Args:
+            events (asyncio.Queue): The queue to remove.
+        """
+        with self.lock:
+            self.subscribers = [(loop, queue) for loop, queue in self.subscribers if queue is not events]
+
+    def _publish(self, event: str, payload: Any) -> None:
+        """
+        Hands an event over to the event loops of all subscribers. Called with the lock held.
+
+        Args:
+            event (str): The event name ('chunk' or 'status').
+            payload (Any): The event payload.
+        """
+        for loop, events in list(self.subscribers):
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, (event, payload))
+            except RuntimeError:
+                # The subscriber's event loop is closed; drop it
+                self.unsubscribe(events)
 
 class JobRegister:
     """
     A thread-safe class to manage the registration and tracking of multiple jobs.
 
+    Jobs in a final state expire once they have not changed for the time to live. The number of
+    jobs and the bytes they retain are capped; to make room for a new job the least recently
+    updated final jobs are evicted, and the new job is refused if that is not enough.
+
     Attributes:
-        register (Dict[str, ChatJob): A dictionary storing jobs by their UUID.
+        register (Dict[str, ChatJob]): A dictionary storing jobs by their UUID.
         lock (RLock): A reentrant lock to ensure thread-safe operations.
+        ttl (float): Seconds a job in a final state is kept after its last status change.
+        max_jobs (int): The maximum number of registered jobs.
+        max_bytes (int): The maximum number of bytes retained by the registered jobs.
+        evicted_expired (int): The number of jobs removed because their time to live passed.
+        evicted_capacity (int): The number of jobs removed to make room for new ones.
+        rejected (int): The number of jobs refused because the register was full.
+        retained (int): The running total of the bytes retained by the registered jobs.
+        retained_lock (Lock): Guards the running total, which jobs update as they grow.
     """
 
-    def __init__(self):
+    FINAL_STATUSES = ("finished", "failed", "cancelled", "expired")
+
+    def __init__(self, ttl: Optional[float] = None, max_jobs: Optional[int] = None, max_bytes: Optional[int] = None):
         """
         Initializes a JobRegister instance with an empty register and a lock.
+
+        Args:
+            ttl (Optional[float]): Seconds to keep final jobs. Defaults to JOB_TTL.
+            max_jobs (Optional[int]): The maximum number of jobs. Defaults to MAX_JOBS.
+            max_bytes (Optional[int]): The maximum retained bytes. Defaults to MAX_JOB_BYTES.
         """
         self.register: Dict[str, ChatJob] = {}
         self.lock = RLock()
+        self.ttl = ttl if ttl is not None else float(os.getenv('JOB_TTL', '3600'))
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.getenv('MAX_JOBS', '10000'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('MAX_JOB_BYTES', str(1024 ** 3)))
+        self.evicted_expired = 0
+        self.evicted_capacity = 0
+        self.rejected = 0
+        self.retained = 0
+        self.retained_lock = Lock()
 
     def delete_job(self, uuid: str) -> None:
         """
-        Deletes a job from the register by its UUID.
+        Deletes a job from the register by its UUID. Unknown UUIDs are ignored.
 
         Args:
             uuid (str): The UUID of the job to delete.
-
-        Raises:
-            KeyError: If the UUID is not found in the register.
         """
         with self.lock:
-            try:
-                del self.register[uuid]
-            except Exception as e:
-                print(e)
+            job = self.register.pop(uuid, None)
+            if job is not None:
+                self._untrack(job)
 
-    def add_job(self, job: ChatJob) -> None:
+    def add_job(self, job: ChatJob) -> bool:
         """
-        Adds a job to the register.
+        Adds a job to the register, evicting final jobs if the register is full.
 
         Args:
-            job (ChatJob ): The job instance to add.
+            job (ChatJob): The job instance to add.
+
+        Returns:
+            bool: True if the job was added, False if the register is full.
         """
         with self.lock:
+            if not self.make_room(job.get_size()):
+                self.rejected += 1
+                return False
             self.register[job.get_uuid()] = job
+            self._track(job)
+            return True
 
     def get_job(self, uuid: str) -> Optional[ChatJob]:
         """
@@ -148,11 +423,216 @@ class JobRegister:
             uuid (str): The UUID of the job to retrieve.
 
         Returns:
-            Optional[ChatJob: The job instance if found, otherwise None.
+            Optional[ChatJob]: The job instance if found, otherwise None.
         """
         with self.lock:
             return self.register.get(uuid)
 
+    def _track(self, job: ChatJob) -> None:
+        """
+        Adds a newly registered job to the running total and has it report its growth.
+
+        Args:
+            job (ChatJob): The job.
+        """
+        with job.lock:
+            job.on_resize = self._resize
+            self._resize(job.get_size())
+
+    def _untrack(self, job: ChatJob) -> None:
+        """
+        Removes a job that left the register from the running total.
+
+        Args:
+            job (ChatJob): The job.
+        """
+        with job.lock:
+            job.on_resize = None
+            self._resize(-job.get_size())
+
+    def _resize(self, size: int) -> None:
+        """
+        Changes the running total of retained bytes.
+
+        Args:
+            size (int): The bytes to add, negative to subtract.
+        """
+        with self.retained_lock:
+            self.retained += size
+
+    def retained_bytes(self) -> int:
+        """
+        Retrieves the number of bytes retained by the registered jobs.
+
+        Returns:
+            int: The retained bytes.
+        """
+        with self.retained_lock:
+            return self.retained
+
+    def make_room(self, size: int) -> bool:
+        """
+        Evicts the least recently updated final jobs until a new job of the given size fits.
+
+        Args:
+            size (int): The bytes retained by the new job.
+
+        Returns:
+            bool: True if the new job fits.
+        """
+        with self.lock:
+            def fits() -> bool:
+                return len(self.register) < self.max_jobs and self.retained_bytes() + size <= self.max_bytes
+
+            if fits():
+                return True
+            final = [job for job in self.register.values() if job.get_status() in self.FINAL_STATUSES]
+            for job in sorted(final, key=lambda job: job.get_updated_at()):
+                del self.register[job.get_uuid()]
+                self._untrack(job)
+                self.evicted_capacity += 1
+                if fits():
+                    return True
+            return False
+
+    def reap(self) -> int:
+        """
+        Removes the final jobs whose time to live has passed.
+
+        Returns:
+            int: The number of removed jobs.
+        """
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            expired = [
+                uuid for uuid, job in self.register.items()
+                if job.get_status() in self.FINAL_STATUSES and job.get_updated_at() < deadline
+            ]
+            for uuid in expired:
+                self._untrack(self.register.pop(uuid))
+            self.evicted_expired += len(expired)
+            return len(expired)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size of the register and its eviction counters.
+
+        Returns:
+            Dict[str, int]: The number of jobs, retained bytes and eviction counters.
+        """
+        with self.lock:
+            return {
+                "jobs": len(self.register),
+                "retained_bytes": self.retained_bytes(),
+                "evicted_expired": self.evicted_expired,
+                "evicted_capacity": self.evicted_capacity,
+                "rejected": self.rejected
+            }
+
+class JobReaper(threading.Thread):
+    """
+    A daemon thread that periodically removes expired jobs from a JobRegister, or expired
+    entries from anything else with a reap() method such as a SessionStore.
+
+    Attributes:
+        jobReg (JobRegister): The register to clean up.
+        interval (float): Seconds between two clean-ups.
+        label (str): What the register holds, used in log messages.
+    """
+
+    def __init__(self, jobReg: JobRegister, interval: Optional[float] = None, label: str = "job"):
+        """
+        Initializes the JobReaper.
+
+        Args:
+            jobReg (JobRegister): The register to clean up.
+            interval (Optional[float]): Seconds between two clean-ups. Defaults to JOB_REAP_INTERVAL.
+            label (str): What the register holds, used in log messages.
+        """
+        super().__init__(daemon=True)
+        self.jobReg = jobReg
+        self.interval = interval if interval is not None else float(os.getenv('JOB_REAP_INTERVAL', '60'))
+        self.label = label
+
+    def run(self):
+        """
+        Removes expired jobs every interval seconds.
+        """
+        while True:
+            time.sleep(self.interval)
+            removed = self.jobReg.reap()
+            if removed:
+                print(f"Removed {removed} expired {self.label}(s).")
+
+class ThroughputTracker:
+    """
+    A thread-safe rolling window over recently finished jobs, used to estimate throughput and waiting times.
+
+    Attributes:
+        samples (Deque[Tuple[float, int]]): Duration in seconds and generated tokens of the recent jobs.
+        lock (RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, window: int = 50):
+        """
+        Initializes an empty ThroughputTracker.
+
+        Args:
+            window (int): The number of recent jobs taken into account.
+        """
+        self.samples: Deque[Tuple[float, int]] = deque(maxlen=window)
+        self.lock = RLock()
+
+    def record(self, seconds: float, tokens: int) -> None:
+        """
+        Records a finished job.
+
+        Args:
+            seconds (float): The processing time of the job.
+            tokens (int): The number of generated tokens.
+        """
+        with self.lock:
+            self.samples.append((seconds, tokens))
+
+    def get_tokens_per_second(self) -> Optional[float]:
+        """
+        Computes the generation speed of a single job over the window.
+
+        Returns:
+            Optional[float]: Tokens per second, or None without samples.
+        """
+        with self.lock:
+            seconds = sum(sample[0] for sample in self.samples)
+            return sum(sample[1] for sample in self.samples) / seconds if seconds > 0 else None
+
+    def get_average_job_seconds(self) -> Optional[float]:
+        """
+        Computes the average processing time of a job over the window.
+
+        Returns:
+            Optional[float]: Seconds per job, or None without samples.
+        """
+        with self.lock:
+            if not self.samples:
+                return None
+            return sum(sample[0] for sample in self.samples) / len(self.samples)
+
+    def estimate_wait(self, jobs_ahead: int, parallel: int) -> Optional[float]:
+        """
+        Estimates the time until a newly queued job is finished.
+
+        Args:
+            jobs_ahead (int): The number of jobs queued before the new one.
+            parallel (int): The number of jobs processed at the same time.
+
+        Returns:
+            Optional[float]: The estimated seconds, or None without samples.
+        """
+        average = self.get_average_job_seconds()
+        if average is None:
+            return None
+        return (jobs_ahead // max(parallel, 1) + 1) * average
+
 class RoleToggle:
     """
     A class to toggle between two roles: 'user' and 'assistant'.
@@ -0,0 +1,222 @@
+import os
+import time
+from typing import Any, Dict, List
+
+import llama_cpp
+from llama_cpp import Llama
+
+# Data types of the K and V cache: f16 (default), q8_0 halves and q4_0 quarters its size;
+# a quantized V cache requires flash attention, which is then enabled
+KV_TYPE_K = os.getenv('KV_TYPE_K', 'f16')
+KV_TYPE_V = os.getenv('KV_TYPE_V', 'f16')
+FLASH_ATTN = os.getenv('FLASH_ATTN', '0') == '1'
+# Lock the weights in RAM so they are never paged out, and read them in before the first job
+# instead of faulting them in page by page while it is processed
+MLOCK = os.getenv('MLOCK', '0') == '1'
+MODEL_PREFETCH = os.getenv('MODEL_PREFETCH', '0') == '1'
+# Context sizes a model may be shrunk to, and the bytes the KV caches of its workers may take;
+# the largest tier up to N_CTX whose caches fit is used. 0 always uses N_CTX
+CTX_TIERS = [int(tier) for tier in os.getenv('CTX_TIERS', '4096,8192,16384,32768').split(',') if tier]
+KV_BUDGET_BYTES = int(os.getenv('KV_BUDGET_BYTES', '0'))
+
+# The ggml type and the bytes per element of each KV cache type; quantized types store blocks
+# of 32 elements with a 16-bit scale (and a 16-bit minimum for the _1 variants)
+KV_TYPES = {
+    "f32": (llama_cpp.GGML_TYPE_F32, 4.0),
+    "f16": (llama_cpp.GGML_TYPE_F16, 2.0),
+    "q8_0": (llama_cpp.GGML_TYPE_Q8_0, 34 / 32),
+    "q5_1": (llama_cpp.GGML_TYPE_Q5_1, 24 / 32),
+    "q5_0": (llama_cpp.GGML_TYPE_Q5_0, 22 / 32),
+    "q4_1": (llama_cpp.GGML_TYPE_Q4_1, 20 / 32),
+    "q4_0": (llama_cpp.GGML_TYPE_Q4_0, 18 / 32),
+}
+
+
+def kv_type(name: str) -> int:
+    """
+    Looks up the ggml type of a KV cache type name.
+
+    Args:
+        name (str): The name, e.g. "f16" or "q8_0".
+
+    Returns:
+        int: The ggml type.
+
+    Raises:
+        ValueError: If the type is not supported for the KV cache.
+    """
+    if name not in KV_TYPES:
+        raise ValueError(f"Unsupported KV cache type {name}; use one of {', '.join(KV_TYPES)}.")
+    return KV_TYPES[name][0]
+
+
+def read_metadata(path: str) -> Dict[str, str]:
+    """
+    Reads the GGUF metadata of a model without loading its weights.
+
+    Args:
+        path (str): The model file.
+
+    Returns:
+        Dict[str, str]: The metadata.
+    """
+    llm = Llama(model_path=path, vocab_only=True, verbose=False)
+    try:
+        return dict(llm.metadata)
+    finally:
+        llm.close()
+
+
+def context_length(metadata: Dict[str, str]) -> int:
+    """
+    Reads the training context size of a model.
+
+    Args:
+        metadata (Dict[str, str]): The GGUF metadata of the model.
+
+    Returns:
+        int: The context size, or 0 if the metadata lacks it.
+    """
+    arch = metadata.get("general.architecture", "")
+    try:
+        return int(metadata.get(f"{arch}.context_length", 0))
+    except ValueError:
+        return 0
+
+
+def kv_bytes_per_token(metadata: Dict[str, str], type_k: str, type_v: str) -> int:
+    """
+    Computes the KV cache bytes one context position takes in every layer.
+
+    Args:
+        metadata (Dict[str, str]): The GGUF metadata of the model.
+        type_k (str): The K cache type.
+        type_v (str): The V cache type.
+
+    Returns:
+        int: The bytes per token, or 0 if the metadata lacks the attention dimensions.
+    """
+    arch = metadata.get("general.architecture", "")
+    try:
+        layers = int(metadata[f"{arch}.block_count"])
+        heads = int(metadata[f"{arch}.attention.head_count"])
+        heads_kv = int(metadata.get(f"{arch}.attention.head_count_kv", heads))
+        embedding = int(metadata[f"{arch}.embedding_length"])
+    except (KeyError, ValueError):
+        return 0
+    key_length = int(metadata.get(f"{arch}.attention.key_length", embedding // heads))
+    value_length = int(metadata.get(f"{arch}.attention.value_length", embedding // heads))
+    per_layer = heads_kv * (key_length * KV_TYPES[type_k][1] + value_length * KV_TYPES[type_v][1])
+    return int(layers * per_layer)
+
+
+def choose_n_ctx(n_ctx: int, per_token: int, workers: int, tiers: List[int] = CTX_TIERS,
+                 budget: int = KV_BUDGET_BYTES) -> int:
+    """
+    Chooses the context size of a model's workers so that their KV caches fit the budget.
+
+    Args:
+        n_ctx (int): The configured context size; 0 for the training context of the model.
+        per_token (int): The KV cache bytes per context position.
+        workers (int): The number of contexts of that size.
+        tiers (List[int]): The context sizes to choose from besides n_ctx.
+        budget (int): The bytes all KV caches may take; 0 disables shrinking.
+
+    Returns:
+        int: The largest tier up to n_ctx whose caches fit, the smallest tier if none does,
+             or n_ctx if there is no budget or the size of the cache is unknown.
+    """
+    if budget <= 0 or per_token <= 0 or n_ctx <= 0:
+        return n_ctx
+    candidates = sorted({tier for tier in tiers if tier < n_ctx} | {n_ctx}, reverse=True)
+    for candidate in candidates:
+        if candidate * per_token * workers <= budget:
+            if candidate < n_ctx:
+                print(f"Shrinking the context from {n_ctx} to {candidate} tokens to fit KV_BUDGET_BYTES.")
+            return candidate
+    print(f"Warning: even {candidates[-1]} tokens of context exceed KV_BUDGET_BYTES.")
+    return candidates[-1]
+
+
+def prefetch(path: str, chunk_size: int = 16 * 1024 ** 2) -> float:
+    """
+    Reads a file into the page cache, so that the mapped weights are not faulted in lazily
+    during the first generations.
+
+    Args:
+        path (str): The model file.
+        chunk_size (int): The bytes read at once.
+
+    Returns:
+        float: The seconds it took.
+    """
+    started = time.monotonic()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while os.read(fd, chunk_size):
+            pass
+    finally:
+        os.close(fd)
+    return time.monotonic() - started
+
+
+def resident_bytes() -> int:
+    """
+    Reads the resident memory of the process.
+
+    Returns:
+        int: The bytes, or 0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def memory_report(handler: Any, n_ctx: int, per_token: int, workers: int) -> Dict[str, Any]:
+    """
+    Summarizes the memory a model's workers use and how it is configured.
+
+    Args:
+        handler (ModelHandler): The model.
+        n_ctx (int): The context size of each worker.
+        per_token (int): The KV cache bytes per context position.
+        workers (int): The number of contexts.
+
+    Returns:
+        Dict[str, Any]: The weights bytes, whether they are locked, the KV cache types, whether
+            flash attention is on, the context size, the KV cache bytes per worker and in total,
+            and the resident memory of the process.
+    """
+    kv = n_ctx * per_token
+    return {
+        "weights_bytes": os.path.getsize(handler.filename) if os.path.exists(handler.filename) else 0,
+        "mlock": handler.mlock,
+        "type_k": handler.type_k,
+        "type_v": handler.type_v,
+        "flash_attn": handler.flash_attn,
+        "n_ctx": n_ctx,
+        "kv_bytes_per_worker": kv,
+        "kv_bytes": kv * workers,
+        "resident_bytes": resident_bytes(),
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """
+    Formats a memory report for the log.
+
+    Args:
+        report (Dict[str, Any]): The report from memory_report.
+
+    Returns:
+        str: One line with the sizes in MiB.
+    """
+    mib = 1024 ** 2
+    return (f"Memory: weights {report['weights_bytes'] / mib:.0f} MiB{' (locked)' if report['mlock'] else ''}, "
+            f"KV cache {report['type_k']}/{report['type_v']} {report['n_ctx']} tokens "
+            f"{report['kv_bytes_per_worker'] / mib:.0f} MiB per worker, {report['kv_bytes'] / mib:.0f} MiB total, "
+            f"flash attention {'on' if report['flash_attn'] else 'off'}, resident {report['resident_bytes'] / mib:.0f} MiB")
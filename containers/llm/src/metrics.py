@@ -0,0 +1,344 @@
+import os
+import threading
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Default histogram buckets for durations in seconds
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Buckets for completion lengths in tokens
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+# Buckets for per-job decode speed in tokens per second
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100, 200)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """
+    Formats label pairs in the Prometheus text format.
+
+    Args:
+        names (Sequence[str]): The label names.
+        values (Sequence[str]): The label values.
+        extra (str): An already formatted pair appended to the labels, e.g. the bucket bound.
+
+    Returns:
+        str: The labels in braces, or an empty string if there are none.
+    """
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    """
+    Formats a sample value, writing whole numbers without a fraction.
+
+    Args:
+        value (float): The value.
+
+    Returns:
+        str: The formatted value.
+    """
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """
+    The base of the metric types: a named family of samples, one per combination of label values.
+
+    Attributes:
+        name (str): The metric name.
+        help (str): The description shown in the exposition.
+        label_names (Tuple[str, ...]): The names of the labels.
+        lock (threading.Lock): Guards the samples, which are updated from several threads.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        """
+        Initializes an empty metric and adds it to the registry.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description shown in the exposition.
+            label_names (Sequence[str]): The names of the labels.
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """
+        Orders label values by the metric's label names.
+
+        Args:
+            labels (Dict[str, str]): The label values by name.
+
+        Returns:
+            Tuple[str, ...]: The label values.
+        """
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        """
+        Renders the samples of the metric.
+
+        Returns:
+            List[str]: One line per sample.
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """
+        Renders the metric with its HELP and TYPE lines.
+
+        Returns:
+            str: The metric in the Prometheus text format.
+        """
+        with self.lock:
+            lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self.samples()
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count.
+
+    Attributes:
+        values (Dict[Tuple[str, ...], float]): The count per label values.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        """
+        Initializes a counter without samples.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description shown in the exposition.
+            label_names (Sequence[str]): The names of the labels.
+        """
+        super().__init__(name, help, label_names)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Increases the count.
+
+        Args:
+            amount (float): The increment.
+            **labels (str): The label values.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def take(self) -> Dict[Tuple[str, ...], float]:
+        """
+        Removes the counts, so that they can be added to totals kept elsewhere.
+
+        Returns:
+            Dict[Tuple[str, ...], float]: The counts by label values since the last call.
+        """
+        with self.lock:
+            values, self.values = self.values, {}
+            return values
+
+    def restore(self, values: Dict[Tuple[str, ...], float]) -> None:
+        """
+        Replaces the counts, e.g. with totals collected from several processes.
+
+        Args:
+            values (Dict[Tuple[str, ...], float]): The counts by label values.
+        """
+        with self.lock:
+            self.values = dict(values)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, typically set when the metrics are scraped.
+
+    Attributes:
+        values (Dict[Tuple[str, ...], float]): The value per label values.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        """
+        Initializes a gauge without samples.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description shown in the exposition.
+            label_names (Sequence[str]): The names of the labels.
+        """
+        super().__init__(name, help, label_names)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        """
+        Sets the value.
+
+        Args:
+            value (float): The new value.
+            **labels (str): The label values.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """
+    Counts observations in cumulative buckets and keeps their sum and count.
+
+    Attributes:
+        buckets (Tuple[float, ...]): The upper bounds of the buckets, ascending.
+        values (Dict[Tuple[str, ...], List[float]]): Per label values, the count of each bucket
+            followed by the count of all observations and their sum.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = SECONDS_BUCKETS,
+                 label_names: Sequence[str] = ()):
+        """
+        Initializes a histogram without samples.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description shown in the exposition.
+            buckets (Sequence[float]): The upper bounds of the buckets.
+            label_names (Sequence[str]): The names of the labels.
+        """
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Records an observation.
+
+        Args:
+            value (float): The observed value.
+            **labels (str): The label values.
+        """
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in self.values.items():
+            for bound, count in zip(self.buckets, counts):
+                le = 'le="{}"'.format(format_value(bound))
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, le)} {counts[-2]}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {counts[-2]}")
+        return lines
+
+
+def render(skip: Sequence[Metric] = ()) -> str:
+    """
+    Renders all metrics.
+
+    Args:
+        skip (Sequence[Metric]): Metrics to leave out, e.g. because they are rendered elsewhere.
+
+    Returns:
+        str: The exposition in the Prometheus text format.
+    """
+    return "\n".join(metric.render() for metric in REGISTRY if metric not in skip) + "\n"
+
+
+# All metrics, in order of definition
+REGISTRY: List[Metric] = []
+
+QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "Seconds chat jobs waited in the queue before a worker took them.")
+PREFILL = Histogram("llm_prefill_seconds", "Seconds from the start of processing to the first generated token.")
+TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "Seconds from submission to the first generated token.")
+JOB_DURATION = Histogram("llm_job_seconds", "Seconds from submission to the end of generation.")
+COMPLETION_TOKENS = Histogram("llm_completion_tokens", "Number of tokens generated per chat job.", TOKEN_BUCKETS)
+DECODE_RATE = Histogram("llm_decode_tokens_per_second", "Decode speed of each chat job after its first token.", RATE_BUCKETS)
+DECODE_TOKENS = Counter("llm_decode_tokens_total", "Tokens generated after the first token of each job.")
+DECODE_SECONDS = Counter("llm_decode_seconds_total", "Seconds spent generating after the first token of each job.")
+JOBS = Counter("llm_jobs_total", "Chat jobs by outcome.", ("outcome",))
+DRAFT_STEPS = Counter("llm_draft_steps_total", "Decode steps of speculative decoding.", ("kind",))
+DRAFT_TOKENS = Counter("llm_draft_tokens_total", "Tokens proposed by the draft.", ("kind",))
+DRAFT_ACCEPTED = Counter("llm_draft_accepted_tokens_total", "Drafted tokens the model accepted.", ("kind",))
+CONTEXT_DROPPED = Counter("llm_context_dropped_messages_total", "Oldest messages dropped to fit the prompt budget.")
+PROMPT_TOKENS = Histogram("llm_prompt_tokens", "Number of prompt tokens per chat job after compaction.", TOKEN_BUCKETS)
+QUEUE_DEPTH = Gauge("llm_queue_depth", "Chat jobs waiting in the queue.", ("model",))
+MODEL_BYTES = Gauge("llm_model_bytes", "Memory footprint of the model weights.", ("model",))
+MODEL_LOADED = Gauge("llm_model_loaded", "Whether the model is loaded and ready.", ("model",))
+REGISTERED_JOBS = Gauge("llm_registered_jobs", "Jobs held by the job register.")
+RETAINED_BYTES = Gauge("llm_retained_bytes", "Bytes of text retained by the job register.")
+PROCESS_RESIDENT_BYTES = Gauge("llm_process_resident_bytes", "Resident memory of the service process.")
+
+
+def sample(registry: Any, jobReg: Any) -> None:
+    """
+    Sets the gauges that are sampled when the metrics are scraped.
+
+    Args:
+        registry (ModelRegistry): The models, for their queue depth, memory and state.
+        jobReg (JobRegister): The job register, for its size.
+    """
+    for name, entry in registry.entries.items():
+        QUEUE_DEPTH.set(entry.queue.qsize(), model=name)
+        MODEL_BYTES.set(entry.get_size() if entry.is_resident() else 0, model=name)
+        MODEL_LOADED.set(1 if entry.get_state() == "ready" else 0, model=name)
+    stats = jobReg.get_stats()
+    REGISTERED_JOBS.set(stats["jobs"])
+    RETAINED_BYTES.set(stats["retained_bytes"])
+    try:
+        with open("/proc/self/statm") as f:
+            PROCESS_RESIDENT_BYTES.set(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except OSError:
+        pass
+
+
+def record_generation(queued_at: float, started: float, first_token: float, finished: float, tokens: int) -> None:
+    """
+    Records the timings of a finished generation.
+
+    Args:
+        queued_at (float): The monotonic time the job was submitted.
+        started (float): The monotonic time a worker started processing the job.
+        first_token (float): The monotonic time the first token was generated; 0 if none was.
+        finished (float): The monotonic time generation ended.
+        tokens (int): The number of generated tokens.
+    """
+    JOB_DURATION.observe(finished - queued_at)
+    COMPLETION_TOKENS.observe(tokens)
+    if not first_token:
+        return
+    PREFILL.observe(first_token - started)
+    TIME_TO_FIRST_TOKEN.observe(first_token - queued_at)
+    if tokens > 1 and finished > first_token:
+        DECODE_TOKENS.inc(tokens - 1)
+        DECODE_SECONDS.inc(finished - first_token)
+        DECODE_RATE.observe((tokens - 1) / (finished - first_token))
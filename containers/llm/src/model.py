@@ -1,8 +1,110 @@
 import os
+import json
+import time
+import hashlib
 import requests
-import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 from llama_cpp import Llama
 
+from memory import FLASH_ATTN, KV_TYPE_K, KV_TYPE_V, MLOCK, kv_type
+from speculative import DRAFT_MAX_LOGITS_BYTES, DRAFT_TOKENS, PROMPT_LOOKUP, make_draft
+from tuning import default_threads
+
+
+def file_sha256(path: str) -> str:
+    """
+    Computes the SHA-256 of a file.
+
+    Parameters:
+    -----------
+    path : str
+        The path of the file.
+
+    Returns:
+    --------
+    str
+        The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DownloadProgress:
+    """
+    A thread-safe counter of downloaded bytes that prints the progress at most every few seconds.
+
+    Attributes:
+    -----------
+    total : Optional[int]
+        The expected number of bytes, if known.
+    done : int
+        The number of bytes downloaded so far, including resumed ones.
+    interval : float
+        The minimum number of seconds between two reports.
+    started : float
+        The monotonic time the download (re)started, used for the rate.
+    resumed : int
+        The number of bytes that were already present when the download (re)started.
+    reported : float
+        The monotonic time of the last report.
+    lock : threading.Lock
+        Guards the counters, which are updated from several download threads.
+    """
+
+    def __init__(self, total: Optional[int], done: int = 0, interval: float = 5):
+        """
+        Initializes the progress of a download.
+
+        Parameters:
+        -----------
+        total : Optional[int]
+            The expected number of bytes, if known.
+        done : int
+            The number of bytes already present from an earlier attempt.
+        interval : float
+            The minimum number of seconds between two reports.
+        """
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.started = time.monotonic()
+        self.resumed = done
+        self.reported = self.started
+        self.lock = threading.Lock()
+        if done:
+            print(f"Resuming download at {done / 2**20:.0f} MiB.")
+
+    def add(self, count: int) -> bool:
+        """
+        Adds downloaded bytes and prints the progress if the last report is old enough.
+
+        Parameters:
+        -----------
+        count : int
+            The number of bytes downloaded.
+
+        Returns:
+        --------
+        bool
+            True if the progress has been reported.
+        """
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.reported < self.interval and self.done != self.total:
+                return False
+            self.reported = now
+            rate = (self.done - self.resumed) / max(now - self.started, 1e-6) / 2**20
+            total = f" of {self.total / 2**20:.0f}" if self.total else ""
+            print(f"Downloaded {self.done / 2**20:.0f}{total} MiB ({rate:.1f} MiB/s)")
+            return True
+
+
 class ModelHandler:
     """
     A class to handle downloading and building the Llama model.
@@ -17,8 +119,32 @@ class ModelHandler:
         The URL from which to download the model if needed.
     filename : str
         The path where the model binary should be saved/loaded from.
+    sha256 : str
+        The expected SHA-256 of the model file; empty to skip verification.
+    connections : int
+        The number of parallel connections used for the download.
+    draft : str
+        The speculative decoding mode: "prompt-lookup", the path of a small draft model of the
+        same family, or empty to disable it.
+    draft_url : str
+        The URL from which to download the draft model if needed.
+    draft_tokens : int
+        The number of tokens drafted per decode step; 0 for the default of the mode.
+    supports_batching : bool
+        Whether the built model offers the low-level batch API used by BatchProcessor; False with
+        speculative decoding, which runs in the generation loop of Llama.
     gpu_layers : int
         The number of GPU layers to use for inference.
+    type_k : str
+        The data type of the K cache, e.g. "f16" or "q8_0".
+    type_v : str
+        The data type of the V cache.
+    flash_attn : bool
+        Whether attention uses the fused flash attention kernels; always True with a quantized V cache,
+        which requires them.
+    mlock : bool
+        Whether the weights are locked in RAM; this needs a sufficient RLIMIT_MEMLOCK (or IPC_LOCK
+        in a container), otherwise llama.cpp only warns.
     verbose : bool
         Controls whether verbose output is enabled during initialization.
 
@@ -27,26 +153,61 @@ class ModelHandler:
     download_file() -> str:
         Downloads the model from the specified URL and saves it locally.
     
-    build() -> Llama:
+    build(n_threads: Optional[int] = None, n_ctx: Optional[int] = None,
+          n_threads_batch: Optional[int] = None, n_batch: Optional[int] = None) -> Llama:
         Initializes and returns the Llama model instance.
     """
 
-    CHUNK_SIZE = 8192  # Constant for download chunk size
+    CHUNK_SIZE = 1024 * 1024  # Constant for download chunk size
+    TIMEOUT = 60  # Seconds without data after which a download connection is dropped
+    RETRIES = 5  # Attempts per download segment
+    supports_batching = True
 
-    def __init__(self):
+    def __init__(self, url: Optional[str] = None, filename: Optional[str] = None,
+                 n_ctx: Optional[int] = None, sha256: Optional[str] = None, draft: Optional[str] = None,
+                 draft_url: Optional[str] = None, draft_tokens: Optional[int] = None):
         """
-        Initializes the ModelHandler with parameters from environment variables.
+        Initializes the ModelHandler with the given parameters, falling back to environment variables.
+
+        Parameters:
+        -----------
+        url : Optional[str]
+            The download URL, overriding MODEL_DOWNLOAD_URL.
+        filename : Optional[str]
+            The path of the model file, overriding MODEL_BIN_PATH.
+        n_ctx : Optional[int]
+            The context size, overriding N_CTX.
+        sha256 : Optional[str]
+            The expected SHA-256 of the model file, overriding MODEL_SHA256.
+        draft : Optional[str]
+            The speculative decoding mode, overriding DRAFT_MODEL.
+        draft_url : Optional[str]
+            The download URL of the draft model, overriding DRAFT_DOWNLOAD_URL.
+        draft_tokens : Optional[int]
+            The number of tokens drafted per step, overriding DRAFT_TOKENS.
 
         Raises:
         -------
         ValueError:
-            If the required environment variables are not set.
+            If neither the parameters nor the environment variables are set, or a KV cache type is not supported.
         """
-        self.url = os.getenv('MODEL_DOWNLOAD_URL')
-        self.filename = os.getenv('MODEL_BIN_PATH')
+        kv_type(KV_TYPE_K)
+        kv_type(KV_TYPE_V)
+        self.url = url or os.getenv('MODEL_DOWNLOAD_URL')
+        self.filename = filename or os.getenv('MODEL_BIN_PATH')
+        self.sha256 = (sha256 if sha256 is not None else os.getenv('MODEL_SHA256', '')).lower()
+        self.connections = max(1, int(os.getenv('DOWNLOAD_CONNECTIONS', '8')))
         self.gpu_layers = int(os.getenv('GPU_LAYERS', '0'))  # Default to 0 GPU layers
         self.verbose = True  # Always use verbose mode (non-verbose leads to errors)
-        self.n_ctx = int(os.getenv('N_CTX', '0'))
+        self.n_ctx = n_ctx if n_ctx is not None else int(os.getenv('N_CTX', '0'))
+        self.draft = draft if draft is not None else os.getenv('DRAFT_MODEL', '')
+        self.draft_url = draft_url if draft_url is not None else os.getenv('DRAFT_DOWNLOAD_URL', '')
+        self.draft_tokens = draft_tokens if draft_tokens is not None else DRAFT_TOKENS
+        self.supports_batching = not self.draft
+        self.type_k = KV_TYPE_K
+        self.type_v = KV_TYPE_V
+        self.flash_attn = FLASH_ATTN or self.type_v not in ("f16", "f32")
+        self.mlock = MLOCK
 
         if not self.url or not self.filename:
             raise ValueError("MODEL_DOWNLOAD_URL and MODEL_BIN_PATH must be set.")
@@ -55,6 +216,12 @@ class ModelHandler:
         """
         Downloads the model from the specified URL and saves it locally.
 
+        The file is downloaded to a ".part" file next to the target and only renamed to the
+        target once it is complete (and matches the expected SHA-256, if one is set), so an
+        interrupted download never leaves a truncated model behind. If the server supports
+        range requests, the file is split into segments downloaded in parallel, and an
+        interrupted download resumes where it stopped.
+
         Returns:
         --------
         str
@@ -66,22 +233,202 @@ class ModelHandler:
             If the download request fails with an HTTP error.
         IOError:
             If there is an error writing to the file.
+        ValueError:
+            If the checksum of the downloaded file does not match.
         """
         print(f"Downloading model from {self.url}...")
-        with requests.get(self.url, stream=True) as response:
-            response.raise_for_status()  # Ensure the request was successful
-            with open(self.filename, 'wb') as f:
+        part = self.filename + ".part"
+        size, ranged = self.probe()
+        if ranged and size:
+            self.download_segments(part, size)
+        else:
+            if os.path.exists(part + ".json"):
+                # A preallocated file of a segmented download cannot be continued as a stream
+                os.remove(part + ".json")
+                os.remove(part)
+            self.download_stream(part, ranged)
+
+        if self.sha256:
+            digest = file_sha256(part)
+            if digest != self.sha256:
+                os.remove(part)
+                raise ValueError(f"Checksum mismatch for {self.url}: expected {self.sha256}, got {digest}.")
+            print("Checksum verified.")
+
+        os.replace(part, self.filename)
+        print("Download complete.")
+        return self.filename
+
+    def download_draft(self) -> None:
+        """
+        Downloads the draft model if speculative decoding uses one that is not found locally.
+
+        Raises:
+        -------
+        ValueError:
+            If the draft model is missing and no download URL is set.
+        """
+        if not self.draft or self.draft == PROMPT_LOOKUP or os.path.exists(self.draft):
+            return
+        if not self.draft_url:
+            raise ValueError(f"Draft model {self.draft} not found and no DRAFT_DOWNLOAD_URL set.")
+        ModelHandler(url=self.draft_url, filename=self.draft, sha256="", draft="").download_file()
+
+    def probe(self) -> Tuple[Optional[int], bool]:
+        """
+        Asks the server for the size of the model and whether it supports range requests.
+
+        Returns:
+        --------
+        Tuple[Optional[int], bool]
+            The size in bytes, if known, and whether range requests are supported.
+        """
+        with requests.get(self.url, headers={"Range": "bytes=0-0"}, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+                total = response.headers["Content-Range"].rsplit("/", 1)[1]
+                return (int(total) if total.isdigit() else None), True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else None), False
+
+    def download_stream(self, part: str, ranged: bool) -> None:
+        """
+        Downloads the model on a single connection, continuing a partial file if the server
+        supports range requests.
+
+        Parameters:
+        -----------
+        part : str
+            The path of the partial file.
+        ranged : bool
+            Whether the server supports range requests.
+        """
+        offset = os.path.getsize(part) if ranged and os.path.exists(part) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            length = response.headers.get("Content-Length")
+            progress = DownloadProgress(offset + int(length) if length else None, offset)
+            with open(part, 'ab' if offset else 'wb') as f:
                 for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
                     if chunk:  # Avoid writing keep-alive chunks
                         f.write(chunk)
-        print("Download complete.")
-        return self.filename
+                        progress.add(len(chunk))
+
+    def download_segments(self, part: str, size: int) -> None:
+        """
+        Downloads the model in parallel segments written into a preallocated partial file.
+        The progress of each segment is recorded in a ".json" file next to the partial file
+        so an interrupted download resumes where it stopped.
 
-    def build(self) -> Llama:
+        Parameters:
+        -----------
+        part : str
+            The path of the partial file.
+        size : int
+            The size of the model in bytes.
+        """
+        state_path = part + ".json"
+        segments = None
+        if os.path.exists(part) and os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                if state.get("url") == self.url and state.get("size") == size:
+                    segments = state["segments"]
+            except (OSError, ValueError, KeyError):
+                segments = None
+        if segments is None:
+            step = -(-size // self.connections)
+            segments = [[start, min(start + step, size), start] for start in range(0, size, step)]
+            with open(part, 'wb') as f:
+                f.truncate(size)
+
+        lock = threading.Lock()
+        progress = DownloadProgress(size, sum(done - start for start, _, done in segments))
+
+        def save_state() -> None:
+            with lock:
+                with open(state_path + ".tmp", 'w') as f:
+                    json.dump({"url": self.url, "size": size, "segments": segments}, f)
+                os.replace(state_path + ".tmp", state_path)
+
+        def fetch(segment: List[int]) -> None:
+            for attempt in range(self.RETRIES):
+                if segment[2] >= segment[1]:
+                    return
+                try:
+                    headers = {"Range": f"bytes={segment[2]}-{segment[1] - 1}"}
+                    with requests.get(self.url, headers=headers, stream=True, timeout=self.TIMEOUT) as response:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            raise requests.exceptions.HTTPError("Server ignored the range request.")
+                        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                            if chunk:
+                                chunk = chunk[:segment[1] - segment[2]]
+                                os.pwrite(fd, chunk, segment[2])
+                                segment[2] += len(chunk)
+                                if progress.add(len(chunk)):
+                                    save_state()
+                except requests.exceptions.RequestException as e:
+                    if attempt == self.RETRIES - 1:
+                        raise
+                    print(f"Warning: {e}. Retrying segment at byte {segment[2]}...")
+            if segment[2] < segment[1]:
+                raise IOError(f"Segment ending at byte {segment[1]} is incomplete.")
+
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                for future in [executor.submit(fetch, segment) for segment in segments]:
+                    future.result()
+        finally:
+            os.close(fd)
+            save_state()
+        os.remove(state_path)
+
+    def context_settings(self) -> Dict[str, Any]:
+        """
+        Retrieves the KV cache settings of the model's contexts.
+
+        Returns:
+        --------
+        Dict[str, Any]
+            The ggml types "type_k" and "type_v" and whether "flash_attn" is enabled.
+        """
+        return {"type_k": kv_type(self.type_k), "type_v": kv_type(self.type_v), "flash_attn": self.flash_attn}
+
+    def build(self, n_threads: Optional[int] = None, n_ctx: Optional[int] = None,
+              n_threads_batch: Optional[int] = None, n_batch: Optional[int] = None) -> Llama:
         """
         Builds and returns an instance of the Llama model.
 
         If the model binary is not found locally, it will be downloaded first.
+        The weights are memory-mapped, so several instances built from the same file
+        share one copy of the weights in the page cache and only add their own context.
+
+        With a draft configured, the instance decodes speculatively: the draft proposes several
+        tokens that the model verifies in a single evaluation. Llama then keeps the logits of every
+        context position, which costs n_ctx * n_vocab * 4 bytes per instance (about 16 GB at 32k
+        tokens and a 128k vocabulary), so speculative decoding suits moderate context sizes and
+        is refused above DRAFT_MAX_LOGITS_BYTES.
+
+        The KV cache uses the configured types, which shrink it to about half (q8_0) or a quarter
+        (q4_0) of f16 at a small loss of accuracy, and the weights are locked in RAM if MLOCK is set.
+
+        Parameters:
+        -----------
+        n_threads : Optional[int]
+            The number of threads used for generation. Defaults to one per physical core
+            the process may use, capped by the CPU quota of the container.
+        n_ctx : Optional[int]
+            The context size, overriding N_CTX.
+        n_threads_batch : Optional[int]
+            The number of threads used for prompt processing. Defaults to n_threads.
+        n_batch : Optional[int]
+            The maximum number of prompt tokens evaluated at once. Defaults to 512.
 
         Returns:
         --------
@@ -90,6 +437,8 @@ class ModelHandler:
 
         Raises:
         -------
+        ValueError:
+            If the logits buffer of speculative decoding exceeds DRAFT_MAX_LOGITS_BYTES.
         Exception:
             If the Llama model initialization fails.
         """
@@ -97,15 +446,32 @@ class ModelHandler:
             print("Specified model not found. Downloading...")
             self.download_file()
 
+        if n_threads is None:
+            n_threads = default_threads()
+        if n_threads_batch is None:
+            n_threads_batch = n_threads
+        if n_ctx is None:
+            n_ctx = self.n_ctx
+        self.download_draft()
+        # Each instance gets its own draft, as a draft model keeps the state of one generation
+        draft_model = make_draft(self.draft, n_ctx, n_threads, self.draft_tokens)
+        if draft_model is not None:
+            print(f"Speculative decoding with {self.draft}.")
+
         try:
-            print("Initializing Llama model...")
+            print(f"Initializing Llama model with {n_threads} threads...")
             llm = Llama(
                 model_path=self.filename,
                 verbose=self.verbose,
-                n_ctx=self.n_ctx,
+                n_ctx=n_ctx,
                 n_gpu_layers=self.gpu_layers,
-                n_threads=multiprocessing.cpu_count(),
-                n_threads_batch=multiprocessing.cpu_count()
+                n_threads=n_threads,
+                n_threads_batch=n_threads_batch,
+                n_batch=n_batch or 512,
+                draft_model=draft_model,
+                logits_all=draft_model is not None,
+                use_mlock=self.mlock,
+                **self.context_settings()
             )
         except Exception as e:
             print(f"Warning: {e}. Retrying without batch threading...")
@@ -113,8 +479,21 @@ class ModelHandler:
                 model_path=self.filename,
                 verbose=self.verbose,
                 n_gpu_layers=self.gpu_layers,
-                n_ctx=self.n_ctx
+                n_ctx=n_ctx,
+                n_threads=n_threads,
+                n_batch=n_batch or 512,
+                draft_model=draft_model,
+                logits_all=draft_model is not None,
+                use_mlock=self.mlock,
+                **self.context_settings()
             )
 
+        if draft_model is not None:
+            logits_bytes = llm.n_ctx() * llm.n_vocab() * 4
+            if logits_bytes > DRAFT_MAX_LOGITS_BYTES:
+                llm.close()
+                raise ValueError(f"Speculative decoding keeps {logits_bytes / 2**30:.1f} GiB of logits per worker at "
+                                 f"{llm.n_ctx()} tokens of context, above DRAFT_MAX_LOGITS_BYTES; lower N_CTX.")
+
         print("Llama model initialized successfully.")
         return llm
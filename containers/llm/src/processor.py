@@ -1,84 +1,204 @@
 import os
+import time
 import threading  # Import threading for concurrency
+from typing import Any, Callable, Dict, List, Optional
+from backend import ChatBackend, Handler
+from batching import BatchProcessor
+from cache import DiskStateStore, PrefixCache, ResponseCache, SemanticCache, cache_completion
+from context import TokenCounter, fit_messages, make_counter, prompt_budget
+from jobtools import ChatJob, JobRegister, ThroughputTracker
+from memory import (KV_BUDGET_BYTES, MODEL_PREFETCH, choose_n_ctx, context_length, format_report, kv_bytes_per_token,
+                    memory_report, prefetch, read_metadata)
 from model import ModelHandler
-from jobtools import ChatJob, JobRegister, RoleToggle
+from scheduler import SchedulerClosed
+from tuning import AUTOTUNE, cpu_budget, default_threads, tune
+import metrics
 
-# Initialize the model handler and load the LLM
-model_handler = ModelHandler()
-llm = model_handler.build()
+# Number of inference workers and CPU threads per worker; by default the physical cores the
+# process may use, within the CPU quota of the container, are split between the workers
+WORKERS = max(1, int(os.getenv('WORKERS', '1')))
+THREADS_PER_WORKER = int(os.getenv('THREADS_PER_WORKER', '0')) or max(1, default_threads() // WORKERS)
+# The most threads per worker autotuning tries, including SMT siblings
+AUTOTUNE_MAX_THREADS = int(os.getenv('THREADS_PER_WORKER', '0')) or max(1, cpu_budget(physical=False) // WORKERS)
+
+# Number of jobs each worker decodes concurrently; values above 1 enable continuous batching
+BATCH_SEQUENCES = max(1, int(os.getenv('BATCH_SEQUENCES', '1')))
+# Total context of a batching worker, shared evenly by its sequences; 0 uses the model's context size
+BATCH_N_CTX = int(os.getenv('BATCH_N_CTX', '0'))
+# Tokens a batching worker decodes per step; 0 uses the autotuned prompt batch size, or else 512
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', '0'))
+# Number of jobs the whole pool processes at the same time
+PARALLEL_JOBS = WORKERS * BATCH_SEQUENCES
+
+# Memory cap of the conversation prefix cache shared by the workers; 0 disables it
+PREFIX_CACHE_BYTES = int(os.getenv('PREFIX_CACHE_BYTES', '0'))
+# On-disk store for idle conversation states; an empty directory disables it
+KV_STATE_DIR = os.getenv('KV_STATE_DIR', '')
+KV_STATE_DISK_BYTES = int(os.getenv('KV_STATE_DISK_BYTES', str(20 * 1024 ** 3)))
+KV_STATE_IDLE_SECONDS = float(os.getenv('KV_STATE_IDLE_SECONDS', '600'))
 
 
 class MainProcessor(threading.Thread):
     """
     A thread-based class that processes jobs (ChatJob) from a task queue using an LLM. 
     It pulls jobs from the queue, processes them based on the job type, and updates the job's status and content.
+    Several processors may share one task queue, each with its own Llama context.
     
     Attributes:
         taskLock (threading.Lock): A lock to ensure thread-safe access to shared resources.
         taskQueue (queue.Queue): The queue holding jobs to be processed.
         jobReg (JobRegister): A registry for managing and retrieving job objects by their UUID.
+        llm (ChatBackend): The model instance this processor generates with, usually a Llama.
+        tracker (ThroughputTracker): Collects the duration and length of finished jobs.
+        responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+        semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+        counter (TokenCounter): Counts the tokens of messages with the model's tokenizer.
+        n_ctx (int): The context size of the model; conversations are compacted to fit it.
+        busy (bool): Whether the processor is working on a job.
     """
 
-    def __init__(self, taskLock: threading.Lock, taskQueue: "queue.Queue[str]", jobReg: JobRegister):
+    def __init__(self, taskLock: threading.Lock, taskQueue: "queue.Queue[str]", jobReg: JobRegister, llm: ChatBackend,
+                 tracker: ThroughputTracker, responseCache: Optional[ResponseCache] = None,
+                 semanticCache: Optional[SemanticCache] = None, counter: Optional[TokenCounter] = None,
+                 n_ctx: int = 0):
         """
-        Initializes the MainProcessor thread with a task lock, a task queue, and a job registry.
+        Initializes the MainProcessor thread with a task lock, a task queue, a job registry and a model.
 
         Args:
             taskLock (threading.Lock): A lock for synchronizing job-related operations.
             taskQueue (queue.Queue): A queue containing job UUIDs to be processed.
             jobReg (JobRegister): A job registry to manage and retrieve jobs.
+            llm (ChatBackend): The model instance used exclusively by this processor.
+            tracker (ThroughputTracker): Collects the duration and length of finished jobs.
+            responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+            semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+            counter (Optional[TokenCounter]): A token counter shared with the other workers of the model.
+                Defaults to a counter of its own.
+            n_ctx (int): The context size of the model; 0 disables compaction.
         """
         super().__init__()  # Initialize the threading.Thread class
         self.taskLock = taskLock
         self.taskQueue = taskQueue
         self.jobReg = jobReg
+        self.llm = llm
+        self.tracker = tracker
+        self.responseCache = responseCache
+        self.semanticCache = semanticCache
+        self.counter = counter if counter is not None else make_counter(llm)
+        self.n_ctx = n_ctx
+        self.busy = False
 
     def run(self):
         """
         The main loop of the thread. Continuously pulls jobs from the task queue and processes them.
         For each job, it determines whether it's a ChatJob and processes it accordingly.
+        Exits and frees the model context once the task queue is closed.
         """
         while True:
             # Retrieve a job UUID from the task queue (blocking call)
-            uuid = self.taskQueue.get(block=True)
+            try:
+                uuid = self.taskQueue.get(block=True)
+            except SchedulerClosed:
+                break
 
+            self.busy = True
             try:
                 # Retrieve the job from the job registry using the UUID
                 job = self.jobReg.get_job(uuid)
                 
                 if isinstance(job, ChatJob):
-                    self.process_chat_job(job)
+                    metrics.QUEUE_WAIT.observe(time.monotonic() - job.get_created_at())
+                    if job.is_cancelled():
+                        job.set_status("cancelled")
+                        metrics.JOBS.inc(outcome="cancelled")
+                    elif job.is_expired():
+                        # Nobody waits for the answer any more, so skip the prefill
+                        job.set_status("expired")
+                        metrics.JOBS.inc(outcome="expired")
+                    else:
+                        self.process_chat_job(job)
                 else:
                     print(f"Unknown job type for UUID: {uuid}")
 
             finally:
                 # Mark the task as done to avoid deadlocks
                 self.taskQueue.task_done()
+                self.busy = False
+        self.release()
+
+    def is_idle(self) -> bool:
+        """
+        Checks whether the processor is waiting for a job.
+
+        Returns:
+            bool: True if no job is being processed.
+        """
+        return not self.busy
+
+    def release(self) -> None:
+        """
+        Frees the model context of the processor.
+        """
+        if hasattr(self.llm, "close"):
+            self.llm.close()
+        self.llm = None
+
+    def warmup(self, prompt: str, max_tokens: int) -> None:
+        """
+        Generates a few tokens before the processor is started, so the first job does not pay
+        for page faults and first-time allocations.
+
+        Args:
+            prompt (str): The user message to answer.
+            max_tokens (int): The number of tokens to generate.
+        """
+        self.llm.create_chat_completion([{"role": "user", "content": prompt}], max_tokens=max_tokens)
+        self.llm.reset()
+
+    def get_prompt_budget(self, max_tokens: Optional[int] = None) -> Optional[int]:
+        """
+        Computes the number of tokens the prompt of a job may use.
+
+        Args:
+            max_tokens (Optional[int]): The job's limit on generated tokens, if any.
+
+        Returns:
+            Optional[int]: The budget, or None if the context size is unknown.
+        """
+        return prompt_budget(self.n_ctx, max_tokens) if self.n_ctx > 0 else None
 
     def process_chat_job(self, job: ChatJob):
         """
         Process a ChatJob by streaming responses from an LLM and updating the job's status and content.
+        The oldest exchanges of the conversation are dropped if its prompt exceeds the budget, so
+        prefill time stays bounded however long the conversation grows.
+        The generation stops early if the job is cancelled or its deadline passes.
 
         Args:
             job (ChatJob): The chat job to process.
         """
         try:
             job.set_status("processing")
-            toggle = RoleToggle("user", "assistant")
-            messages = [{"role": "system", "content": job.get_sys_prompt()}]
-
-            # Append previous messages to the conversation
-            for message in job.get_messages():
-                messages.append({"role": toggle.toggle(), "content": message})
+            started = time.monotonic()
+            messages = job.get_chat_messages()
+            failed = False
+            first_token = 0.0
 
             try:
+                budget = self.get_prompt_budget(job.get_params().get("max_tokens"))
+                if budget is not None:
+                    messages, _ = fit_messages(messages, self.counter, budget)
                 # Stream the response from the LLM
                 print(messages)
-                completionStream = llm.create_chat_completion(
-                    messages, stream=True
+                completionStream = self.llm.create_chat_completion(
+                    messages, stream=True, **job.get_params()
                 )
                 for chunk in completionStream:
+                    if job.is_cancelled() or job.is_expired():
+                        completionStream.close()  # Stop generating for a job nobody reads
+                        break
                     if chunk.get('choices')[0].get('delta').get('content'):
+                        first_token = first_token or time.monotonic()
                         job.append_chunk(chunk.get('choices')[0].get('delta').get('content'))  # Store streamed chunk in the job
 
             except Exception as e:
@@ -86,9 +206,246 @@ class MainProcessor(threading.Thread):
                 print(f"Error during LLM completion: {e}")
                 error_message = os.getenv('CHATERROR', 'An error occurred.')
                 job.append_chunk(error_message)
+                failed = True
 
             # Finalize the job by appending the full message and setting status
-            job.set_status("finished")
+            if job.is_cancelled():
+                job.set_status("cancelled")
+                metrics.JOBS.inc(outcome="cancelled")
+            elif job.is_expired():
+                job.set_status("expired")
+                metrics.JOBS.inc(outcome="expired")
+            else:
+                self.tracker.record(time.monotonic() - started, job.count_chunks())
+                if not failed:
+                    cache_completion(job, self.responseCache, self.semanticCache)
+                    metrics.record_generation(job.get_created_at(), started, first_token,
+                                              time.monotonic(), job.count_chunks())
+                metrics.JOBS.inc(outcome="failed" if failed else "finished")
+                job.set_status("finished")
         except Exception as e:
             print(f"Error during ChatJob processing: {e}")
-    
\ No newline at end of file
+
+
+def build_workers(model_handler: Handler, taskLock: threading.Lock, taskQueue: "queue.Queue[str]",
+                  jobReg: JobRegister, tracker: ThroughputTracker, responseCache: Optional[ResponseCache] = None,
+                  semanticCache: Optional[SemanticCache] = None,
+                  timings: Optional[Dict[str, float]] = None,
+                  memory: Optional[Dict[str, Any]] = None) -> List[threading.Thread]:
+    """
+    Builds one Llama context of a model per worker and a MainProcessor for each on the shared task queue.
+    The workers are returned unstarted.
+
+    The CPU threads are split between the workers so that they do not oversubscribe the host.
+    With AUTOTUNE=1 the thread counts for decode and prefill and the prompt batch size of llama
+    models are benchmarked first, or read from the result cached for this host and model; the
+    batch size also applies to batching workers unless BATCH_SIZE is set.
+    For llama models the weights are read into the page cache first if MODEL_PREFETCH is set, and
+    the context is shrunk to the largest of CTX_TIERS whose KV caches fit KV_BUDGET_BYTES.
+    With BATCH_SEQUENCES above 1 every worker is a BatchProcessor that interleaves that many jobs instead,
+    or, for backends without a batch API, BATCH_SEQUENCES MainProcessors so the pool runs as many jobs.
+    Otherwise the workers share a PrefixCache if PREFIX_CACHE_BYTES is set and the model has no
+    draft, which spills idle conversations to KV_STATE_DIR if that is set. All workers share one TokenCounter.
+
+    Args:
+        model_handler (Handler): The model to build the workers from.
+        taskLock (threading.Lock): A lock for synchronizing job-related operations.
+        taskQueue (queue.Queue): The shared queue containing job UUIDs to be processed.
+        jobReg (JobRegister): A job registry to manage and retrieve jobs.
+        tracker (ThroughputTracker): Collects the duration and length of finished jobs.
+        responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+        semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+        timings (Optional[Dict[str, float]]): Receives the seconds spent loading the model ("load",
+            which includes mapping the weights) and creating the contexts of the other workers ("init").
+        memory (Optional[Dict[str, Any]]): Receives the memory report of llama models: the weights,
+            the KV cache types, the context size, the KV cache bytes and the resident memory.
+
+    Returns:
+        List[threading.Thread]: The worker threads.
+    """
+    batching = BATCH_SEQUENCES > 1 and model_handler.supports_batching
+    count = WORKERS if batching else PARALLEL_JOBS
+    timings = timings if timings is not None else {}
+    settings = {"n_threads": THREADS_PER_WORKER}
+    if AUTOTUNE and isinstance(model_handler, ModelHandler):
+        started = time.monotonic()
+        try:
+            result = tune(model_handler, AUTOTUNE_MAX_THREADS)
+            settings = {name: result[name] for name in ("n_threads", "n_threads_batch", "n_batch")}
+        except Exception as e:
+            print(f"Warning: tuning failed, using {THREADS_PER_WORKER} thread(s): {e}")
+        timings["tune"] = time.monotonic() - started
+    n_ctx = (BATCH_N_CTX or model_handler.n_ctx) if batching else model_handler.n_ctx
+    per_token = None
+    context = {}
+    if isinstance(model_handler, ModelHandler):
+        if MODEL_PREFETCH:
+            timings["prefetch"] = prefetch(model_handler.filename)
+        if KV_BUDGET_BYTES > 0:
+            metadata = read_metadata(model_handler.filename)
+            per_token = kv_bytes_per_token(metadata, model_handler.type_k, model_handler.type_v)
+            # A context size of 0 means the training context of the model
+            n_ctx = choose_n_ctx(n_ctx or context_length(metadata), per_token, count)
+        context = model_handler.context_settings()
+    print(f"Building {count} inference worker(s) with {settings}...")
+    workers = []
+    prefix_cache = None
+    if PREFIX_CACHE_BYTES > 0 and getattr(model_handler, "draft", ""):
+        # The saved states would include the logits of every position, n_vocab floats per token
+        print("The prefix cache is not used with speculative decoding.")
+    elif PREFIX_CACHE_BYTES > 0:
+        disk = None
+        if KV_STATE_DIR:
+            # States only fit the model and context size they were saved from
+            fingerprint = f"{os.path.basename(model_handler.filename)}-{n_ctx}"
+            disk = DiskStateStore(os.path.join(KV_STATE_DIR, fingerprint), KV_STATE_DISK_BYTES)
+        prefix_cache = PrefixCache(PREFIX_CACHE_BYTES, disk, KV_STATE_IDLE_SECONDS)
+    counter = None
+    for index in range(count):
+        started = time.monotonic()
+        if batching:
+            # The Llama only serves as tokenizer and weight holder, so it gets a minimal context
+            llm = model_handler.build(n_threads=settings["n_threads"], n_ctx=512)
+            # All workers share the token counts of the first, as they use the same tokenizer
+            counter = counter or make_counter(llm)
+            worker = BatchProcessor(taskLock, taskQueue, jobReg, llm, tracker, responseCache, semanticCache,
+                                    n_seq=BATCH_SEQUENCES, n_ctx=n_ctx, n_batch=BATCH_SIZE or settings.get("n_batch", 512),
+                                    n_threads=settings["n_threads"], counter=counter,
+                                    n_threads_batch=settings.get("n_threads_batch"), **context)
+            worker_ctx = worker.seq_ctx * BATCH_SEQUENCES
+        else:
+            llm = model_handler.build(n_ctx=n_ctx, **settings)
+            counter = counter or make_counter(llm)
+            # A Llama built with n_ctx 0 uses the training context of the model
+            worker_ctx = llm.n_ctx() if callable(getattr(llm, "n_ctx", None)) else n_ctx
+            worker = MainProcessor(taskLock, taskQueue, jobReg, llm, tracker, responseCache, semanticCache,
+                                   counter=counter, n_ctx=worker_ctx)
+        # Only the first worker maps the weights; the others find them in the page cache
+        phase = "load" if index == 0 else "init"
+        timings[phase] = timings.get(phase, 0.0) + time.monotonic() - started
+        workers.append(worker)
+    if isinstance(model_handler, ModelHandler) and memory is not None:
+        if per_token is None:
+            # Without a budget the metadata is only needed here, and the built model has it
+            per_token = kv_bytes_per_token(workers[0].llm.metadata, model_handler.type_k, model_handler.type_v)
+        memory.update(memory_report(model_handler, worker_ctx, per_token, count))
+        print(format_report(memory))
+    if prefix_cache is not None:
+        # Attached only now so that warmup generations are not cached
+        for worker in workers:
+            if isinstance(worker, MainProcessor):
+                worker.llm.set_cache(prefix_cache)
+    return workers
+
+
+class ModelLoader(threading.Thread):
+    """
+    A thread that downloads a model if needed, builds and warms up the workers and then starts
+    them, so the web server can answer while the model is loading. Jobs queued in the meantime
+    are processed once the workers are started.
+
+    Attributes:
+        model_handler (Handler): The model to load.
+        reserve (Optional[Callable[[], bool]]): Makes room for the model in memory; loading waits
+            until it returns True.
+        state (str): One of "starting", "downloading", "waiting", "loading", "warming", "ready" and "failed".
+        error (str): The error that made loading fail, if any.
+        timings (Dict[str, float]): Seconds spent in each phase: "download", "wait", "prefetch", "load", "init",
+            "warmup" and "total".
+        memory (Dict[str, Any]): The memory report of the workers, once they are built.
+        workers (List[threading.Thread]): The started workers; empty until ready.
+        warmup_prompt (str): The prompt generated once by every worker before it is started.
+        warmup_tokens (int): The number of tokens of the warmup generation; 0 disables warmup.
+    """
+
+    def __init__(self, model_handler: Handler, taskLock: threading.Lock, taskQueue: "queue.Queue[str]",
+                 jobReg: JobRegister, tracker: ThroughputTracker, responseCache: Optional[ResponseCache] = None,
+                 semanticCache: Optional[SemanticCache] = None, reserve: Optional[Callable[[], bool]] = None):
+        """
+        Initializes the ModelLoader with the model and the arguments of the workers.
+
+        Args:
+            model_handler (Handler): The model to load.
+            taskLock (threading.Lock): A lock for synchronizing job-related operations.
+            taskQueue (queue.Queue): The shared queue containing job UUIDs to be processed.
+            jobReg (JobRegister): A job registry to manage and retrieve jobs.
+            tracker (ThroughputTracker): Collects the duration and length of finished jobs.
+            responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+            semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+            reserve (Optional[Callable[[], bool]]): Makes room for the model in memory.
+        """
+        super().__init__(daemon=True)
+        self.model_handler = model_handler
+        self.reserve = reserve
+        self.args = (taskLock, taskQueue, jobReg, tracker, responseCache, semanticCache)
+        self.state = "starting"
+        self.error = ""
+        self.timings: Dict[str, float] = {}
+        self.memory: Dict[str, Any] = {}
+        self.workers: List[threading.Thread] = []
+        self.warmup_prompt = os.getenv('WARMUP_PROMPT', 'Hello')
+        self.warmup_tokens = int(os.getenv('WARMUP_TOKENS', '8'))
+
+    def run(self):
+        """
+        Loads the model and starts the workers, recording the duration of each phase.
+        """
+        started = time.monotonic()
+        try:
+            if not os.path.exists(self.model_handler.filename):
+                self.state = "downloading"
+                self.model_handler.download_file()
+                self.timings["download"] = time.monotonic() - started
+
+            if self.reserve is not None and not self.reserve():
+                self.state = "waiting"
+                phase_started = time.monotonic()
+                while not self.reserve():
+                    time.sleep(1)
+                self.timings["wait"] = time.monotonic() - phase_started
+
+            self.state = "loading"
+            workers = build_workers(self.model_handler, *self.args, timings=self.timings, memory=self.memory)
+
+            if self.warmup_tokens > 0:
+                self.state = "warming"
+                phase_started = time.monotonic()
+                for worker in workers:
+                    # The first generation pays for page faults and buffer allocations
+                    worker.warmup(self.warmup_prompt, self.warmup_tokens)
+                self.timings["warmup"] = time.monotonic() - phase_started
+
+            for worker in workers:
+                worker.start()
+            self.workers = workers
+            self.timings["total"] = time.monotonic() - started
+            self.state = "ready"
+            print(f"Model ready: {', '.join(f'{name} {seconds:.1f}s' for name, seconds in self.timings.items())}")
+        except Exception as e:
+            print(f"Error while loading the model: {e}")
+            self.error = str(e)
+            self.state = "failed"
+
+    def is_ready(self) -> bool:
+        """
+        Checks whether the workers are started.
+
+        Returns:
+            bool: True once the model is loaded and warmed up.
+        """
+        return self.state == "ready"
+
+    def get_status(self) -> Dict[str, Any]:
+        """
+        Retrieves the loading state, error, phase timings and memory report.
+
+        Returns:
+            Dict[str, Any]: The state, the error (if any), the timings in seconds and the memory
+                report (once the workers of a llama model are built).
+        """
+        status = {"state": self.state, "timings": dict(self.timings)}
+        if self.memory:
+            status["memory"] = dict(self.memory)
+        if self.error:
+            status["error"] = self.error
+        return status
@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from backend import BACKEND, Handler, make_handler
+from remote import RemoteModelHandler
+from processor import ModelLoader
+from cache import ResponseCache, SemanticCache
+from jobtools import JobRegister, ThroughputTracker
+from scheduler import FairScheduler
+
+# States in which a model occupies memory or is about to
+RESIDENT_STATES = ("starting", "downloading", "loading", "warming", "ready")
+
+
+class ModelEntry:
+    """
+    A model declared in the registry, with its own task queue, throughput statistics and,
+    while it is loaded, the loader that started its workers.
+
+    Attributes:
+        name (str): The name clients select the model by.
+        handler (Handler): Downloads and builds the model.
+        ram_bytes (int): The configured memory footprint; 0 estimates it from the file size.
+        queue (FairScheduler): The jobs waiting for this model.
+        tracker (ThroughputTracker): Collects the duration and length of the model's finished jobs.
+        loader (Optional[ModelLoader]): The loader of the current instance; None while unloaded.
+        last_used (float): The monotonic time of the last job submitted for the model.
+        was_ready (bool): Whether the model has been loaded successfully at least once.
+    """
+
+    def __init__(self, name: str, handler: Handler, queue: FairScheduler, ram_bytes: int = 0):
+        """
+        Initializes an unloaded ModelEntry.
+
+        Args:
+            name (str): The name of the model.
+            handler (Handler): Downloads and builds the model.
+            queue (FairScheduler): The task queue of the model.
+            ram_bytes (int): The memory footprint; 0 estimates it from the file size.
+        """
+        self.name = name
+        self.handler = handler
+        self.ram_bytes = ram_bytes
+        self.queue = queue
+        self.tracker = ThroughputTracker()
+        self.loader: Optional[ModelLoader] = None
+        self.last_used = 0.0
+        self.was_ready = False
+
+    def get_state(self) -> str:
+        """
+        Retrieves the loading state of the model.
+
+        Returns:
+            str: The state of the loader, or "unloaded".
+        """
+        state = self.loader.state if self.loader is not None else "unloaded"
+        if state == "ready":
+            self.was_ready = True
+        return state
+
+    def is_ready(self) -> bool:
+        """
+        Checks whether the model can serve jobs: it is loaded, or it has been loaded before and was
+        unloaded to make room, in which case the next job loads it again.
+
+        Returns:
+            bool: True if the model is or was ready and its last load did not fail.
+        """
+        state = self.get_state()
+        return state == "ready" or (self.was_ready and state != "failed")
+
+    def is_resident(self) -> bool:
+        """
+        Checks whether the model occupies memory or is being loaded into it.
+
+        Returns:
+            bool: True unless the model is unloaded, failed or waiting for memory.
+        """
+        return self.get_state() in RESIDENT_STATES
+
+    def is_idle(self) -> bool:
+        """
+        Checks whether the model is loaded and has neither queued nor running jobs.
+
+        Returns:
+            bool: True if the model can be unloaded without delaying any job.
+        """
+        return (self.get_state() == "ready" and self.queue.qsize() == 0
+                and all(worker.is_idle() for worker in self.loader.workers))
+
+    def get_size(self) -> int:
+        """
+        Estimates the memory footprint of the model: the configured value, or else the size of the
+        memory-mapped weights.
+
+        Returns:
+            int: The size in bytes; 0 while the file has not been downloaded.
+        """
+        if self.ram_bytes:
+            return self.ram_bytes
+        return os.path.getsize(self.handler.filename) if os.path.exists(self.handler.filename) else 0
+
+
+class ModelRegistry:
+    """
+    A thread-safe registry of the models the service can serve. Models are loaded on the first
+    job that selects them, and idle models are unloaded least recently used first while loading
+    another model would exceed the memory budget.
+
+    Attributes:
+        entries (Dict[str, ModelEntry]): The declared models by name.
+        default (str): The name of the model used when a request names none.
+        budget_bytes (int): The memory available to loaded models; 0 means unlimited.
+        make_queue (Callable[[], FairScheduler]): Creates the task queue of a model.
+        taskLock (threading.Lock): The lock passed on to the workers.
+        jobReg (JobRegister): The job registry passed on to the workers.
+        responseCache (Optional[ResponseCache]): Passed on to the workers.
+        semanticCache (Optional[SemanticCache]): Passed on to the workers.
+        lock (threading.RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, models: Dict[str, Dict[str, Any]], default: str, budget_bytes: int,
+                 make_queue: Callable[[], FairScheduler], taskLock: threading.Lock, jobReg: JobRegister,
+                 responseCache: Optional[ResponseCache] = None, semanticCache: Optional[SemanticCache] = None):
+        """
+        Initializes the registry with the declared models, none of them loaded.
+
+        Args:
+            models (Dict[str, Dict[str, Any]]): Per model name, its specification as accepted by
+                make_handler and optionally "ram_bytes".
+            default (str): The name of the default model.
+            budget_bytes (int): The memory available to loaded models; 0 means unlimited.
+            make_queue (Callable[[], FairScheduler]): Creates the task queue of a model.
+            taskLock (threading.Lock): The lock passed on to the workers.
+            jobReg (JobRegister): The job registry passed on to the workers.
+            responseCache (Optional[ResponseCache]): Stores the completions of cacheable jobs.
+            semanticCache (Optional[SemanticCache]): Stores the answers to single-turn questions.
+
+        Raises:
+            ValueError: If the default model is not declared or a model specification is invalid.
+        """
+        if default not in models:
+            raise ValueError(f"Default model {default} is not declared.")
+        self.entries: Dict[str, ModelEntry] = {
+            name: ModelEntry(
+                name,
+                make_handler(name, spec),
+                make_queue(),
+                int(spec.get("ram_bytes", 0))
+            )
+            for name, spec in models.items()
+        }
+        self.default = default
+        self.budget_bytes = budget_bytes
+        self.make_queue = make_queue
+        self.taskLock = taskLock
+        self.jobReg = jobReg
+        self.responseCache = responseCache
+        self.semanticCache = semanticCache
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def from_env() -> Dict[str, Dict[str, Any]]:
+        """
+        Reads the declared models from the environment: the JSON object MODELS mapping names to
+        model specifications, plus a model named "default" from MODEL_DOWNLOAD_URL, MODEL_BIN_PATH,
+        N_CTX, MODEL_SHA256, DRAFT_MODEL and DRAFT_DOWNLOAD_URL if the first two are set, or else a remote or fake model if BACKEND
+        selects one.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The model specifications by name.
+        """
+        models = json.loads(os.getenv('MODELS', '{}'))
+        if os.getenv('MODEL_DOWNLOAD_URL') and os.getenv('MODEL_BIN_PATH'):
+            models.setdefault("default", {
+                "url": os.getenv('MODEL_DOWNLOAD_URL'),
+                "path": os.getenv('MODEL_BIN_PATH'),
+                "n_ctx": int(os.getenv('N_CTX', '0')),
+                "sha256": os.getenv('MODEL_SHA256', ''),
+                "draft": os.getenv('DRAFT_MODEL', ''),
+                "draft_url": os.getenv('DRAFT_DOWNLOAD_URL', '')
+            })
+        elif BACKEND in ("remote", "fake"):
+            models.setdefault("default", {"backend": BACKEND})
+        return models
+
+    def get_entry(self, name: Optional[str] = None) -> ModelEntry:
+        """
+        Retrieves a declared model.
+
+        Args:
+            name (Optional[str]): The name of the model; None selects the default model.
+
+        Returns:
+            ModelEntry: The model.
+
+        Raises:
+            KeyError: If the model is not declared.
+        """
+        return self.entries[name or self.default]
+
+    def load(self, name: Optional[str] = None) -> ModelEntry:
+        """
+        Starts loading a model in the background unless it is loaded or being loaded.
+        A model whose loading failed is loaded again.
+
+        Args:
+            name (Optional[str]): The name of the model; None selects the default model.
+
+        Returns:
+            ModelEntry: The model.
+        """
+        with self.lock:
+            entry = self.get_entry(name)
+            if entry.loader is None or entry.get_state() == "failed":
+                entry.loader = ModelLoader(
+                    entry.handler, self.taskLock, entry.queue, self.jobReg, entry.tracker,
+                    self.responseCache, self.semanticCache, reserve=lambda: self.reserve(entry)
+                )
+                entry.loader.start()
+            return entry
+
+    def submit(self, name: Optional[str], uuid: str, client_id: str, priority: str, cost: int) -> ModelEntry:
+        """
+        Queues a job for a model and loads the model if necessary.
+
+        Args:
+            name (Optional[str]): The name of the model; None selects the default model.
+            uuid (str): The UUID of the job.
+            client_id (str): The client the job belongs to.
+            priority (str): The priority class.
+            cost (int): The cost used by shortest-prompt-first.
+
+        Returns:
+            ModelEntry: The model.
+
+        Raises:
+            queue.Full: If the model's queue is full.
+        """
+        with self.lock:
+            entry = self.get_entry(name)
+            entry.queue.put_nowait(uuid, client_id, priority, cost)
+            entry.last_used = time.monotonic()
+            self.load(entry.name)
+            return entry
+
+    def remove(self, uuid: str) -> bool:
+        """
+        Removes a queued job from the queue of whichever model it waits for.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            bool: True if the job was queued and has been removed.
+        """
+        with self.lock:
+            return any(entry.queue.remove(uuid) for entry in self.entries.values())
+
+    def qsize(self) -> int:
+        """
+        Returns the number of jobs queued for all models.
+        """
+        with self.lock:
+            return sum(entry.queue.qsize() for entry in self.entries.values())
+
+    def resident_bytes(self, exclude: Optional[ModelEntry] = None) -> int:
+        """
+        Sums the memory footprints of the models that are loaded or being loaded.
+
+        Args:
+            exclude (Optional[ModelEntry]): A model to leave out.
+
+        Returns:
+            int: The total size in bytes.
+        """
+        return sum(entry.get_size() for entry in self.entries.values()
+                   if entry is not exclude and entry.is_resident())
+
+    def reserve(self, entry: ModelEntry) -> bool:
+        """
+        Makes room for a model about to be loaded by unloading idle models, least recently used
+        first, until it fits into the memory budget. Called by the model's loader.
+
+        Args:
+            entry (ModelEntry): The model to make room for.
+
+        Returns:
+            bool: True if the model fits; otherwise the loader waits and tries again.
+        """
+        unloaded = []
+        with self.lock:
+            needed = entry.get_size()
+            while self.budget_bytes and self.resident_bytes(entry) + needed > self.budget_bytes:
+                idle = [other for other in self.entries.values() if other is not entry and other.is_idle()]
+                if not idle:
+                    break
+                unloaded.append(self.unload(min(idle, key=lambda other: other.last_used)))
+            fits = not self.budget_bytes or self.resident_bytes(entry) + needed <= self.budget_bytes
+
+        # The workers free their contexts when they exit
+        for workers in unloaded:
+            for worker in workers:
+                worker.join()
+        return fits
+
+    def unload(self, entry: ModelEntry) -> List[threading.Thread]:
+        """
+        Unloads an idle model: closes its queue, which makes its workers exit and free their
+        contexts, and gives it a fresh queue for future jobs. Must be called with the lock held.
+
+        Args:
+            entry (ModelEntry): The model to unload.
+
+        Returns:
+            List[threading.Thread]: The exiting workers.
+        """
+        print(f"Unloading model {entry.name} to make room for another model.")
+        workers = entry.loader.workers
+        entry.queue.close()
+        entry.queue = self.make_queue()
+        entry.loader = None
+        return workers
+
+    def get_status(self) -> Dict[str, Any]:
+        """
+        Retrieves the state of every declared model.
+
+        Returns:
+            Dict[str, Any]: The default model, the memory budget and use, and per model its state,
+                size, queue length, timings, error, for remote models replicas and, with speculative
+                decoding, the draft.
+        """
+        with self.lock:
+            models = {}
+            for name, entry in self.entries.items():
+                models[name] = {
+                    "state": entry.get_state(),
+                    "bytes": entry.get_size(),
+                    "queue_size": entry.queue.qsize(),
+                    **({"replicas": entry.handler.get_replicas()} if isinstance(entry.handler, RemoteModelHandler) else {}),
+                    **({"draft": entry.handler.draft} if getattr(entry.handler, "draft", "") else {}),
+                    **({k: v for k, v in entry.loader.get_status().items() if k != "state"} if entry.loader else {})
+                }
+            return {
+                "default": self.default,
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": self.resident_bytes(),
+                "models": models
+            }
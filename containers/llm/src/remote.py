@@ -0,0 +1,438 @@
+import os
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+# Seconds to connect to a replica and to wait for its next bytes
+REMOTE_CONNECT_TIMEOUT = float(os.getenv('REMOTE_CONNECT_TIMEOUT', '5'))
+REMOTE_READ_TIMEOUT = float(os.getenv('REMOTE_READ_TIMEOUT', '600'))
+# Seconds between health checks of the replicas
+REMOTE_HEALTH_INTERVAL = float(os.getenv('REMOTE_HEALTH_INTERVAL', '10'))
+# Keep-alive connections kept open per replica
+REMOTE_POOL_SIZE = int(os.getenv('REMOTE_POOL_SIZE', '16'))
+# Seconds the model waits for a healthy replica when it is loaded
+REMOTE_STARTUP_TIMEOUT = float(os.getenv('REMOTE_STARTUP_TIMEOUT', '600'))
+
+
+class NoReplicaAvailable(Exception):
+    """
+    Raised when no replica is healthy or every replica refused the request.
+    """
+
+
+class Replica:
+    """
+    An OpenAI-compatible runtime, such as llama_cpp.server in containers/llm_runtime.
+
+    Attributes:
+        url (str): The base URL, without /v1.
+        outstanding (int): The number of requests in flight.
+        healthy (bool): Whether the last health check or request succeeded.
+        requests (int): The number of requests sent.
+        failures (int): The number of requests that failed to connect or found the replica unavailable.
+    """
+
+    def __init__(self, url: str):
+        """
+        Initializes a Replica, assumed unhealthy until it has been checked.
+
+        Args:
+            url (str): The base URL.
+        """
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = False
+        self.requests = 0
+        self.failures = 0
+
+
+class ReplicaPool:
+    """
+    A thread-safe set of runtime replicas shared by the workers of a model. Requests go to the
+    healthy replica with the fewest requests in flight over pooled keep-alive connections,
+    and a background thread checks the health of every replica periodically.
+
+    Attributes:
+        replicas (List[Replica]): The replicas.
+        session (requests.Session): Holds the keep-alive connections to all replicas.
+        headers (Dict[str, str]): Sent with every request, e.g. the API key.
+        health_interval (float): Seconds between health checks.
+        lock (threading.Lock): Guards the replica counters.
+        checked (threading.Event): Set after the first round of health checks.
+    """
+
+    UNAVAILABLE_STATUSES = (502, 503)  # Answers meaning the replica itself cannot serve requests
+
+    def __init__(self, urls: List[str], api_key: str = "", pool_size: int = REMOTE_POOL_SIZE,
+                 health_interval: float = REMOTE_HEALTH_INTERVAL):
+        """
+        Initializes the pool and starts the health checks.
+
+        Args:
+            urls (List[str]): The base URLs of the replicas.
+            api_key (str): The bearer token of the replicas, if they require one.
+            pool_size (int): The number of keep-alive connections kept per replica.
+            health_interval (float): Seconds between health checks.
+
+        Raises:
+            ValueError: If no URL is given.
+        """
+        if not urls:
+            raise ValueError("A remote model needs at least one replica URL.")
+        self.replicas = [Replica(url) for url in urls]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.checked = threading.Event()
+        threading.Thread(target=self.check_loop, daemon=True).start()
+
+    def check_loop(self) -> None:
+        """
+        Checks every replica, forever, every health_interval seconds.
+        """
+        while True:
+            for replica in self.replicas:
+                self.check(replica)
+            self.checked.set()
+            time.sleep(self.health_interval)
+
+    def check(self, replica: Replica) -> bool:
+        """
+        Checks whether a replica answers its model list.
+
+        Args:
+            replica (Replica): The replica.
+
+        Returns:
+            bool: True if the replica is healthy.
+        """
+        try:
+            response = self.session.get(f"{replica.url}/v1/models", headers=self.headers,
+                                        timeout=(REMOTE_CONNECT_TIMEOUT, REMOTE_CONNECT_TIMEOUT))
+            healthy = response.status_code == 200
+        except requests.RequestException:
+            healthy = False
+        if healthy != replica.healthy:
+            print(f"Runtime replica {replica.url} is {'healthy' if healthy else 'unhealthy'}.")
+        replica.healthy = healthy
+        return healthy
+
+    def wait_healthy(self, timeout: float) -> bool:
+        """
+        Waits until at least one replica is healthy.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            bool: True if a replica is healthy.
+        """
+        deadline = time.monotonic() + timeout
+        self.checked.wait(timeout)
+        while not any(replica.healthy for replica in self.replicas):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(1)
+        return True
+
+    def acquire(self, exclude: List[Replica]) -> Replica:
+        """
+        Picks the healthy replica with the fewest requests in flight and counts a request on it.
+
+        Args:
+            exclude (List[Replica]): Replicas that already failed this request.
+
+        Returns:
+            Replica: The replica.
+
+        Raises:
+            NoReplicaAvailable: If no healthy replica is left.
+        """
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica.healthy and replica not in exclude]
+            if not candidates:
+                raise NoReplicaAvailable("No healthy runtime replica is available.")
+            replica = min(candidates, key=lambda candidate: (candidate.outstanding, candidate.requests))
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica
+
+    def release(self, replica: Replica, failed: bool = False) -> None:
+        """
+        Ends a request on a replica. A replica that failed is taken out of rotation until
+        the next successful health check.
+
+        Args:
+            replica (Replica): The replica.
+            failed (bool): Whether the request failed.
+        """
+        with self.lock:
+            replica.outstanding -= 1
+            if failed:
+                replica.failures += 1
+                replica.healthy = False
+
+    def post(self, path: str, body: Dict[str, Any], stream: bool = False) -> Tuple[requests.Response, Replica]:
+        """
+        Sends a request to the least busy replica, trying the next one if a replica cannot be
+        reached or answers that it is unavailable (502 or 503). Other errors, including read
+        timeouts and other server errors, are passed on without changing the replica's health,
+        as they may be caused by the request itself. The caller must release the replica.
+
+        Args:
+            path (str): The path, e.g. /v1/chat/completions.
+            body (Dict[str, Any]): The JSON body.
+            stream (bool): Whether to stream the response body.
+
+        Returns:
+            Tuple[requests.Response, Replica]: The response and the replica that sent it.
+
+        Raises:
+            NoReplicaAvailable: If every healthy replica failed.
+            requests.HTTPError: If the request was refused or failed, e.g. because it is invalid.
+            requests.RequestException: If the replica did not answer in time.
+        """
+        tried: List[Replica] = []
+        while True:
+            replica = self.acquire(tried)
+            try:
+                response = self.session.post(f"{replica.url}{path}", json=body, headers=self.headers, stream=stream,
+                                             timeout=(REMOTE_CONNECT_TIMEOUT, REMOTE_READ_TIMEOUT))
+            except requests.ConnectionError as e:
+                print(f"Runtime replica {replica.url} failed: {e}")
+                self.release(replica, failed=True)
+                tried.append(replica)
+                continue
+            except requests.RequestException:
+                self.release(replica)
+                raise
+            if response.status_code in self.UNAVAILABLE_STATUSES:
+                print(f"Runtime replica {replica.url} answered {response.status_code}.")
+                response.close()
+                self.release(replica, failed=True)
+                tried.append(replica)
+                continue
+            if response.status_code >= 400:
+                self.release(replica)
+                response.raise_for_status()
+            return response, replica
+
+    def get_status(self) -> List[Dict[str, Any]]:
+        """
+        Retrieves the state of every replica.
+
+        Returns:
+            List[Dict[str, Any]]: Per replica its URL, health, requests in flight, requests and failures.
+        """
+        with self.lock:
+            return [{"url": replica.url, "healthy": replica.healthy, "outstanding": replica.outstanding,
+                     "requests": replica.requests, "failures": replica.failures} for replica in self.replicas]
+
+
+class RemoteLlama:
+    """
+    A stand-in for Llama that forwards chat completions to the replicas of a ReplicaPool.
+
+    Attributes:
+        pool (ReplicaPool): The replicas.
+        model (str): The model name sent to the replicas; empty to use their default.
+    """
+
+    def __init__(self, pool: ReplicaPool, model: str = ""):
+        """
+        Initializes the RemoteLlama.
+
+        Args:
+            pool (ReplicaPool): The replicas, shared with the other workers of the model.
+            model (str): The model name sent to the replicas.
+        """
+        self.pool = pool
+        self.model = model
+
+    def create_chat_completion(self, messages: List[Dict[str, str]], stream: bool = False, **kwargs: Any) -> Any:
+        """
+        Forwards a conversation to /v1/chat/completions.
+
+        Args:
+            messages (List[Dict[str, str]]): The conversation.
+            stream (bool): Whether to return an iterator of chunks.
+            **kwargs (Any): Sampling parameters and limits, e.g. temperature, seed, max_tokens and stop.
+
+        Returns:
+            Any: An iterator of chunks if streaming, else the complete response.
+        """
+        body = {"messages": messages, "stream": stream, **kwargs}
+        if self.model:
+            body["model"] = self.model
+        response, replica = self.pool.post("/v1/chat/completions", body, stream=stream)
+        if stream:
+            return self.stream(response, replica)
+        try:
+            return response.json()
+        finally:
+            self.pool.release(replica)
+
+    def stream(self, response: requests.Response, replica: Replica) -> Iterator[Dict[str, Any]]:
+        """
+        Parses the Server-Sent Events of a streamed completion. Closing the iterator closes the
+        connection, which makes the replica stop generating.
+
+        Args:
+            response (requests.Response): The streamed response.
+            replica (Replica): The replica, released when the stream ends.
+
+        Yields:
+            Dict[str, Any]: The completion chunks.
+        """
+        failed = False
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
+        except requests.ConnectionError:
+            failed = True
+            raise
+        finally:
+            response.close()
+            self.pool.release(replica, failed=failed)
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        """
+        Tokenizes text with the /extras/tokenize endpoint of llama_cpp.server.
+
+        Args:
+            text (bytes): The UTF-8 encoded text.
+            add_bos (bool): Ignored; the replica decides.
+            special (bool): Ignored; the replica decides.
+
+        Returns:
+            List[int]: The tokens, or one placeholder per four bytes if the replica cannot tokenize.
+        """
+        body: Dict[str, Any] = {"input": text.decode("utf-8", errors="ignore")}
+        if self.model:
+            body["model"] = self.model
+        try:
+            response, replica = self.pool.post("/extras/tokenize", body)
+        except (NoReplicaAvailable, requests.HTTPError):
+            return [0] * (len(text) // 4)
+        try:
+            return response.json()["tokens"]
+        except (ValueError, KeyError):
+            return [0] * (len(text) // 4)
+        finally:
+            self.pool.release(replica)
+
+    def reset(self) -> None:
+        """
+        Does nothing, as the replicas keep their own state.
+        """
+
+    def set_cache(self, cache: Any) -> None:
+        """
+        Ignores the prefix cache, as the replicas keep their own state.
+
+        Args:
+            cache (Any): The prefix cache.
+        """
+
+    def close(self) -> None:
+        """
+        Does nothing; the connections belong to the pool.
+        """
+
+
+class RemoteModelHandler:
+    """
+    The counterpart of ModelHandler for the remote backend: the model runs on OpenAI-compatible
+    replicas and build() returns a RemoteLlama. All workers of the model share one ReplicaPool,
+    so the number of jobs forwarded at the same time is the number of workers.
+
+    Attributes:
+        filename (str): A name identifying the model in cache keys; no file is read.
+        n_ctx (int): The nominal context size.
+        supports_batching (bool): False; the replicas batch on their own.
+        urls (List[str]): The base URLs of the replicas.
+        model (str): The model name sent to the replicas.
+        api_key (str): The bearer token of the replicas.
+        pool (Optional[ReplicaPool]): The replicas, created when the model is first built.
+        lock (threading.Lock): Ensures that the workers share one pool.
+    """
+
+    supports_batching = False
+
+    def __init__(self, name: str = "remote", urls: Union[str, List[str], None] = None, model: Optional[str] = None,
+                 n_ctx: Optional[int] = None, api_key: Optional[str] = None):
+        """
+        Initializes the RemoteModelHandler, falling back to the REMOTE_* environment variables.
+
+        Args:
+            name (str): The name of the model.
+            urls (Union[str, List[str], None]): The replica URLs, as a list or comma-separated,
+                overriding REMOTE_URLS.
+            model (Optional[str]): The model name sent to the replicas, overriding REMOTE_MODEL.
+            n_ctx (Optional[int]): The nominal context size, overriding N_CTX.
+            api_key (Optional[str]): The bearer token, overriding REMOTE_API_KEY.
+
+        Raises:
+            ValueError: If no replica URL is configured.
+        """
+        urls = urls if urls is not None else os.getenv('REMOTE_URLS', '')
+        self.urls = [url.strip() for url in (urls.split(",") if isinstance(urls, str) else urls) if url.strip()]
+        if not self.urls:
+            raise ValueError(f"Model {name} needs replica urls or REMOTE_URLS.")
+        self.filename = f"remote-{name}"
+        self.model = model if model is not None else os.getenv('REMOTE_MODEL', '')
+        self.n_ctx = n_ctx or int(os.getenv('N_CTX', '0')) or 4096
+        self.api_key = api_key if api_key is not None else os.getenv('REMOTE_API_KEY', '')
+        self.pool: Optional[ReplicaPool] = None
+        self.lock = threading.Lock()
+
+    def download_file(self) -> str:
+        """
+        Does nothing, as there is no model file.
+
+        Returns:
+            str: The model name.
+        """
+        return self.filename
+
+    def build(self, n_threads: Optional[int] = None, n_ctx: Optional[int] = None) -> RemoteLlama:
+        """
+        Builds a RemoteLlama on the shared replica pool, waiting for a healthy replica.
+
+        Args:
+            n_threads (Optional[int]): Ignored.
+            n_ctx (Optional[int]): Ignored.
+
+        Returns:
+            RemoteLlama: The forwarding model.
+
+        Raises:
+            NoReplicaAvailable: If no replica becomes healthy within REMOTE_STARTUP_TIMEOUT seconds.
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ReplicaPool(self.urls, self.api_key)
+        if not self.pool.wait_healthy(REMOTE_STARTUP_TIMEOUT):
+            raise NoReplicaAvailable(f"No runtime replica of {', '.join(self.urls)} became healthy.")
+        return RemoteLlama(self.pool, self.model)
+
+    def get_replicas(self) -> List[Dict[str, Any]]:
+        """
+        Retrieves the state of the replicas.
+
+        Returns:
+            List[Dict[str, Any]]: The replica states; empty before the model is first built.
+        """
+        return self.pool.get_status() if self.pool is not None else []
@@ -0,0 +1,344 @@
+import os
+import time
+import heapq
+import queue
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+# Priority classes, highest first
+PRIORITIES = ("interactive", "batch")
+
+
+class SchedulerClosed(Exception):
+    """
+    Raised by a closed scheduler once it holds no more jobs, telling the workers to exit.
+    """
+
+
+class ClientQueue:
+    """
+    The queued jobs of one client in one priority class, ordered by prompt cost and by arrival.
+
+    Entries are [cost, sequence, enqueued at, uuid, queued] lists held in both a heap and a FIFO;
+    an entry taken through one of them is marked as no longer queued and skipped by the other.
+
+    Attributes:
+        heap (List[list]): The entries by ascending cost, then arrival.
+        fifo (Deque[list]): The entries in order of arrival.
+        size (int): The number of queued entries.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty ClientQueue.
+        """
+        self.heap: List[list] = []
+        self.fifo: Deque[list] = deque()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, cost: int, sequence: int, uuid: str) -> None:
+        """
+        Queues a job.
+
+        Args:
+            cost (int): The cost the heap orders by.
+            sequence (int): The arrival order, breaking ties between equal costs.
+            uuid (str): The UUID of the job.
+        """
+        entry = [cost, sequence, time.monotonic(), uuid, True]
+        heapq.heappush(self.heap, entry)
+        self.fifo.append(entry)
+        self.size += 1
+
+    def oldest(self) -> list:
+        """
+        Returns the entry that has waited longest. Must only be called on a non-empty queue.
+        """
+        while not self.fifo[0][4]:
+            self.fifo.popleft()
+        return self.fifo[0]
+
+    def pop(self, oldest: bool = False) -> str:
+        """
+        Removes the cheapest entry, or the oldest one. Must only be called on a non-empty queue.
+
+        Args:
+            oldest (bool): Whether to take the entry that has waited longest.
+
+        Returns:
+            str: The UUID of the job.
+        """
+        if oldest:
+            entry = self.oldest()
+            self.fifo.popleft()
+        else:
+            entry = heapq.heappop(self.heap)
+            while not entry[4]:
+                entry = heapq.heappop(self.heap)
+        entry[4] = False
+        self.size -= 1
+        return entry[3]
+
+    def remove(self, uuid: str) -> bool:
+        """
+        Removes a queued job.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            bool: True if the job was queued and has been removed.
+        """
+        for entry in self.fifo:
+            if entry[4] and entry[3] == uuid:
+                entry[4] = False
+                self.size -= 1
+                return True
+        return False
+
+
+class FairScheduler:
+    """
+    A thread-safe replacement for the FIFO task queue that schedules job UUIDs by priority class,
+    shares each class fairly between clients and optionally serves short prompts first.
+
+    Interactive jobs always go before batch jobs. Within a class the clients are served
+    round-robin, so one client queueing many jobs cannot starve the others. Within a client's
+    queue jobs are served in order of arrival or, with shortest-prompt-first, by ascending prompt
+    cost. Once jobs have waited longer than max_wait seconds, the one that has waited longest is
+    served first regardless of its class and cost, so neither batch jobs nor long prompts starve.
+
+    The scheduler implements the parts of the queue.Queue interface the processors use, and
+    raises queue.Full and queue.Empty like it.
+
+    Attributes:
+        maxsize (int): The maximum number of queued jobs; 0 means unbounded.
+        fair (bool): Whether clients are served round-robin instead of in global arrival order.
+        shortest_first (bool): Whether a client's jobs are ordered by prompt cost.
+        max_wait (float): Seconds after which a job is served before higher-priority and cheaper ones.
+        classes (Dict[str, OrderedDict[str, ClientQueue]]): Per priority class, the queue of each
+            client in round-robin order.
+        condition (threading.Condition): Signals waiting consumers about new jobs.
+        closed (bool): Whether the scheduler accepts no more jobs.
+    """
+
+    def __init__(self, maxsize: int = 0, fair: bool = True, shortest_first: bool = False, max_wait: float = 300):
+        """
+        Initializes an empty FairScheduler.
+
+        Args:
+            maxsize (int): The maximum number of queued jobs; 0 means unbounded.
+            fair (bool): Whether clients are served round-robin.
+            shortest_first (bool): Whether a client's jobs are ordered by prompt cost.
+            max_wait (float): Seconds after which a job is promoted.
+        """
+        self.maxsize = maxsize
+        self.fair = fair
+        self.shortest_first = shortest_first
+        self.max_wait = max_wait
+        self.classes: Dict[str, "OrderedDict[str, ClientQueue]"] = {
+            priority: OrderedDict() for priority in PRIORITIES
+        }
+        self.size = 0
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    @staticmethod
+    def from_env() -> "FairScheduler":
+        """
+        Creates an empty scheduler configured by MAX_QUEUE, SCHEDULER_FAIR, SCHEDULER_SHORTEST_FIRST
+        and SCHEDULER_MAX_WAIT.
+
+        Returns:
+            FairScheduler: The scheduler.
+        """
+        return FairScheduler(
+            maxsize=int(os.getenv('MAX_QUEUE', '1000')),
+            fair=os.getenv('SCHEDULER_FAIR', 'true').lower() == 'true',
+            shortest_first=os.getenv('SCHEDULER_SHORTEST_FIRST', 'false').lower() == 'true',
+            max_wait=float(os.getenv('SCHEDULER_MAX_WAIT', '300'))
+        )
+
+    def qsize(self) -> int:
+        """
+        Returns the number of queued jobs.
+        """
+        with self.condition:
+            return self.size
+
+    def ahead(self, priority: str) -> int:
+        """
+        Returns the number of queued jobs a new job of the given priority would have to wait for.
+
+        Args:
+            priority (str): The priority class of the new job.
+        """
+        with self.condition:
+            count = 0
+            for name in PRIORITIES[:PRIORITIES.index(priority) + 1]:
+                count += sum(len(entries) for entries in self.classes[name].values())
+            return count
+
+    def put_nowait(self, uuid: str, client_id: str = "", priority: str = "interactive", cost: int = 0) -> None:
+        """
+        Queues a job without blocking.
+
+        Args:
+            uuid (str): The UUID of the job.
+            client_id (str): The client the job belongs to.
+            priority (str): The priority class, one of PRIORITIES.
+            cost (int): The cost used by shortest-prompt-first, e.g. the prompt's token count.
+
+        Raises:
+            queue.Full: If the scheduler holds maxsize jobs.
+            ValueError: If the priority class is unknown.
+            SchedulerClosed: If the scheduler is closed.
+        """
+        if priority not in self.classes:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+        with self.condition:
+            if self.closed:
+                raise SchedulerClosed
+            if self.maxsize > 0 and self.size >= self.maxsize:
+                raise queue.Full
+            client = client_id if self.fair else ""
+            entries = self.classes[priority].setdefault(client, ClientQueue())
+            self.sequence += 1
+            entries.push(cost if self.shortest_first else 0, self.sequence, uuid)
+            self.size += 1
+            self.condition.notify()
+
+    def put(self, uuid: str, block: bool = True, timeout: Optional[float] = None) -> None:
+        """
+        Queues an interactive job of an anonymous client, for compatibility with queue.Queue.
+        Never blocks.
+
+        Args:
+            uuid (str): The UUID of the job.
+            block (bool): Ignored.
+            timeout (Optional[float]): Ignored.
+
+        Raises:
+            queue.Full: If the scheduler holds maxsize jobs.
+        """
+        self.put_nowait(uuid)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> str:
+        """
+        Removes and returns the UUID of the next job to process.
+
+        Args:
+            block (bool): Whether to wait for a job if none is queued.
+            timeout (Optional[float]): The maximum number of seconds to wait.
+
+        Returns:
+            str: The UUID of the job.
+
+        Raises:
+            queue.Empty: If no job is available.
+            SchedulerClosed: If the scheduler is closed and empty.
+        """
+        with self.condition:
+            if block:
+                if not self.condition.wait_for(lambda: self.size > 0 or self.closed, timeout=timeout):
+                    raise queue.Empty
+            if self.size == 0:
+                if self.closed:
+                    raise SchedulerClosed
+                raise queue.Empty
+            return self.pop()
+
+    def get_nowait(self) -> str:
+        """
+        Removes and returns the UUID of the next job without waiting.
+
+        Raises:
+            queue.Empty: If no job is queued.
+        """
+        return self.get(block=False)
+
+    def task_done(self) -> None:
+        """
+        Exists for compatibility with queue.Queue; the scheduler does not track processing.
+        """
+
+    def close(self) -> None:
+        """
+        Stops accepting jobs and wakes all waiting consumers, which receive SchedulerClosed
+        once the queued jobs are taken.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def pop(self) -> str:
+        """
+        Removes the next job according to the priority, aging and fairness rules.
+        Must be called with the condition held and at least one job queued.
+
+        Returns:
+            str: The UUID of the job.
+        """
+        # Promote the job that has waited longest, once it has waited too long
+        deadline = time.monotonic() - self.max_wait
+        overdue = None
+        for priority in PRIORITIES:
+            for client, entries in self.classes[priority].items():
+                enqueued = entries.oldest()[2]
+                if enqueued < deadline and (overdue is None or enqueued < overdue[0]):
+                    overdue = (enqueued, priority, client)
+        if overdue is not None:
+            return self.pop_client(overdue[1], overdue[2], oldest=True)
+
+        for priority in PRIORITIES:
+            if self.classes[priority]:
+                return self.pop_client(priority, next(iter(self.classes[priority])))
+        raise queue.Empty
+
+    def pop_client(self, priority: str, client: str, oldest: bool = False) -> str:
+        """
+        Removes the next job of a client and moves the client to the end of the round-robin order.
+
+        Args:
+            priority (str): The priority class.
+            client (str): The client.
+            oldest (bool): Whether to take the client's job that has waited longest instead of the cheapest.
+
+        Returns:
+            str: The UUID of the job.
+        """
+        clients = self.classes[priority]
+        entries = clients[client]
+        uuid = entries.pop(oldest)
+        if entries:
+            clients.move_to_end(client)
+        else:
+            del clients[client]
+        self.size -= 1
+        return uuid
+
+    def remove(self, uuid: str) -> bool:
+        """
+        Removes a queued job.
+
+        Args:
+            uuid (str): The UUID of the job.
+
+        Returns:
+            bool: True if the job was queued and has been removed.
+        """
+        with self.condition:
+            for clients in self.classes.values():
+                for client, entries in clients.items():
+                    if entries.remove(uuid):
+                        if not entries:
+                            del clients[client]
+                        self.size -= 1
+                        return True
+            return False
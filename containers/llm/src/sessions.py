@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import zlib
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+from typing import Dict, List, Optional
+
+# Seconds a session is kept after its last turn
+SESSION_TTL = float(os.getenv('SESSION_TTL', '86400'))
+# Maximum number of sessions and maximum compressed bytes of all their histories
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', '10000'))
+SESSIONS_MAX_BYTES = int(os.getenv('SESSIONS_MAX_BYTES', str(256 * 1024 ** 2)))
+# Maximum characters of a session's history; the oldest turns are dropped beyond it
+SESSION_MAX_CHARS = int(os.getenv('SESSION_MAX_CHARS', str(128 * 1024)))
+
+
+def pack(messages: List[str]) -> bytes:
+    """
+    Compresses the messages of a conversation.
+
+    Args:
+        messages (List[str]): The messages, alternating between user and assistant.
+
+    Returns:
+        bytes: The compressed history.
+    """
+    return zlib.compress(json.dumps(messages).encode("utf-8"))
+
+
+def unpack(history: bytes) -> List[str]:
+    """
+    Decompresses the messages of a conversation.
+
+    Args:
+        history (bytes): The compressed history.
+
+    Returns:
+        List[str]: The messages.
+    """
+    return json.loads(zlib.decompress(history).decode("utf-8"))
+
+
+def trim(messages: List[str], max_chars: int) -> List[str]:
+    """
+    Drops the oldest exchanges of a conversation until it fits, keeping at least the last message.
+    Messages are dropped in user/assistant pairs, so the conversation still starts with the user.
+
+    Args:
+        messages (List[str]): The messages, alternating between user and assistant.
+        max_chars (int): The maximum number of characters.
+
+    Returns:
+        List[str]: The remaining messages.
+    """
+    size = sum(len(message) for message in messages)
+    start = 0
+    while size > max_chars and len(messages) - start > 2:
+        size -= len(messages[start]) + len(messages[start + 1])
+        start += 2
+    return messages[start:]
+
+
+class Session:
+    """
+    A conversation kept by the server, so clients send only their new message each turn.
+
+    Attributes:
+        session_id (str): The unique identifier of the session.
+        sys_prompt (str): The system prompt of the conversation.
+        model (Optional[str]): The model answering the conversation; None for the default model.
+        client_id (str): The client the session's jobs are scheduled for.
+        history (bytes): The compressed messages, alternating between user and assistant.
+        turns (int): The number of turns started in the session, including dropped ones.
+        pending (Optional[str]): The UUID of the job answering the last message, until its reply is
+            added to the history.
+        updated_at (float): The time of the last change.
+    """
+
+    def __init__(self, session_id: str, sys_prompt: str, model: Optional[str], client_id: str,
+                 history: bytes, turns: int = 0, pending: Optional[str] = None, updated_at: Optional[float] = None):
+        """
+        Initializes a Session.
+
+        Args:
+            session_id (str): The unique identifier of the session.
+            sys_prompt (str): The system prompt.
+            model (Optional[str]): The model; None for the default model.
+            client_id (str): The client the session's jobs are scheduled for.
+            history (bytes): The compressed messages.
+            turns (int): The number of turns started so far.
+            pending (Optional[str]): The UUID of the job answering the last message, if any.
+            updated_at (Optional[float]): The time of the last change; defaults to now.
+        """
+        self.session_id = session_id
+        self.sys_prompt = sys_prompt
+        self.model = model
+        self.client_id = client_id
+        self.history = history
+        self.turns = turns
+        self.pending = pending
+        self.updated_at = updated_at if updated_at is not None else time.time()
+
+    def get_messages(self) -> List[str]:
+        """
+        Retrieves the messages of the conversation.
+
+        Returns:
+            List[str]: The messages, alternating between user and assistant.
+        """
+        return unpack(self.history)
+
+    def get_size(self) -> int:
+        """
+        Computes the bytes retained by the session.
+
+        Returns:
+            int: The length of the system prompt and the compressed history.
+        """
+        return len(self.sys_prompt) + len(self.history)
+
+
+class SessionStore:
+    """
+    A thread-safe store of the sessions of a single API process. Sessions without a running turn
+    expire once they have not changed for the time to live, and the least recently used ones are
+    evicted when the number of sessions or their bytes exceed the limits. A session whose turn
+    never settles, e.g. because its client went away, expires after twice the time to live.
+
+    Attributes:
+        sessions (OrderedDict[str, Session]): The sessions by id, least recently used first.
+        ttl (float): Seconds a session is kept after its last change.
+        max_sessions (int): The maximum number of sessions.
+        max_bytes (int): The maximum number of bytes retained by all sessions.
+        evicted (int): The number of sessions evicted to make room.
+        retained (int): The running total of the bytes retained by all sessions.
+        lock (threading.RLock): A reentrant lock to ensure thread-safe operations.
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = MAX_SESSIONS, max_bytes: int = SESSIONS_MAX_BYTES):
+        """
+        Initializes an empty SessionStore.
+
+        Args:
+            ttl (float): Seconds a session is kept after its last change.
+            max_sessions (int): The maximum number of sessions.
+            max_bytes (int): The maximum number of bytes retained by all sessions.
+        """
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self.retained = 0
+        self.lock = threading.RLock()
+
+    def retained_bytes(self) -> int:
+        """
+        Retrieves the bytes retained by all sessions.
+
+        Returns:
+            int: The retained bytes.
+        """
+        with self.lock:
+            return self.retained
+
+    def remove(self, session_id: str) -> Optional[Session]:
+        """
+        Removes a session and its bytes from the running total. Must be called with the lock held.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            Optional[Session]: The removed session, or None if it does not exist.
+        """
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.retained -= session.get_size()
+        return session
+
+    def make_room(self, size: int, count: int, keep: Optional[str] = None) -> bool:
+        """
+        Evicts the least recently used sessions without a running turn until the given bytes
+        and number of new sessions fit.
+
+        Args:
+            size (int): The bytes needed.
+            count (int): The number of sessions added.
+            keep (Optional[str]): The id of a session that must not be evicted.
+
+        Returns:
+            bool: True if they fit.
+        """
+        with self.lock:
+            def fits() -> bool:
+                return len(self.sessions) + count <= self.max_sessions and self.retained + size <= self.max_bytes
+
+            if fits():
+                return True
+            for session in list(self.sessions.values()):
+                if session.pending is None and session.session_id != keep:
+                    self.remove(session.session_id)
+                    self.evicted += 1
+                    if fits():
+                        return True
+            return False
+
+    def create(self, sys_prompt: str, model: Optional[str], client_id: str) -> Optional[Session]:
+        """
+        Creates an empty session.
+
+        Args:
+            sys_prompt (str): The system prompt.
+            model (Optional[str]): The model; None for the default model.
+            client_id (str): The client the session's jobs are scheduled for.
+
+        Returns:
+            Optional[Session]: The session, or None if the store is full.
+        """
+        session = Session(uuid4().hex, sys_prompt, model, client_id, pack([]))
+        with self.lock:
+            if not self.make_room(session.get_size(), 1):
+                return None
+            self.sessions[session.session_id] = session
+            self.retained += session.get_size()
+            return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """
+        Retrieves a session.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            Optional[Session]: The session, or None if it does not exist.
+        """
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def update(self, session_id: str, expected: Optional[str], messages: List[str], pending: Optional[str],
+               new_turn: bool = False) -> bool:
+        """
+        Replaces the history and pending job of a session, unless another request changed its
+        pending job in the meantime. Idle sessions are evicted if the history grows beyond the
+        limit, but the update itself is never refused for size, as SESSION_MAX_CHARS bounds it.
+
+        Args:
+            session_id (str): The id of the session.
+            expected (Optional[str]): The pending job the caller saw.
+            messages (List[str]): The new messages.
+            pending (Optional[str]): The new pending job.
+            new_turn (bool): Whether the update starts a turn.
+
+        Returns:
+            bool: True if the session was updated.
+        """
+        history = pack(messages)
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or session.pending != expected:
+                return False
+            self.sessions.move_to_end(session_id)
+            if len(history) > len(session.history):
+                self.make_room(len(history) - len(session.history), 0, session_id)
+            self.retained += len(history) - len(session.history)
+            session.history = history
+            session.pending = pending
+            session.turns += 1 if new_turn else 0
+            session.updated_at = time.time()
+            return True
+
+    def delete(self, session_id: str) -> bool:
+        """
+        Deletes a session.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            bool: True if the session existed.
+        """
+        with self.lock:
+            return self.remove(session_id) is not None
+
+    def reap(self) -> int:
+        """
+        Removes the sessions whose time to live has passed, keeping those with a turn in progress
+        for up to twice the time to live.
+
+        Returns:
+            int: The number of removed sessions.
+        """
+        now = time.time()
+        with self.lock:
+            expired = [
+                session_id for session_id, session in self.sessions.items()
+                if session.updated_at < now - (self.ttl if session.pending is None else 2 * self.ttl)
+            ]
+            for session_id in expired:
+                self.remove(session_id)
+            return len(expired)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the number of sessions, the bytes they retain and the eviction counter.
+
+        Returns:
+            Dict[str, int]: The statistics of the store.
+        """
+        with self.lock:
+            return {"sessions": len(self.sessions), "retained_bytes": self.retained, "evicted": self.evicted}
@@ -0,0 +1,161 @@
+import os
+from typing import Any, Optional
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+import metrics
+
+# Tokens drafted per decode step; 0 uses 10 for prompt lookup and 4 for a draft model
+DRAFT_TOKENS = int(os.getenv('DRAFT_TOKENS', '0'))
+# Longest n-gram prompt lookup searches for
+DRAFT_NGRAM = int(os.getenv('DRAFT_NGRAM', '2'))
+# Largest logits buffer (n_ctx * n_vocab * 4 bytes) a worker may keep for speculative decoding;
+# a model whose context needs more refuses to load with a draft
+DRAFT_MAX_LOGITS_BYTES = int(os.getenv('DRAFT_MAX_LOGITS_BYTES', str(2 * 1024 ** 3)))
+
+# The speculative decoding mode drafting tokens by matching the last n-gram in the prompt;
+# any other non-empty mode is the path of a small GGUF of the same model family
+PROMPT_LOOKUP = "prompt-lookup"
+
+
+class DraftLlama(LlamaDraftModel):
+    """
+    Drafts tokens greedily with a small model that shares the tokenizer of the main model.
+    The draft keeps its own context and only evaluates the tokens that differ from its last call,
+    so the conversation prefix is not evaluated again on every step.
+
+    Attributes:
+        llm (Llama): The draft model.
+        num_pred_tokens (int): The number of tokens drafted per call.
+    """
+
+    def __init__(self, llm: Llama, num_pred_tokens: int = 4):
+        """
+        Initializes the DraftLlama.
+
+        Args:
+            llm (Llama): The draft model, with a context as large as the main model's.
+            num_pred_tokens (int): The number of tokens drafted per call.
+        """
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        """
+        Continues the tokens greedily.
+
+        Args:
+            input_ids (np.ndarray): The tokens of the prompt and the answer so far.
+            **kwargs (Any): Ignored.
+
+        Returns:
+            np.ndarray: The drafted tokens; empty if they would not fit the draft context.
+        """
+        if len(input_ids) + self.num_pred_tokens > self.llm.n_ctx():
+            return np.array([], dtype=np.intc)
+        length = min(self.llm.n_tokens, len(input_ids))
+        mismatches = np.nonzero(self.llm.input_ids[:length] != input_ids[:length])[0]
+        prefix = int(mismatches[0]) if len(mismatches) else length
+        # Evaluate at least the last token again, as its logits are needed
+        self.llm.n_tokens = min(prefix, len(input_ids) - 1)
+        tokens = input_ids[self.llm.n_tokens:].tolist()
+        drafted = []
+        for _ in range(self.num_pred_tokens):
+            self.llm.eval(tokens)
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.llm.ctx, -1), shape=(self.llm.n_vocab(),))
+            token = int(np.argmax(logits))
+            if self.llm.token_eos() == token:
+                break
+            drafted.append(token)
+            tokens = [token]
+        return np.array(drafted, dtype=np.intc)
+
+
+class MeasuredDraft(LlamaDraftModel):
+    """
+    Wraps a draft model and counts its proposals and how many of them the main model accepted.
+
+    Llama calls the draft once per decode step with all tokens so far. The tokens that follow
+    the previous call's input are the accepted part of the previous proposal and the token the
+    main model sampled after it, so the accepted length is the common prefix of those tokens
+    and the proposal. The acceptance rate is accepted/drafted tokens; the tokens per decode step,
+    the upper bound of the speedup, is (steps + accepted)/steps.
+
+    A proposal is counted once its outcome is known. An input that does not extend the previous
+    one starts a new generation, and the last proposal of the previous generation, whose outcome
+    is unknown, is dropped.
+
+    Attributes:
+        draft (LlamaDraftModel): The wrapped draft model.
+        kind (str): The metric label: "prompt-lookup" or "draft-model".
+        proposal (np.ndarray): The tokens proposed by the previous call.
+        offset (int): The number of input tokens of the previous call.
+        last (int): The last input token of the previous call.
+    """
+
+    def __init__(self, draft: LlamaDraftModel, kind: str):
+        """
+        Initializes the MeasuredDraft.
+
+        Args:
+            draft (LlamaDraftModel): The draft model to measure.
+            kind (str): The metric label.
+        """
+        self.draft = draft
+        self.kind = kind
+        self.proposal = np.array([], dtype=np.intc)
+        self.offset = 0
+        self.last = -1
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        """
+        Records the outcome of the previous proposal and drafts the next one.
+
+        Args:
+            input_ids (np.ndarray): The tokens of the prompt and the answer so far.
+            **kwargs (Any): Passed to the draft model.
+
+        Returns:
+            np.ndarray: The drafted tokens.
+        """
+        extends = len(input_ids) > self.offset > 0 and int(input_ids[self.offset - 1]) == self.last
+        if extends:
+            following = input_ids[self.offset:self.offset + len(self.proposal)]
+            mismatches = np.nonzero(following != self.proposal[:len(following)])[0]
+            accepted = int(mismatches[0]) if len(mismatches) else len(following)
+            metrics.DRAFT_STEPS.inc(kind=self.kind)
+            metrics.DRAFT_TOKENS.inc(len(self.proposal), kind=self.kind)
+            # The last new token was sampled by the main model, not taken from the draft
+            metrics.DRAFT_ACCEPTED.inc(min(accepted, len(input_ids) - self.offset - 1), kind=self.kind)
+
+        self.proposal = self.draft(input_ids, **kwargs)
+        self.offset = len(input_ids)
+        self.last = int(input_ids[-1]) if len(input_ids) else -1
+        return self.proposal
+
+
+def make_draft(draft: str, n_ctx: int, n_threads: int, num_pred_tokens: int = DRAFT_TOKENS,
+               max_ngram_size: int = DRAFT_NGRAM) -> Optional[LlamaDraftModel]:
+    """
+    Creates the draft model of a Llama.
+
+    Args:
+        draft (str): "prompt-lookup", the file of a draft model, or empty to disable speculative decoding.
+        n_ctx (int): The context size of the main model.
+        n_threads (int): The number of CPU threads of the draft model.
+        num_pred_tokens (int): The number of tokens drafted per step; 0 for the default.
+        max_ngram_size (int): The longest n-gram prompt lookup searches for.
+
+    Returns:
+        Optional[LlamaDraftModel]: The measured draft model, or None if disabled.
+    """
+    if not draft:
+        return None
+    if draft == PROMPT_LOOKUP:
+        lookup = LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens or 10)
+        return MeasuredDraft(lookup, PROMPT_LOOKUP)
+    llm = Llama(model_path=draft, n_ctx=n_ctx, n_threads=n_threads, n_threads_batch=n_threads, verbose=False)
+    return MeasuredDraft(DraftLlama(llm, num_pred_tokens or 4), "draft-model")
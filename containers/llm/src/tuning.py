@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from typing import Any, Dict, List, Optional
+
+import llama_cpp
+
+# Benchmark thread counts and batch sizes when a model is loaded, instead of one thread per core
+AUTOTUNE = os.getenv('AUTOTUNE', '0') == '1'
+# File the results are kept in; empty keeps them next to the model file
+AUTOTUNE_CACHE = os.getenv('AUTOTUNE_CACHE', '')
+# Length of the synthetic prompt and of the decode measured per candidate
+AUTOTUNE_PROMPT_TOKENS = int(os.getenv('AUTOTUNE_PROMPT_TOKENS', '256'))
+AUTOTUNE_DECODE_TOKENS = int(os.getenv('AUTOTUNE_DECODE_TOKENS', '16'))
+# Prompt batch sizes tried for prefill
+AUTOTUNE_BATCH_SIZES = [int(size) for size in os.getenv('AUTOTUNE_BATCH_SIZES', '128,256,512').split(',') if size]
+
+SYNTHETIC_TEXT = "The quick brown fox jumps over the lazy dog while the committee reviews the annual report. "
+
+
+def read_text(path: str) -> Optional[str]:
+    """
+    Reads a small system file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        Optional[str]: The stripped content, or None if it cannot be read.
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def usable_cpus() -> List[int]:
+    """
+    Lists the CPUs the process may run on.
+
+    Returns:
+        List[int]: The CPU numbers of the affinity mask, or all CPUs where it is not available.
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(multiprocessing.cpu_count()))
+
+
+def cpu_quota() -> Optional[float]:
+    """
+    Reads the CPU quota of the container from cgroup v2 or v1.
+
+    Returns:
+        Optional[float]: The number of CPUs the quota allows, or None if there is no quota.
+    """
+    limit = read_text("/sys/fs/cgroup/cpu.max")
+    if limit is not None:
+        quota, _, period = limit.partition(" ")
+        return int(quota) / int(period) if quota != "max" and period else None
+    quota = read_text("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = read_text("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def physical_cores(cpus: List[int]) -> int:
+    """
+    Counts the physical cores among CPUs, so that SMT siblings count once.
+
+    Args:
+        cpus (List[int]): The CPU numbers.
+
+    Returns:
+        int: The number of distinct cores, or the number of CPUs if the topology is unknown.
+    """
+    cores = set()
+    for cpu in cpus:
+        package = read_text(f"/sys/devices/system/cpu/cpu{cpu}/topology/physical_package_id")
+        core = read_text(f"/sys/devices/system/cpu/cpu{cpu}/topology/core_id")
+        if package is None or core is None:
+            return len(cpus)
+        cores.add((package, core))
+    return len(cores) or len(cpus)
+
+
+def cpu_budget(physical: bool = True) -> int:
+    """
+    Computes the number of threads the process can keep busy: one per physical core (or per
+    logical CPU) of its affinity mask, capped by the CPU quota of the container.
+
+    Args:
+        physical (bool): Whether to count physical cores instead of logical CPUs.
+
+    Returns:
+        int: The number of threads, at least 1.
+    """
+    cpus = usable_cpus()
+    count = physical_cores(cpus) if physical else len(cpus)
+    quota = cpu_quota()
+    if quota is not None:
+        count = min(count, int(quota))
+    return max(1, count)
+
+
+def default_threads() -> int:
+    """
+    The thread count of llama.cpp when none is configured: one per physical core, as SMT
+    siblings share the execution units the matrix multiplications are bound by.
+
+    Returns:
+        int: The number of threads.
+    """
+    return cpu_budget(physical=True)
+
+
+def fingerprint(model_path: str, max_threads: int) -> str:
+    """
+    Identifies a host and model combination, so that tuning results are only reused where they apply.
+
+    Args:
+        model_path (str): The model file.
+        max_threads (int): The largest thread count tried.
+
+    Returns:
+        str: A short hex digest of the CPU model, the usable CPUs, the quota, the model file and
+             the llama.cpp version.
+    """
+    cpuinfo = read_text("/proc/cpuinfo") or ""
+    cpu_model = next((line.split(":", 1)[1].strip() for line in cpuinfo.splitlines() if line.startswith("model name")), "")
+    cpus = usable_cpus()
+    key = json.dumps([
+        cpu_model, len(cpus), physical_cores(cpus), cpu_quota(), max_threads,
+        os.path.basename(model_path), os.path.getsize(model_path), getattr(llama_cpp, "__version__", "")
+    ])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_results(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Reads the cached tuning results.
+
+    Args:
+        path (str): The cache file.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The results by fingerprint; empty if there is no valid cache.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_result(path: str, key: str, result: Dict[str, Any]) -> None:
+    """
+    Adds a tuning result to the cache file, replacing the file atomically.
+
+    Args:
+        path (str): The cache file.
+        key (str): The fingerprint.
+        result (Dict[str, Any]): The result.
+    """
+    results = load_results(path)
+    results[key] = result
+    try:
+        with open(path + ".tmp", 'w') as f:
+            json.dump(results, f, indent=2)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Warning: could not save the tuning result: {e}")
+
+
+def thread_candidates(max_threads: int) -> List[int]:
+    """
+    Chooses the thread counts to benchmark: powers of two, the physical cores and the maximum.
+
+    Args:
+        max_threads (int): The largest thread count.
+
+    Returns:
+        List[int]: The thread counts, ascending, from a quarter of the maximum up.
+    """
+    candidates = {max_threads, min(default_threads(), max_threads)}
+    count = 1
+    while count < max_threads:
+        candidates.add(count)
+        count *= 2
+    return sorted(count for count in candidates if count >= max(1, max_threads // 4))
+
+
+def benchmark(handler: Any, max_threads: int) -> Dict[str, Any]:
+    """
+    Measures prefill and decode speed of a model for several thread counts and prompt batch
+    sizes on a synthetic prompt. The batch size of a llama.cpp context is fixed when it is
+    created, so each batch size is measured on a context of its own.
+
+    Args:
+        handler (ModelHandler): The model.
+        max_threads (int): The largest thread count to try.
+
+    Returns:
+        Dict[str, Any]: The fastest "n_threads" for decode, "n_threads_batch" and "n_batch" for
+            prefill, and the speeds measured with them in tokens per second.
+    """
+    n_ctx = AUTOTUNE_PROMPT_TOKENS + AUTOTUNE_DECODE_TOKENS + 8
+
+    def prefill(llm: Any, threads: int, tokens: List[int]) -> float:
+        llama_cpp.llama_set_n_threads(llm.ctx, threads, threads)
+        llm.reset()
+        started = time.perf_counter()
+        llm.eval(tokens)
+        return len(tokens) / (time.perf_counter() - started)
+
+    def decode(llm: Any, threads: int, tokens: List[int]) -> float:
+        llama_cpp.llama_set_n_threads(llm.ctx, threads, threads)
+        llm.n_tokens = len(tokens)
+        started = time.perf_counter()
+        for token in tokens[:AUTOTUNE_DECODE_TOKENS]:
+            llm.eval([token])
+        return AUTOTUNE_DECODE_TOKENS / (time.perf_counter() - started)
+
+    largest = max(AUTOTUNE_BATCH_SIZES)
+    llm = handler.build(n_threads=max_threads, n_ctx=n_ctx, n_batch=largest)
+    try:
+        text = SYNTHETIC_TEXT * (AUTOTUNE_PROMPT_TOKENS // 8 + 1)
+        tokens = llm.tokenize(text.encode("utf-8"))[:AUTOTUNE_PROMPT_TOKENS]
+        # The first evaluation pays for page faults and buffer allocations
+        prefill(llm, max_threads, tokens)
+        prefill_speed = {threads: prefill(llm, threads, tokens) for threads in thread_candidates(max_threads)}
+        n_threads_batch = max(prefill_speed, key=prefill_speed.get)
+        batch_speed = {largest: prefill_speed[n_threads_batch]}
+        decode_speed = {threads: decode(llm, threads, tokens) for threads in thread_candidates(max_threads)}
+        n_threads = max(decode_speed, key=decode_speed.get)
+    finally:
+        llm.close()
+
+    for n_batch in AUTOTUNE_BATCH_SIZES:
+        if n_batch in batch_speed:
+            continue
+        llm = handler.build(n_threads=n_threads_batch, n_ctx=n_ctx, n_batch=n_batch)
+        try:
+            prefill(llm, n_threads_batch, tokens)
+            batch_speed[n_batch] = prefill(llm, n_threads_batch, tokens)
+        finally:
+            llm.close()
+    n_batch = max(batch_speed, key=batch_speed.get)
+    print(f"Prefill tokens/s by threads: {prefill_speed}, by batch size: {batch_speed}; decode tokens/s by threads: {decode_speed}")
+    return {
+        "n_threads": n_threads,
+        "n_threads_batch": n_threads_batch,
+        "n_batch": n_batch,
+        "prefill_tokens_per_second": batch_speed[n_batch],
+        "decode_tokens_per_second": decode_speed[n_threads],
+        "tuned_at": time.time()
+    }
+
+
+def tune(handler: Any, max_threads: int) -> Dict[str, Any]:
+    """
+    Finds the fastest thread counts and prompt batch size of a model on this host, benchmarking
+    only if no result for the same host and model fingerprint is cached.
+
+    Args:
+        handler (ModelHandler): The model.
+        max_threads (int): The largest thread count to try, usually the share of one worker.
+
+    Returns:
+        Dict[str, Any]: The build arguments "n_threads", "n_threads_batch" and "n_batch", plus the
+            measured speeds.
+    """
+    path = AUTOTUNE_CACHE or os.path.join(os.path.dirname(os.path.abspath(handler.filename)), "autotune.json")
+    key = fingerprint(handler.filename, max_threads)
+    cached = load_results(path).get(key)
+    if cached is not None:
+        print(f"Using the cached tuning result {key}: {cached}")
+        return cached
+    print(f"Tuning thread counts and batch size for up to {max_threads} thread(s)...")
+    result = benchmark(handler, max_threads)
+    save_result(path, key, result)
+    print(f"Tuning result {key}: {result}")
+    return result
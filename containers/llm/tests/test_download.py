@@ -0,0 +1,99 @@
+import os
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from model import ModelHandler
+
+PAYLOAD = os.urandom(3 * 1024 * 1024 + 17)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD with support for single byte ranges. While `broken` is set, range requests
+    for more than one byte are cut off halfway, as if the connection dropped.
+    """
+
+    broken = False
+    ranges = []
+
+    def do_GET(self):
+        start, end = 0, len(PAYLOAD) - 1
+        header = self.headers.get("Range")
+        if header:
+            first, last = header[len("bytes="):].split("-")
+            start, end = int(first), int(last) if last else end
+            self.ranges.append((start, end))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.broken and len(body) > 1:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.broken = False
+    RangeHandler.ranges = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/model.gguf"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_handler(url, filename, sha256=""):
+    handler = ModelHandler(url=url, filename=str(filename), sha256=sha256, draft="")
+    handler.connections = 3
+    handler.CHUNK_SIZE = 64 * 1024
+    return handler
+
+
+def test_interrupted_download_resumes(server, tmp_path):
+    target = tmp_path / "model.gguf"
+    handler = make_handler(server, target, hashlib.sha256(PAYLOAD).hexdigest())
+
+    RangeHandler.broken = True
+    handler.RETRIES = 1
+    with pytest.raises(requests.exceptions.RequestException):
+        handler.download_file()
+    assert not target.exists()
+    assert os.path.exists(str(target) + ".part.json")
+    starts = [start for start, end in RangeHandler.ranges if end > start]
+
+    RangeHandler.broken = False
+    RangeHandler.ranges = []
+    handler.RETRIES = ModelHandler.RETRIES
+    assert handler.download_file() == str(target)
+
+    assert target.read_bytes() == PAYLOAD
+    assert not os.path.exists(str(target) + ".part")
+    assert not os.path.exists(str(target) + ".part.json")
+    resumed = [start for start, end in RangeHandler.ranges if end > start]
+    assert len(resumed) == len(starts)
+    assert all(start not in starts for start in resumed)
+
+
+def test_checksum_mismatch_is_rejected(server, tmp_path):
+    target = tmp_path / "model.gguf"
+    handler = make_handler(server, target, "0" * 64)
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        handler.download_file()
+    assert not target.exists()
+    assert not os.path.exists(str(target) + ".part")
+    assert not os.path.exists(str(target) + ".part.json")
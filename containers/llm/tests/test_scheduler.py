@@ -0,0 +1,115 @@
+import queue
+
+import pytest
+
+import scheduler
+from scheduler import FairScheduler, SchedulerClosed
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler.time, "monotonic", lambda: now[0])
+    return now
+
+
+def drain(jobs):
+    return [jobs.get_nowait() for _ in range(jobs.qsize())]
+
+
+def test_clients_are_served_round_robin(clock):
+    jobs = FairScheduler()
+    for uuid in ("a1", "a2", "a3"):
+        jobs.put_nowait(uuid, client_id="a")
+    jobs.put_nowait("b1", client_id="b")
+    jobs.put_nowait("b2", client_id="b")
+
+    assert drain(jobs) == ["a1", "b1", "a2", "b2", "a3"]
+
+
+def test_unfair_scheduler_serves_in_arrival_order(clock):
+    jobs = FairScheduler(fair=False)
+    for uuid, client in (("a1", "a"), ("a2", "a"), ("b1", "b")):
+        jobs.put_nowait(uuid, client_id=client)
+
+    assert drain(jobs) == ["a1", "a2", "b1"]
+
+
+def test_interactive_jobs_go_before_batch_jobs(clock):
+    jobs = FairScheduler()
+    jobs.put_nowait("batch", client_id="a", priority="batch")
+    jobs.put_nowait("interactive", client_id="b")
+
+    assert jobs.ahead("interactive") == 1
+    assert jobs.ahead("batch") == 2
+    assert drain(jobs) == ["interactive", "batch"]
+
+
+def test_shortest_prompt_first_within_a_client(clock):
+    jobs = FairScheduler(shortest_first=True)
+    for uuid, cost in (("long", 900), ("short", 10), ("medium", 100)):
+        jobs.put_nowait(uuid, client_id="a", cost=cost)
+
+    assert drain(jobs) == ["short", "medium", "long"]
+
+
+def test_batch_job_is_promoted_after_max_wait(clock):
+    jobs = FairScheduler(max_wait=10)
+    jobs.put_nowait("batch", client_id="a", priority="batch")
+    clock[0] += 11
+    jobs.put_nowait("interactive", client_id="b")
+
+    assert drain(jobs) == ["batch", "interactive"]
+
+
+def test_long_prompt_is_promoted_despite_newer_short_ones(clock):
+    jobs = FairScheduler(shortest_first=True, max_wait=10)
+    jobs.put_nowait("long", client_id="a", priority="batch", cost=1000)
+    clock[0] += 50
+    for uuid in ("short1", "short2", "short3"):
+        jobs.put_nowait(uuid, client_id="a", priority="batch", cost=1)
+    jobs.put_nowait("interactive", client_id="b")
+
+    assert jobs.get_nowait() == "long"
+    assert drain(jobs) == ["interactive", "short1", "short2", "short3"]
+
+
+def test_longest_waiting_job_is_promoted_first(clock):
+    jobs = FairScheduler(shortest_first=True, max_wait=10)
+    jobs.put_nowait("older", client_id="a", priority="batch", cost=500)
+    clock[0] += 1
+    jobs.put_nowait("newer", client_id="b", priority="batch", cost=5)
+    clock[0] += 20
+
+    assert drain(jobs) == ["older", "newer"]
+
+
+def test_removed_jobs_are_skipped(clock):
+    jobs = FairScheduler(shortest_first=True, max_wait=10)
+    jobs.put_nowait("old", client_id="a", cost=50)
+    jobs.put_nowait("cheap", client_id="a", cost=1)
+    jobs.put_nowait("other", client_id="a", cost=5)
+
+    assert jobs.remove("old")
+    assert not jobs.remove("old")
+    assert jobs.remove("cheap")
+    clock[0] += 20
+    assert drain(jobs) == ["other"]
+    with pytest.raises(queue.Empty):
+        jobs.get_nowait()
+
+
+def test_full_and_closed(clock):
+    jobs = FairScheduler(maxsize=1)
+    jobs.put_nowait("a")
+    with pytest.raises(queue.Full):
+        jobs.put_nowait("b")
+    with pytest.raises(ValueError):
+        jobs.put_nowait("c", priority="urgent")
+
+    jobs.close()
+    with pytest.raises(SchedulerClosed):
+        jobs.put_nowait("d")
+    assert jobs.get() == "a"
+    with pytest.raises(SchedulerClosed):
+        jobs.get()
@@ -5,7 +5,7 @@ from fastapi import FastAPI, HTTPException, File, UploadFile, Form
 from pydantic import BaseModel
 from typing import Any, List, Optional
 from processor import MainProcessor
-from jobtools import JobRegister, VectorJob
+from jobtools import JobRegister, JobReaper, VectorJob
 from datetime import date
 
 # Fetch the supertoken from environment variables
@@ -13,6 +13,8 @@ supertoken = os.getenv('SUPERTOKEN', default="PLEASE_CHANGE_THIS_PLEASE")
 
 # Initialize job registration and threading components
 jobReg = JobRegister()
+reaper = JobReaper(jobReg)
+reaper.start()
 taskLock = threading.Lock()
 taskQueue = queue.Queue(maxsize=1000)
 
@@ -73,12 +75,15 @@ async def upload_files(
         collection=collection,
         task_type="upload"
     )
-    jobReg.add_job(job)
+    if not jobReg.add_job(job):
+        job.set_status("failed")
+        return {"uuid": job.get_uuid(), "status": job.get_status()}
 
     try:
         taskQueue.put(job.get_uuid())
     except queue.Full:
         job.set_status("failed")
+        job.release_files()
     
     return {"uuid": job.get_uuid(), "status": job.get_status()}
 
@@ -102,7 +107,9 @@ async def query_vector_store(request: QueryRequest) -> Any:
         collection=request.collection,
         task_type="query"
     )
-    jobReg.add_job(job)
+    if not jobReg.add_job(job):
+        job.set_status("failed")
+        return {"uuid": job.get_uuid(), "status": job.get_status()}
 
     try:
         taskQueue.put(job.get_uuid())
@@ -122,8 +129,14 @@ async def get_status(info: InfoRequest) -> Any:
 
     Returns:
         Any: The status of the job.
+
+    Raises:
+        HTTPException: If the job does not exist or was already removed.
     """
-    return {"status": jobReg.get_job(info.uuid).get_status(), "queue_size": taskQueue.qsize()}
+    job = jobReg.get_job(info.uuid)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"status": job.get_status(), "queue_size": taskQueue.qsize()}
 
 
 @app.post("/getCompletion/")
@@ -163,3 +176,14 @@ async def unregister_job(info: InfoRequest) -> Any:
     """
     jobReg.delete_job(info.uuid)
     return "OK"
+
+
+@app.get("/getJobStats/")
+async def get_job_stats() -> Any:
+    """
+    Get the number of registered jobs, the bytes they retain and the eviction counters.
+
+    Returns:
+        dict: The statistics of the job register.
+    """
+    return jobReg.get_stats()
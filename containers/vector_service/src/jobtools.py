@@ -1,5 +1,9 @@
-from typing import Optional, List, Dict, Union
+import os
+import time
+import threading
+from typing import Callable, Optional, List, Dict, Union
 from uuid import uuid4
+from threading import Lock, RLock
 
 class VectorJob:
     """
@@ -14,6 +18,11 @@ class VectorJob:
         uuid (str): A unique identifier for the vector job.
         status (str): The current status of the vector job (e.g., 'created', 'processing', 'completed').
         result (Optional[Union[Dict, List[float]]]): The result of the task, such as query results or confirmation of upload.
+        updated_at (float): The monotonic time of the last status change.
+        size (int): The number of bytes retained by the job.
+        lock (Lock): Guards the size and the register callback.
+        on_resize (Optional[Callable[[int], None]]): Called with the change in size when the files
+            are released, so that the register holding the job can keep its total current.
     """
 
     def __init__(self, files: Optional[List[bytes]] = None, metadata: Optional[Dict[str, str]] = None,
@@ -36,6 +45,10 @@ class VectorJob:
         self.uuid = str(uuid4().hex)
         self.status = "created"
         self.result: Optional[Union[Dict, List[float]]] = None
+        self.updated_at = time.monotonic()
+        self.size = sum(len(content) for content in files or []) + len((query or "").encode("utf-8"))
+        self.lock = Lock()
+        self.on_resize: Optional[Callable[[int], None]] = None
 
     def set_result(self, result: Union[Dict, List[float]]) -> None:
         """
@@ -64,6 +77,44 @@ class VectorJob:
         """
         return self.files
 
+    def release_files(self) -> None:
+        """
+        Drops the uploaded file contents once they have been stored in the vector store or the
+        upload failed.
+        """
+        self.files = None
+        self.resize(len((self.query or "").encode("utf-8")))
+
+    def resize(self, size: int) -> None:
+        """
+        Sets the number of bytes retained by the job and reports the change to its register.
+
+        Args:
+            size (int): The new size.
+        """
+        with self.lock:
+            change, self.size = size - self.size, size
+            if self.on_resize is not None:
+                self.on_resize(change)
+
+    def get_size(self) -> int:
+        """
+        Estimates the number of bytes retained by the vector job.
+
+        Returns:
+            int: The size of the file contents and the UTF-8 size of the query.
+        """
+        return self.size
+
+    def get_updated_at(self) -> float:
+        """
+        Retrieves the monotonic time of the last status change.
+
+        Returns:
+            float: The time of the last status change.
+        """
+        return self.updated_at
+
     def get_metadata(self) -> Optional[Dict[str, str]]:
         """
         Retrieves the metadata for the files.
@@ -126,49 +177,81 @@ class VectorJob:
             status (str): The new status to assign to the job.
         """
         self.status = status
+        self.updated_at = time.monotonic()
 
 
 class JobRegister:
     """
     A thread-safe class to manage the registration and tracking of multiple jobs.
 
+    Jobs in a final state expire once they have not changed for the time to live. The number of
+    jobs and the bytes they retain are capped; to make room for a new job the least recently
+    updated final jobs are evicted, and the new job is refused if that is not enough.
+
     Attributes:
         register (Dict[str, VectorJob]): A dictionary storing jobs by their UUID.
         lock (RLock): A reentrant lock to ensure thread-safe operations.
+        ttl (float): Seconds a job in a final state is kept after its last status change.
+        max_jobs (int): The maximum number of registered jobs.
+        max_bytes (int): The maximum number of bytes retained by the registered jobs.
+        evicted_expired (int): The number of jobs removed because their time to live passed.
+        evicted_capacity (int): The number of jobs removed to make room for new ones.
+        rejected (int): The number of jobs refused because the register was full.
+        retained (int): The running total of the bytes retained by the registered jobs.
+        retained_lock (Lock): Guards the running total, which jobs update as their size changes.
     """
 
-    def __init__(self):
+    FINAL_STATUSES = ("completed", "failed")
+
+    def __init__(self, ttl: Optional[float] = None, max_jobs: Optional[int] = None, max_bytes: Optional[int] = None):
         """
         Initializes a JobRegister instance with an empty register and a lock.
+
+        Args:
+            ttl (Optional[float]): Seconds to keep final jobs. Defaults to JOB_TTL.
+            max_jobs (Optional[int]): The maximum number of jobs. Defaults to MAX_JOBS.
+            max_bytes (Optional[int]): The maximum retained bytes. Defaults to MAX_JOB_BYTES.
         """
         self.register: Dict[str, VectorJob] = {}
         self.lock = RLock()
+        self.ttl = ttl if ttl is not None else float(os.getenv('JOB_TTL', '3600'))
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.getenv('MAX_JOBS', '10000'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('MAX_JOB_BYTES', str(4 * 1024 ** 3)))
+        self.evicted_expired = 0
+        self.evicted_capacity = 0
+        self.rejected = 0
+        self.retained = 0
+        self.retained_lock = Lock()
 
     def delete_job(self, uuid: str) -> None:
         """
-        Deletes a job from the register by its UUID.
+        Deletes a job from the register by its UUID. Unknown UUIDs are ignored.
 
         Args:
             uuid (str): The UUID of the job to delete.
-
-        Raises:
-            KeyError: If the UUID is not found in the register.
         """
         with self.lock:
-            try:
-                del self.register[uuid]
-            except Exception as e:
-                print(e)
+            job = self.register.pop(uuid, None)
+            if job is not None:
+                self._untrack(job)
 
-    def add_job(self, job: VectorJob) -> None:
+    def add_job(self, job: VectorJob) -> bool:
         """
-        Adds a job to the register.
+        Adds a job to the register, evicting final jobs if the register is full.
 
         Args:
             job (VectorJob): The job instance to add.
+
+        Returns:
+            bool: True if the job was added, False if the register is full.
         """
         with self.lock:
+            if not self.make_room(job.get_size()):
+                self.rejected += 1
+                return False
             self.register[job.get_uuid()] = job
+            self._track(job)
+            return True
 
     def get_job(self, uuid: str) -> Optional[VectorJob]:
         """
@@ -181,4 +264,136 @@ class JobRegister:
             Optional[VectorJob]: The job instance if found, otherwise None.
         """
         with self.lock:
-            return self.register.get(uuid)
\ No newline at end of file
+            return self.register.get(uuid)
+
+    def _track(self, job: VectorJob) -> None:
+        """
+        Adds a newly registered job to the running total and has it report its changes in size.
+
+        Args:
+            job (VectorJob): The job.
+        """
+        with job.lock:
+            job.on_resize = self._resize
+            self._resize(job.get_size())
+
+    def _untrack(self, job: VectorJob) -> None:
+        """
+        Removes a job that left the register from the running total.
+
+        Args:
+            job (VectorJob): The job.
+        """
+        with job.lock:
+            job.on_resize = None
+            self._resize(-job.get_size())
+
+    def _resize(self, size: int) -> None:
+        """
+        Changes the running total of retained bytes.
+
+        Args:
+            size (int): The bytes to add, negative to subtract.
+        """
+        with self.retained_lock:
+            self.retained += size
+
+    def retained_bytes(self) -> int:
+        """
+        Retrieves the number of bytes retained by the registered jobs.
+
+        Returns:
+            int: The retained bytes.
+        """
+        with self.retained_lock:
+            return self.retained
+
+    def make_room(self, size: int) -> bool:
+        """
+        Evicts the least recently updated final jobs until a new job of the given size fits.
+
+        Args:
+            size (int): The bytes retained by the new job.
+
+        Returns:
+            bool: True if the new job fits.
+        """
+        with self.lock:
+            def fits() -> bool:
+                return len(self.register) < self.max_jobs and self.retained_bytes() + size <= self.max_bytes
+
+            if fits():
+                return True
+            final = [job for job in self.register.values() if job.get_status() in self.FINAL_STATUSES]
+            for job in sorted(final, key=lambda job: job.get_updated_at()):
+                del self.register[job.get_uuid()]
+                self._untrack(job)
+                self.evicted_capacity += 1
+                if fits():
+                    return True
+            return False
+
+    def reap(self) -> int:
+        """
+        Removes the final jobs whose time to live has passed.
+
+        Returns:
+            int: The number of removed jobs.
+        """
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            expired = [
+                uuid for uuid, job in self.register.items()
+                if job.get_status() in self.FINAL_STATUSES and job.get_updated_at() < deadline
+            ]
+            for uuid in expired:
+                self._untrack(self.register.pop(uuid))
+            self.evicted_expired += len(expired)
+            return len(expired)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Retrieves the size of the register and its eviction counters.
+
+        Returns:
+            Dict[str, int]: The number of jobs, retained bytes and eviction counters.
+        """
+        with self.lock:
+            return {
+                "jobs": len(self.register),
+                "retained_bytes": self.retained_bytes(),
+                "evicted_expired": self.evicted_expired,
+                "evicted_capacity": self.evicted_capacity,
+                "rejected": self.rejected
+            }
+
+class JobReaper(threading.Thread):
+    """
+    A daemon thread that periodically removes expired jobs from a JobRegister.
+
+    Attributes:
+        jobReg (JobRegister): The register to clean up.
+        interval (float): Seconds between two clean-ups.
+    """
+
+    def __init__(self, jobReg: JobRegister, interval: Optional[float] = None):
+        """
+        Initializes the JobReaper.
+
+        Args:
+            jobReg (JobRegister): The register to clean up.
+            interval (Optional[float]): Seconds between two clean-ups. Defaults to JOB_REAP_INTERVAL.
+        """
+        super().__init__(daemon=True)
+        self.jobReg = jobReg
+        self.interval = interval if interval is not None else float(os.getenv('JOB_REAP_INTERVAL', '60'))
+
+    def run(self):
+        """
+        Removes expired jobs every interval seconds.
+        """
+        while True:
+            time.sleep(self.interval)
+            removed = self.jobReg.reap()
+            if removed:
+                print(f"Removed {removed} expired job(s).")
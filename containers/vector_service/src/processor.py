@@ -47,11 +47,18 @@ class MainProcessor(threading.Thread):
             job = self.job_register.get_job(job_uuid)
             if isinstance(job, VectorJob):
                 job.set_status("processing")
-                if job.get_task_type() == "upload":
-                    self.process_upload(job)
-                elif job.get_task_type() == "query":
-                    self.process_query(job)
-                job.set_status("completed")
+                try:
+                    if job.get_task_type() == "upload":
+                        self.process_upload(job)
+                    elif job.get_task_type() == "query":
+                        self.process_query(job)
+                    job.set_status("completed")
+                except Exception as e:
+                    print(f"Error while processing VectorJob: {e}")
+                    job.set_status("failed")
+                finally:
+                    # The raw file contents are no longer needed once they are in the vector store or the upload failed
+                    job.release_files()
             self.task_queue.task_done()
 
     def process_upload(self, job: VectorJob) -> None: